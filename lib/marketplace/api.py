@@ -1,8 +1,11 @@
+import threading
+import time
+
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.decorators import method_decorator
 
-from cache_nuggets.lib import memoize
+from django_statsd.clients import statsd
 from requests.exceptions import ConnectionError
 
 from constants import COUNTRIES
@@ -10,6 +13,7 @@ from ..utils import SlumberWrapper
 
 from lib.solitude.constants import PROVIDER_BANGO, PROVIDERS_INVERTED
 
+from webpay.base.cache import stale_while_revalidate
 from webpay.base.logger import getLogger
 
 log = getLogger('w.marketplace')
@@ -25,38 +29,206 @@ class ConnectionFailed(ConnectionError):
     pass
 
 
+class PriceIndex(object):
+    """
+    An in-process index of the price tiers of each provider.
+
+    All tiers of a provider are loaded from zamboni in one go, in a
+    background thread, the first time they are needed; until they are
+    loaded, lookups return None and callers ask zamboni for the one tier
+    they need. Tiers are looked up by (point, provider) and prices by
+    (point, provider, region) without a network call. Once the tiers are
+    PRICE_INDEX['refresh'] seconds old they are reloaded in the background
+    while the old ones keep being served; once they are
+    PRICE_INDEX['max_age'] seconds old they are no longer used.
+
+    :param clock: returns the current time in seconds, for tests.
+    """
+
+    def __init__(self, client, clock=time.time):
+        self.client = client
+        self.clock = clock
+        self._tiers = {}
+        self._prices = {}
+        self._loaded = {}
+        self._failed = {}
+        # Maps a provider being loaded to the generation it is loaded for.
+        self._loading = {}
+        # Incremented by clear() so that loads started before are dropped.
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, provider):
+        """
+        Return all the tiers of a provider keyed by pricePoint. Stops
+        early if the index is cleared because load() drops them then.
+        """
+        generation = self._generation
+        tiers = {}
+        offset = 0
+        while generation == self._generation:
+            res = self.client.api.webpay.prices.get(
+                provider=provider, offset=offset,
+                limit=settings.PRICE_INDEX['page_size'])
+            for tier in res['objects']:
+                tiers[unicode(tier['pricePoint'])] = tier
+            if not res['meta'].get('next') or not res['objects']:
+                return tiers
+            offset += len(res['objects'])
+        return tiers
+
+    def load(self, provider):
+        """Load all the tiers of a provider into the index."""
+        generation = self._generation
+        try:
+            with statsd.timer('marketplace.price_index.load'):
+                tiers = self.fetch(provider)
+        except Exception:
+            log.exception('Failed to load price tiers for {0}'
+                          .format(provider))
+            statsd.incr('marketplace.price_index.load_failed')
+            with self._lock:
+                if generation == self._generation:
+                    self._failed[provider] = self.clock()
+            return
+
+        prices = {}
+        for point, tier in tiers.items():
+            for price in tier['prices']:
+                # The first price of a region wins, like a scan would.
+                prices.setdefault((point, price.get('region')),
+                                  (price['amount'], price['currency']))
+        with self._lock:
+            if generation != self._generation:
+                # The index was cleared while these were loading.
+                return
+            self._tiers[provider] = tiers
+            self._prices[provider] = prices
+            self._loaded[provider] = self.clock()
+            self._failed.pop(provider, None)
+        log.info('Loaded {0} price tiers for {1}'
+                 .format(len(tiers), provider))
+
+    def _load(self, provider, generation):
+        try:
+            self.load(provider)
+        finally:
+            with self._lock:
+                if self._loading.get(provider) == generation:
+                    del self._loading[provider]
+
+    def load_in_background(self, provider):
+        """
+        Load the tiers of a provider in a thread and return the thread,
+        unless they are already being loaded.
+        """
+        with self._lock:
+            if provider in self._loading:
+                return None
+            generation = self._loading[provider] = self._generation
+        thread = threading.Thread(target=self._load,
+                                  args=(provider, generation))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def ensure(self, provider):
+        """
+        Make sure the tiers of a provider are loaded, or being loaded, and
+        fresh enough. Returns False if they are not available yet.
+        """
+        config = settings.PRICE_INDEX
+
+        def age():
+            return self.clock() - self._loaded.get(provider, 0)
+
+        if age() > config['refresh']:
+            # Don't hammer zamboni while it's failing.
+            if (self.clock() - self._failed.get(provider, 0) >=
+                    config['refresh']):
+                self.load_in_background(provider)
+        return age() <= config['max_age']
+
+    def tier(self, point, provider):
+        """Return the tier or None if it isn't in the index."""
+        if not self.ensure(provider):
+            return None
+        tier = self._tiers.get(provider, {}).get(unicode(point))
+        statsd.incr('marketplace.price_index.{0}'
+                    .format('hit' if tier else 'miss'))
+        return tier
+
+    def price(self, point, provider, region):
+        """
+        Return the (amount, currency) of a tier in a region or None if it
+        isn't in the index.
+        """
+        if not self.ensure(provider):
+            return None
+        return self._prices.get(provider, {}).get((unicode(point), region))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._tiers.clear()
+            self._prices.clear()
+            self._loaded.clear()
+            self._failed.clear()
+            self._loading.clear()
+
+
 class MarketplaceAPI(SlumberWrapper):
     errors = {}
+    pool_name = 'marketplace'
+
+    def __init__(self, *args, **kw):
+        super(MarketplaceAPI, self).__init__(*args, **kw)
+        self.price_index = PriceIndex(self)
 
-    @method_decorator(memoize('marketplace:api:get_price'))
     def get_price(self, point, provider=PROVIDERS_INVERTED[PROVIDER_BANGO]):
         """
         Get the price points from zamboni for a provider.
 
+        The in-process price index is used when PRICE_INDEX_ENABLED is
+        True, falling back to asking zamboni for tiers it doesn't know.
+
         :param point: the name of the price tier.
         :param provider: the payment provider. Defaults to 'bango'.
         """
+        if settings.PRICE_INDEX_ENABLED:
+            tier = self.price_index.tier(point, provider)
+            if tier:
+                return tier
+        return self.fetch_price(point, provider)
+
+    @method_decorator(stale_while_revalidate(
+        'marketplace:api:get_price',
+        timeout=settings.PRICE_CACHE_TIMEOUT,
+        max_stale=settings.PRICE_CACHE_MAX_STALE))
+    def fetch_price(self, point, provider):
+        """
+        Get the price points for a provider from zamboni.
+
+        :param point: the name of the price tier.
+        :param provider: the payment provider.
+        """
         # https://bugzilla.mozilla.org/show_bug.cgi?id=1024065
         # This seems to fail more often than it should, so we'll retry
-        # it a few times.
-        #
-        # This is a filthy terrible hack.
-        for x in range(1, NUMBER_ATTEMPTS + 1):
-            log.info('Attempting to get prices: attempt: {0}'.format(x))
-            try:
-                res = (self.api.webpay.prices()
-                       .get_object(provider=provider, pricePoint=point))
-                log.info('Successfully got prices')
-                return res
-            except ObjectDoesNotExist:
-                raise UnknownPricePoint(point)
-            except ConnectionError:
-                log.error('Failed to get prices, attempt: {0}'.format(x))
-
-        # Re-raise the connection error.
-        log.error('Failed to get prices after {0} attempts'
-                  .format(NUMBER_ATTEMPTS))
-        raise ConnectionFailed(point)
+        # it a few times, see SLUMBER_RETRY['marketplace.prices'].
+        def fetch():
+            return (self.api.webpay.prices()
+                    .get_object(provider=provider, pricePoint=point))
+
+        try:
+            res = self.with_retries('prices', fetch, attempts=NUMBER_ATTEMPTS)
+        except ObjectDoesNotExist:
+            raise UnknownPricePoint(point)
+        except ConnectionError:
+            log.error('Failed to get prices for {0}'.format(point))
+            raise ConnectionFailed(point)
+
+        log.info('Successfully got prices')
+        return res
 
     def get_price_country(self, point, provider, country):
         """
@@ -67,9 +239,14 @@ class MarketplaceAPI(SlumberWrapper):
         :param provider: the payment provider.
         :param country: the country MCC code.
         """
-        tier = self.get_price(point, provider)
         # This assumes you've already validated the MCC is correct.
         country_id = COUNTRIES[country]
+        if settings.PRICE_INDEX_ENABLED:
+            price = self.price_index.price(point, provider, country_id)
+            if price:
+                return price
+
+        tier = self.get_price(point, provider)
         for price in tier['prices']:
             if price.get('region', None) == country_id:
                 return price['amount'], price['currency']
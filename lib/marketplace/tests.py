@@ -1,13 +1,17 @@
+import threading
+
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
+from django.test.utils import override_settings
 
 import mock
 from curling.lib import HttpServerError
 from nose.tools import eq_, raises
 from requests.exceptions import ConnectionError
 
-from lib.marketplace.api import client, NUMBER_ATTEMPTS, UnknownPricePoint
+from lib.marketplace.api import (client, NUMBER_ATTEMPTS, PriceIndex,
+                                 UnknownPricePoint)
 from lib.solitude.constants import PROVIDER_BOKU
 
 
@@ -24,6 +28,8 @@ sample_price = {
 }
 
 
+# These test asking zamboni for a tier so the index is left out.
+@override_settings(PRICE_INDEX_ENABLED=False)
 @mock.patch('lib.marketplace.api.client.api')
 class SolitudeAPITest(TestCase):
 
@@ -68,14 +74,17 @@ class SolitudeAPITest(TestCase):
             eq_(slumber.webpay.prices.call_count, 1)  # This stays the same.
             eq_(prices, sample_price)
 
-    def test_connection_error_raises(self, slumber):
+    @mock.patch('lib.utils.time.sleep')
+    def test_connection_error_raises(self, sleep, slumber):
         slumber.webpay.prices.side_effect = ConnectionError
         with self.assertRaises(ConnectionError):
             client.get_price(1)
 
         eq_(slumber.webpay.prices.call_count, NUMBER_ATTEMPTS)
+        eq_(sleep.call_count, NUMBER_ATTEMPTS - 1)
 
-    def test_connection_flaky(self, slumber):
+    @mock.patch('lib.utils.time.sleep')
+    def test_connection_flaky(self, sleep, slumber):
         sample = mock.Mock()
         sample.get_object.return_value = sample_price
 
@@ -90,3 +99,137 @@ class SolitudeAPITest(TestCase):
         slumber.webpay.prices.side_effect = failure
         client.get_price(1)
         eq_(slumber.webpay.prices.call_count, 3)
+
+
+@override_settings(PRICE_INDEX_ENABLED=True,
+                   PRICE_INDEX={'refresh': 60, 'max_age': 120,
+                                'page_size': 1})
+@mock.patch('lib.marketplace.api.client.api')
+class TestPriceIndex(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        client.price_index.clear()
+        self.tier_1 = dict(sample_price, pricePoint='1')
+        self.now = 1000
+
+    def mock(self, slumber):
+        slumber.webpay.prices.get.side_effect = [
+            {'meta': {'next': '/next/'}, 'objects': [sample_price]},
+            {'meta': {'next': None}, 'objects': [self.tier_1]}]
+
+    def index(self):
+        index = PriceIndex(client, clock=lambda: self.now)
+        p = mock.patch.object(index, 'load_in_background')
+        self.load_in_background = p.start()
+        self.addCleanup(p.stop)
+        return index
+
+    def foreground(self, index):
+        """Load tiers straight away instead of in a thread."""
+        p = mock.patch.object(index, 'load_in_background',
+                              side_effect=index.load)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_get_price(self, slumber):
+        self.mock(slumber)
+        self.foreground(client.price_index)
+        eq_(client.get_price(1, 'bango'), self.tier_1)
+        eq_(client.get_price('0', 'bango'), sample_price)
+        eq_(slumber.webpay.prices.get.call_count, 2)
+        slumber.webpay.prices.get.assert_called_with(
+            provider='bango', offset=1, limit=1)
+        assert not slumber.webpay.prices.called
+
+    def test_get_price_country(self, slumber):
+        self.mock(slumber)
+        self.foreground(client.price_index)
+        eq_(client.get_price_country(1, PROVIDER_BOKU, '334'),
+            (u'3.00', 'MXN'))
+
+    def test_unknown_falls_back(self, slumber):
+        self.mock(slumber)
+        self.foreground(client.price_index)
+        sample = mock.Mock()
+        sample.get_object.return_value = sample_price
+        slumber.webpay.prices.return_value = sample
+        client.get_price(5, 'bango')
+        sample.get_object.assert_called_with(provider='bango', pricePoint=5)
+
+    def test_falls_back_while_loading(self, slumber):
+        with mock.patch.object(client.price_index,
+                               'load_in_background') as load:
+            sample = mock.Mock()
+            sample.get_object.return_value = sample_price
+            slumber.webpay.prices.return_value = sample
+            eq_(client.get_price(0, 'bango'), sample_price)
+        load.assert_called_with('bango')
+
+    def test_load_failed(self, slumber):
+        slumber.webpay.prices.get.side_effect = HttpServerError
+        index = self.index()
+        self.foreground(index)
+        eq_(index.tier(1, 'bango'), None)
+        eq_(index.tier(1, 'bango'), None)
+        # It isn't loaded again straight away.
+        eq_(slumber.webpay.prices.get.call_count, 1)
+
+    def test_background_refresh(self, slumber):
+        self.mock(slumber)
+        index = self.index()
+        index.load('bango')
+        self.now = 1061
+        eq_(index.tier(1, 'bango'), self.tier_1)
+        self.load_in_background.assert_called_once_with('bango')
+
+    def test_expired(self, slumber):
+        self.mock(slumber)
+        index = self.index()
+        index.load('bango')
+        self.now = 1121
+        eq_(index.tier(1, 'bango'), None)
+
+    def blocked(self, slumber):
+        """Make loads wait until the returned event is set."""
+        release = threading.Event()
+
+        def get(**kw):
+            release.wait(5)
+            return {'meta': {'next': None}, 'objects': [sample_price]}
+        slumber.webpay.prices.get.side_effect = get
+        return release
+
+    def test_one_load_at_a_time(self, slumber):
+        release = self.blocked(slumber)
+        index = PriceIndex(client)
+        thread = index.load_in_background('bango')
+        eq_(index.load_in_background('bango'), None)
+        release.set()
+        thread.join(5)
+        eq_(index.tier(0, 'bango'), sample_price)
+        eq_(slumber.webpay.prices.get.call_count, 1)
+
+    def test_clear_while_loading(self, slumber):
+        release = self.blocked(slumber)
+        index = PriceIndex(client)
+        thread = index.load_in_background('bango')
+        index.clear()
+        # A load can start again straight away.
+        again = index.load_in_background('bango')
+        assert again
+        release.set()
+        thread.join(5)
+        again.join(5)
+        eq_(slumber.webpay.prices.get.call_count, 2)
+        eq_(index.tier(0, 'bango'), sample_price)
+
+    def test_cleared_load_dropped(self, slumber):
+        release = self.blocked(slumber)
+        index = PriceIndex(client)
+        thread = index.load_in_background('bango')
+        index.clear()
+        release.set()
+        thread.join(5)
+        eq_(index._tiers, {})
+        eq_(index._loading, {})
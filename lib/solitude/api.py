@@ -1,25 +1,34 @@
+import functools
+import hashlib
 import json
 import logging
 import sys
+import threading
+import urlparse
 import uuid
 import warnings
 
 from django.conf import settings
 from django.core.cache import cache
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import (MultipleObjectsReturned,
+                                    ObjectDoesNotExist)
 from django.core.urlresolvers import reverse
+from django.utils.encoding import smart_str
 
+from django_statsd.clients import statsd
 import mobile_codes
 from mpconstants import countries
+from requests import Response
 from slumber.exceptions import HttpClientError
 
 from lib.marketplace.constants import COUNTRIES
 from webpay.base import dev_messages as msg
+from webpay.base.cache import LocalCache, request_cache
 from webpay.base.helpers import absolutify
 
 from . import constants as solitude_const
 from .exceptions import ProviderTransactionError, ResourceNotModified
-from ..utils import SlumberWrapper
+from ..utils import call_concurrently, SlumberWrapper
 
 
 log = logging.getLogger('w.solitude')
@@ -36,6 +45,107 @@ class SellerNotConfigured(Exception):
     error_code = 'SELLER_NOT_CONFIGURED'
 
 
+class Batch(object):
+    """
+    Collects independent Solitude calls and makes them together.
+
+    Lookups added with get_object_or_404() are sent in a single request to
+    the composite endpoint at settings.SOLITUDE_BATCH_ENDPOINT when
+    Solitude offers one. Otherwise, and for any other call added with
+    add(), the calls are made concurrently (see
+    settings.SOLITUDE_CONCURRENT_LOOKUPS). Either way run() returns a list
+    of (result, exc_info) tuples in the order the calls were added, see
+    lib.utils.call_concurrently.
+    """
+
+    def __init__(self, slumber):
+        self.slumber = slumber
+        self.calls = []
+
+    def add(self, func, *args, **kw):
+        """Add a call to func(*args, **kw), returning its index."""
+        self.calls.append((functools.partial(func, *args, **kw), None))
+        return len(self.calls) - 1
+
+    def get_object_or_404(self, resource, **params):
+        """Add resource.get_object_or_404(**params), returning its index."""
+        self.calls.append((functools.partial(resource.get_object_or_404,
+                                             **params),
+                           (resource, params)))
+        return len(self.calls) - 1
+
+    def run(self):
+        concurrent = settings.SOLITUDE_CONCURRENT_LOOKUPS
+        lookups = [index for index, (func, lookup) in enumerate(self.calls)
+                   if lookup]
+        if not settings.SOLITUDE_BATCH_ENDPOINT or not lookups:
+            return call_concurrently(*[func for func, lookup in self.calls],
+                                     concurrent=concurrent)
+
+        others = [index for index in range(len(self.calls))
+                  if index not in lookups]
+        results = call_concurrently(
+            functools.partial(self.composite,
+                              [self.calls[index][1] for index in lookups]),
+            *[self.calls[index][0] for index in others],
+            concurrent=concurrent)
+        composite, exc_info = results[0]
+        if exc_info:
+            # The whole batch failed.
+            composite = [(None, exc_info)] * len(lookups)
+        ordered = dict(zip(lookups, composite))
+        ordered.update(zip(others, results[1:]))
+        return [ordered[index] for index in range(len(self.calls))]
+
+    def composite(self, lookups):
+        """
+        Make the lookups in one request to the composite endpoint and
+        return their (result, exc_info) tuples.
+        """
+        base = urlparse.urlparse(self.slumber._store['base_url']).path
+        endpoint = self.slumber
+        for part in settings.SOLITUDE_BATCH_ENDPOINT.strip('/').split('/'):
+            endpoint = getattr(endpoint, part)
+        res = endpoint.post({'requests': [
+            {'method': 'GET',
+             'path': urlparse.urlparse(resource._store['base_url'])
+                             .path[len(base):],
+             'params': params}
+            for resource, params in lookups]})
+
+        results = []
+        for (resource, params), response in zip(lookups, res['responses']):
+            try:
+                results.append((self.result(resource, response), None))
+            except Exception:
+                results.append((None, sys.exc_info()))
+        return results
+
+    def result(self, resource, response):
+        """Return the object get_object_or_404() would have returned."""
+        body = response['body']
+        if response['status'] == 404:
+            raise ObjectDoesNotExist(resource._store['base_url'])
+        if response['status'] >= 400:
+            # Raise it the way slumber does, so that safe_run() and the
+            # other callers can read the status and content of the response.
+            url = resource._store['base_url']
+            res = Response()
+            res.status_code = response['status']
+            res._content = json.dumps(body)
+            res.url = url
+            raise HttpClientError('Client Error {0}: {1}'.format(
+                res.status_code, url), response=res, content=res.content)
+        if 'meta' not in body:
+            return body
+        count = body['meta']['total_count']
+        if count == 0:
+            raise ObjectDoesNotExist(resource._store['base_url'])
+        if count > 1:
+            raise MultipleObjectsReturned(resource._store['base_url'])
+        return body['objects'][0]
+
+
 class SolitudeAPI(SlumberWrapper):
     """
     A Solitude facade that works with a payment provider or the
@@ -43,9 +153,49 @@ class SolitudeAPI(SlumberWrapper):
 
     :param url: URL of the solitude endpoint.
     """
+    pool_name = 'solitude'
 
     def __init__(self, *args, **kw):
         super(SolitudeAPI, self).__init__(*args, **kw)
+        # Buyer etags and buyers are kept in this process before falling
+        # back to the shared cache.
+        self.buyer_cache = LocalCache(
+            'solitude.buyer', size=settings.BUYER_LOCAL_CACHE_SIZE,
+            timeout=settings.BUYER_LOCAL_CACHE_TIMEOUT)
+
+    def _cache_get(self, key):
+        value = self.buyer_cache.get(key)
+        if value is None:
+            value = cache.get(key)
+            if value is not None:
+                self.buyer_cache.set(key, value)
+        return value
+
+    def _cache_set(self, key, value):
+        self.buyer_cache.set(key, value)
+        cache.set(key, value)
+
+    def _remember_buyer(self, uuid, obj):
+        etag = obj['etag']
+        self._cache_set('etag:%s' % uuid, etag)
+        self._cache_set('buyer:%s' % etag, obj)
+        request_cache.set('solitude:buyer:%s' % uuid, obj)
+        if obj.get('resource_pk'):
+            # The resource_pk of a buyer never changes so keep it for as
+            # long as possible.
+            key = 'buyer_pk:%s' % uuid
+            self.buyer_cache.set(key, obj['resource_pk'], timeout=0)
+            cache.set(key, obj['resource_pk'],
+                      settings.BUYER_PK_CACHE_TIMEOUT)
+
+    def _forget_buyer(self, uuid):
+        # The buyer was changed in Solitude, its etag takes care of the
+        # other caches.
+        request_cache.delete('solitude:buyer:%s' % uuid)
+
+    def batch(self):
+        """Return a Batch to make several independent calls together."""
+        return Batch(self.slumber)
 
     def create_buyer(self, uuid, email, pin=None, pin_confirmed=False):
         """Creates a buyer with an optional PIN in solitude.
@@ -66,50 +216,99 @@ class SolitudeAPI(SlumberWrapper):
         obj = self.safe_run(self.slumber.generic.buyer.post, pin_data)
 
         if 'etag' in obj:
-            etag = obj['etag']
-            cache.set('etag:%s' % uuid, etag)
-            cache.set('buyer:%s' % etag, obj)
+            self._remember_buyer(uuid, obj)
         return obj
 
     def get_buyer(self, uuid, use_etags=True):
         """Retrieves a buyer by their uuid.
 
+        Within a request the buyer is only fetched once. Otherwise a
+        conditional GET is made using the last known etag from the
+        in-process or shared cache.
+
         :param uuid: String to identify the buyer by.
         :rtype: dictionary
         """
-        cache_key = 'etag:%s' % uuid
-        etag = cache.get(cache_key) if use_etags else None
+        if use_etags:
+            obj = request_cache.get('solitude:buyer:%s' % uuid)
+            if obj is not None:
+                return obj
+
+        etag = self._cache_get('etag:%s' % uuid) if use_etags else None
         headers = {'If-None-Match': etag} if etag else {}
         try:
             obj = self.safe_run(self.slumber.generic.buyer.get_object_or_404,
                                 headers=headers, uuid=uuid)
         except ResourceNotModified:
-            return (cache.get('buyer:%s' % etag)
-                    or self.get_buyer(uuid, use_etags=False))
+            obj = self._cache_get('buyer:%s' % etag)
+            if not obj:
+                return self.get_buyer(uuid, use_etags=False)
+            request_cache.set('solitude:buyer:%s' % uuid, obj)
+            return obj
         except ObjectDoesNotExist:
             obj = {}
         if 'etag' in obj:
-            etag = obj['etag']
-            cache.set(cache_key, etag)
-            cache.set('buyer:%s' % etag, obj)
+            self._remember_buyer(uuid, obj)
         return obj
 
-    def update_buyer(self, uuid, etag='', **kwargs):
+    def _buyer_patch(self, id_):
+        """
+        Returns the patch method of a buyer that raises ObjectDoesNotExist
+        when the buyer is not found.
+        """
+        patch = self.slumber.generic.buyer(id=id_).patch
+
+        def patch_existing(*args, **kwargs):
+            try:
+                return patch(*args, **kwargs)
+            except HttpClientError as err:
+                if err.response.status_code == 404:
+                    raise ObjectDoesNotExist(
+                        'Buyer {0} does not exist'.format(id_))
+                raise
+
+        return patch_existing
+
+    def update_buyer(self, uuid, etag='', buyer=None, **kwargs):
         """Updates a buyer identified by their uuid.
 
+        The buyer's resource_pk is taken from `buyer` or from the cache of
+        known buyers so that the update is a single request. The buyer is
+        only looked up when its resource_pk is unknown or turns out to be
+        stale.
+
         :param uuid: String to identify the buyer by.
+        :param buyer: Optional buyer dictionary, as returned by get_buyer.
         :rtype: dictionary
         """
-        id_ = self.get_buyer(uuid).get('resource_pk')
-        res = self.safe_run(self.slumber.generic.buyer(id=id_).patch,
-                            kwargs,
-                            headers={'If-Match': etag})
+        pk_key = 'buyer_pk:%s' % uuid
+        id_ = (buyer or {}).get('resource_pk') or self._cache_get(pk_key)
+        self._forget_buyer(uuid)
+        headers = {'If-Match': etag}
+        res = None
+        stale = False
+        if id_:
+            try:
+                res = self.safe_run(self._buyer_patch(id_), kwargs,
+                                    headers=headers)
+            except ObjectDoesNotExist:
+                log.info('Buyer {uuid} is no longer resource {pk}, '
+                         'looking it up'.format(uuid=uuid, pk=id_))
+                self.buyer_cache.delete(pk_key)
+                cache.delete(pk_key)
+                stale = True
+
+        if res is None:
+            id_ = (self.get_buyer(uuid, use_etags=not stale)
+                   .get('resource_pk'))
+            res = self.safe_run(self.slumber.generic.buyer(id=id_).patch,
+                                kwargs, headers=headers)
         if 'errors' in res:
             return res
         return {}
 
     def change_pin(self, uuid, pin, etag='', pin_confirmed=False,
-                   clear_was_locked=False):
+                   clear_was_locked=False, buyer=None):
         """Changes the pin of a buyer, for use with buyers who exist without
         pins.
 
@@ -120,23 +319,26 @@ class SolitudeAPI(SlumberWrapper):
                               in the UI.
         :param clear_was_locked: Boolean to clear the pin_was_locked_out state
                                  if the PIN was changed by the user.
+        :param buyer: Optional buyer dictionary, if already known.
         :rtype: dictionary
         """
         pin_data = {'pin': pin, 'pin_confirmed': pin_confirmed}
         if clear_was_locked:
             pin_data['pin_was_locked_out'] = False
 
-        return self.update_buyer(uuid, etag=etag, **pin_data)
+        return self.update_buyer(uuid, etag=etag, buyer=buyer, **pin_data)
 
-    def set_new_pin(self, uuid, new_pin, etag=''):
+    def set_new_pin(self, uuid, new_pin, etag='', buyer=None):
         """Sets the new_pin for use with a buyer that is resetting their pin.
 
         :param buyer_id integer: ID of the buyer you'd like to change the PIN
                                  for.
         :param pin: PIN the user would like to change to.
+        :param buyer: Optional buyer dictionary, if already known.
         :rtype: dictionary
         """
-        return self.update_buyer(uuid, etag=etag, new_pin=new_pin)
+        return self.update_buyer(uuid, etag=etag, buyer=buyer,
+                                 new_pin=new_pin)
 
     def get_active_product(self, public_id):
         """
@@ -155,7 +357,7 @@ class SolitudeAPI(SlumberWrapper):
         :param pin: PIN to confirm
         :rtype: boolean
         """
-
+        self._forget_buyer(uuid)
         res = self.safe_run(self.slumber.generic.confirm_pin.post,
                             {'uuid': uuid, 'pin': pin})
         return res.get('confirmed', False)
@@ -167,7 +369,7 @@ class SolitudeAPI(SlumberWrapper):
         :param pin: PIN to confirm
         :rtype: boolean
         """
-
+        self._forget_buyer(uuid)
         res = self.safe_run(self.slumber.generic.reset_confirm_pin.post,
                             {'uuid': uuid, 'pin': pin})
         return res.get('confirmed', False)
@@ -179,7 +381,8 @@ class SolitudeAPI(SlumberWrapper):
         :param pin: PIN to check
         :rtype: dictionary
         """
-
+        # Verifying can lock the buyer out.
+        self._forget_buyer(uuid)
         res = self.safe_run(self.slumber.generic.verify_pin.post,
                             {'uuid': uuid, 'pin': pin})
         return res
@@ -193,16 +396,78 @@ class SolitudeAPI(SlumberWrapper):
         return transaction
 
 
+class ProviderRoutes(object):
+    """
+    A table of the payment providers to offer on each mobile network, in
+    order of preference.
+
+    The table is built once from settings and the provider network data.
+    It is rebuilt when settings.PAYMENT_PROVIDER or the networks of
+    BokuProvider change, so it never needs to be reloaded by hand.
+    """
+
+    def __init__(self):
+        self._table = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        if settings.PAYMENT_PROVIDER == BokuProvider.name:
+            raise ValueError('Since Boku is detected by network '
+                             'use SIMULATED_NETWORK to force it instead')
+
+        # Always allow the default provider.
+        default = (settings.PAYMENT_PROVIDER,)
+        # Allow Boku when on one of their networks.
+        networks = dict((network, (BokuProvider.name,) + default)
+                        for network in BokuProvider.network_data)
+        return settings.PAYMENT_PROVIDER, networks, default
+
+    def current(self, table):
+        """Return True if table was built from the current data."""
+        provider, networks, default = table
+        return (provider == settings.PAYMENT_PROVIDER and
+                networks.viewkeys() == BokuProvider.network_data.viewkeys())
+
+    def get(self, mcc=None, mnc=None):
+        """Return a tuple of provider names for the network."""
+        table = self._table
+        if table is None or not self.current(table):
+            with self._lock:
+                table = self._table = self.build()
+        provider, networks, default = table
+        return networks.get((mcc, mnc), default)
+
+
+provider_routes = ProviderRoutes()
+
+
 class ProviderHelper:
     """
     A common interface to all payment providers.
     """
+    # Helpers are stateless so they are shared, see get(). This maps the
+    # name of a provider to its helper for the default client.
+    _helpers = {}
+
     def __init__(self, name, slumber=None):
         self.slumber = slumber or client.slumber
         ProviderClass = provider_cls(name)
         self.provider = ProviderClass(self.slumber)
         self.name = self.provider.name
 
+    @classmethod
+    def get(cls, name):
+        """
+        Return a shared helper for the provider called name that uses the
+        default client, creating it the first time. To use another
+        slumber create a ProviderHelper instead.
+        """
+        helper = cls._helpers.get(name)
+        if helper is None or helper.slumber is not client.slumber:
+            # The client's slumber is replaced in tests.
+            helper = cls._helpers[name] = cls(name)
+        return helper
+
     @classmethod
     def supported_providers(cls, mcc=None, mnc=None):
         """
@@ -217,23 +482,12 @@ class ProviderHelper:
         **mnc**
             The user's mobile network code, if known.
         """
-        if settings.PAYMENT_PROVIDER == BokuProvider.name:
-            raise ValueError('Since Boku is detected by network '
-                             'use SIMULATED_NETWORK to force it instead')
-
-        supported_providers = []
-
-        # Allow Boku when on one of their networks.
-        if (mcc, mnc) in BokuProvider.network_data:
-            supported_providers.append(BokuProvider.name)
-
-        # Always allow the default provider.
-        supported_providers.append(settings.PAYMENT_PROVIDER)
-
+        supported_providers = provider_routes.get(mcc, mnc)
         log.info('supported payment providers: {p}'
                  .format(p=', '.join(supported_providers)))
 
-        return [cls(provider_name) for provider_name in supported_providers]
+        return [cls.get(provider_name)
+                for provider_name in supported_providers]
 
     def start_transaction(self, transaction_uuid,
                           generic_seller_uuid, provider_seller_uuid,
@@ -241,52 +495,38 @@ class ProviderHelper:
                           prices, icon_url,
                           user_uuid, application_size,
                           source='unknown',
-                          mcc=None, mnc=None):
+                          mcc=None, mnc=None, generic_seller=None):
         """
         Start a payment provider transaction to begin the purchase flow.
-        """
-        try:
-            generic_buyer = self.slumber.generic.buyer.get_object_or_404(
-                uuid=user_uuid)
-        except ObjectDoesNotExist:
-            raise BuyerNotConfigured(
-                '{pr}: Buyer with uuid {u} does not exist'
-                .format(u=user_uuid, pr=self.provider.name))
 
-        try:
-            generic_seller = self.slumber.generic.seller.get_object_or_404(
-                uuid=generic_seller_uuid)
-        except ObjectDoesNotExist:
-            raise SellerNotConfigured(
-                '{pr}: Seller with uuid {u} does not exist'
-                .format(u=generic_seller_uuid, pr=self.provider.name))
+        If the caller already has the generic seller it can pass it as
+        `generic_seller` and the buyer, product and provider product are
+        then all fetched in one batch.
+
+        Returns a tuple of (provider transaction ID, payment start URL,
+        generic seller pk, generic transaction).
+        """
+        if generic_seller:
+            generic_buyer, (product, provider_product, found) = (
+                self.get_buyer_and_products(user_uuid, generic_seller,
+                                            product_id))
+        else:
+            generic_buyer, generic_seller = self.get_buyer_and_seller(
+                user_uuid, generic_seller_uuid)
+            product, provider_product, found = self.get_products(
+                generic_seller, product_id)
         generic_seller_id = generic_seller['resource_pk']
         log.info('{pr}: starting transaction {tr}: generic seller: {sel}'
                  .format(tr=transaction_uuid, sel=generic_seller_id,
                          pr=self.provider.name))
-        log.info('{pr}: get product for seller_uuid={uuid} external_id={ext}'
-                 .format(pr=self.provider.name,
-                         uuid=generic_seller_uuid, ext=product_id))
 
-        product = None
-        try:
-            product = self.slumber.generic.product.get_object_or_404(
-                external_id=product_id,
-                seller=generic_seller_id,
-            )
-            log.info('{pr}: found generic product {prod}'
-                     .format(pr=self.provider.name, prod=product))
-            provider_product = self.provider.get_product(generic_seller,
-                                                         product)
-            log.info('{pr}: found provider product {prod}'
-                     .format(prod=provider_product, pr=self.provider.name))
-        except ObjectDoesNotExist:
+        if not found:
             product, provider_product = self.create_product(
                 external_id=product_id, product_name=product_name,
                 generic_seller=generic_seller, generic_product=product,
                 provider_seller_uuid=provider_seller_uuid)
 
-        trans_token, pay_url = self.provider.create_transaction(
+        trans_token, pay_url, trans = self.provider.create_transaction(
             generic_buyer=generic_buyer,
             generic_seller=generic_seller,
             generic_product=product,
@@ -305,7 +545,130 @@ class ProviderHelper:
         log.info('{pr}: made provider trans {trans}'
                  .format(trans=trans_token, pr=self.provider.name))
 
-        return trans_token, pay_url, generic_seller_id
+        return trans_token, pay_url, generic_seller_id, trans
+
+    def get_buyer_and_seller(self, user_uuid, generic_seller_uuid):
+        """
+        Get the generic buyer and generic seller for a transaction.
+
+        These lookups are independent so they are made in one batch. Errors
+        are raised in the same order as if the lookups were made one after
+        another.
+        """
+        generic = self.slumber.generic
+        batch = Batch(self.slumber)
+        batch.get_object_or_404(generic.buyer, uuid=user_uuid)
+        batch.get_object_or_404(generic.seller, uuid=generic_seller_uuid)
+        (buyer, buyer_error), (seller, seller_error) = batch.run()
+
+        self._check_buyer(user_uuid, buyer_error)
+        if seller_error:
+            if issubclass(seller_error[0], ObjectDoesNotExist):
+                raise SellerNotConfigured(
+                    '{pr}: Seller with uuid {u} does not exist'
+                    .format(u=generic_seller_uuid, pr=self.provider.name))
+            raise seller_error[0], seller_error[1], seller_error[2]
+
+        return buyer, seller
+
+    def get_buyer_and_products(self, user_uuid, generic_seller, product_id):
+        """
+        Get the generic buyer and, as get_products() does, the products
+        for a transaction in one batch.
+        """
+        products = self.cached_products(generic_seller, product_id)
+        batch = Batch(self.slumber)
+        batch.get_object_or_404(self.slumber.generic.buyer, uuid=user_uuid)
+        if not products:
+            self._add_products(batch, generic_seller, product_id)
+        results = batch.run()
+
+        buyer, buyer_error = results[0]
+        self._check_buyer(user_uuid, buyer_error)
+        return buyer, products or self._products(generic_seller, product_id,
+                                                 *results[1:])
+
+    def get_products(self, generic_seller, product_id):
+        """
+        Get the generic product and provider product for a transaction in
+        one batch.
+
+        Returns (product, provider_product, found). When found is False
+        the provider product doesn't exist yet and product is None if the
+        generic product doesn't exist either.
+        """
+        products = self.cached_products(generic_seller, product_id)
+        if products:
+            return products
+        batch = Batch(self.slumber)
+        self._add_products(batch, generic_seller, product_id)
+        return self._products(generic_seller, product_id, *batch.run())
+
+    def product_cache_key(self, generic_seller, product_id):
+        return 'solitude:product:{0}:{1}:{2}'.format(
+            self.name, generic_seller['resource_pk'],
+            hashlib.md5(smart_str(product_id)).hexdigest())
+
+    def cached_products(self, generic_seller, product_id):
+        """
+        Return the cached result of get_products() for a product that was
+        found, or None.
+
+        Products are cached for PRODUCT_CACHE_TIMEOUT seconds so that
+        repeat purchases of the same product don't look it up every time.
+        """
+        if not settings.PRODUCT_CACHE_TIMEOUT:
+            return None
+        products = cache.get(self.product_cache_key(generic_seller,
+                                                    product_id))
+        statsd.incr('solitude.product_cache.{0}'
+                    .format('hit' if products else 'miss'))
+        return products
+
+    def invalidate_products(self, generic_seller, product_id):
+        cache.delete(self.product_cache_key(generic_seller, product_id))
+
+    def _check_buyer(self, user_uuid, buyer_error):
+        if buyer_error:
+            if issubclass(buyer_error[0], ObjectDoesNotExist):
+                raise BuyerNotConfigured(
+                    '{pr}: Buyer with uuid {u} does not exist'
+                    .format(u=user_uuid, pr=self.provider.name))
+            raise buyer_error[0], buyer_error[1], buyer_error[2]
+
+    def _add_products(self, batch, generic_seller, product_id):
+        log.info('{pr}: get product for seller={sel} external_id={ext}'
+                 .format(pr=self.provider.name,
+                         sel=generic_seller['resource_pk'], ext=product_id))
+        # The provider product is found by the seller and external_id so
+        # it doesn't need to wait for the generic product.
+        batch.get_object_or_404(self.slumber.generic.product,
+                                external_id=product_id,
+                                seller=generic_seller['resource_pk'])
+        batch.add(self.provider.get_product, generic_seller, product_id)
+
+    def _products(self, generic_seller, product_id, product_result,
+                  provider_product_result):
+        product, product_error = product_result
+        provider_product, provider_product_error = provider_product_result
+        for error in (product_error, provider_product_error):
+            if error and not issubclass(error[0], ObjectDoesNotExist):
+                raise error[0], error[1], error[2]
+
+        if product_error:
+            # Without a generic product there can't be a provider product.
+            return None, None, False
+        log.info('{pr}: found generic product {prod}'
+                 .format(pr=self.provider.name, prod=product))
+        if provider_product_error:
+            return product, None, False
+        log.info('{pr}: found provider product {prod}'
+                 .format(prod=provider_product, pr=self.provider.name))
+        products = product, provider_product, True
+        if settings.PRODUCT_CACHE_TIMEOUT:
+            cache.set(self.product_cache_key(generic_seller, product_id),
+                      products, settings.PRODUCT_CACHE_TIMEOUT)
+        return products
 
     def create_product(self, external_id, product_name, generic_seller,
                        provider_seller_uuid, generic_product=None):
@@ -346,6 +709,7 @@ class ProviderHelper:
             generic_product, provider_seller, external_id, product_name)
         log.info('{pr}: created provider product {prod}'
                  .format(prod=provider_product, pr=self.provider.name))
+        self.invalidate_products(generic_seller, external_id)
 
         return generic_product, provider_product
 
@@ -452,9 +816,10 @@ class PayProvider(object):
         # such as /provider/reference/:
         return getattr(self.slumber.provider, self.name)
 
-    def get_product(self, generic_seller, generic_product):
+    def get_product(self, generic_seller, external_id):
         """
-        Returns the provider specific product object from Solitude.
+        Returns the provider specific product object from Solitude for the
+        generic product of the seller with this external_id.
         """
         raise NotImplementedError()
 
@@ -483,7 +848,7 @@ class PayProvider(object):
 
         Return the provider a tuple of:
 
-        (transaction ID, payment start URL)
+        (transaction ID, payment start URL, generic transaction)
         """
         raise NotImplementedError()
 
@@ -553,11 +918,11 @@ class ReferenceProvider(PayProvider):
             'uuid': str(uuid.uuid4()),
         })
 
-    def get_product(self, generic_seller, generic_product):
+    def get_product(self, generic_seller, external_id):
         # This returns a partial result.
         listing = self.api.products.get_object_or_404(
             seller_product__seller=generic_seller['resource_pk'],
-            seller_product__external_id=generic_product['external_id'])
+            seller_product__external_id=external_id)
         # This pings zippy and returns us a full result.
         return self.api.products(id=listing['id']).get_object_or_404()
 
@@ -626,7 +991,7 @@ class ReferenceProvider(PayProvider):
         log.info('made solitude trans {trans}'.format(trans=trans))
 
         token = provider_trans['token']
-        return token, self._formatted_payment_url(token)
+        return token, self._formatted_payment_url(token), trans
 
     def get_seller(self, generic_seller, provider_seller_uuid):
         return (self.api.sellers
@@ -658,7 +1023,7 @@ class BokuProvider(PayProvider):
     def api(self):
         return self.slumber.boku
 
-    def get_product(self, generic_seller, generic_product):
+    def get_product(self, generic_seller, external_id):
         # Boku does not have a products API the way Bango does.
         return None
 
@@ -728,7 +1093,8 @@ class BokuProvider(PayProvider):
         log.info('{pr}: made solitude trans {trans}'
                  .format(pr=self.name, trans=trans))
 
-        return provider_trans['transaction_id'], provider_trans['buy_url']
+        return (provider_trans['transaction_id'], provider_trans['buy_url'],
+                trans)
 
     def get_notification_data(self, request):
         return request.GET
@@ -762,10 +1128,10 @@ class BangoProvider(PayProvider):
     def api(self):
         return self.slumber.bango
 
-    def get_product(self, generic_seller, generic_product):
+    def get_product(self, generic_seller, external_id):
         return self.api.product.get_object_or_404(
             seller_product__seller=generic_seller['resource_pk'],
-            seller_product__external_id=generic_product['external_id'])
+            seller_product__external_id=external_id)
 
     def create_product(self, generic_product, provider_seller, external_id,
                        product_name):
@@ -868,7 +1234,7 @@ class BangoProvider(PayProvider):
         log.info('{pr}: made solitude trans {trans}'
                  .format(pr=self.name, trans=trans))
 
-        return bill_id, self._formatted_payment_url(bill_id)
+        return bill_id, self._formatted_payment_url(bill_id), trans
 
     def transaction_from_notice(self, parsed_qs):
         raise NotImplementedError()
@@ -0,0 +1,168 @@
+"""
+An in-process stand-in for the Solitude API, for tests and load tests.
+
+It is a requests transport adapter so it can be mounted on the shared
+Slumber session in place of the real server; no socket is opened, which
+keeps it working under blockage. Resources are kept in memory as lists of
+dicts per path, for example::
+
+    fake = FakeSolitude()
+    fake.add('generic/buyer', uuid='buyer:uuid')
+    with fake.installed(client):
+        client.slumber.generic.buyer.get_object_or_404(uuid='buyer:uuid')
+
+Only what webpay uses is implemented: filtering lists by exact field
+values, getting and patching by pk, creating with POST and the batch
+endpoint. Every request is kept in `requests` so tests can count round
+trips. Lists can be paged with offset and limit.
+
+It doesn't know anything Solitude specific so it also stands in for the
+Marketplace API, see webpay.pay.loadtest. Latency and server errors can
+be injected to see how webpay copes with a slow or failing server.
+"""
+import contextlib
+import json
+import random
+import threading
+import time
+import urlparse
+
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from lib.utils import host_prefix
+
+
+class FakeSolitude(BaseAdapter):
+    """
+    :param latency: seconds to wait before answering each request.
+    :param error_rate: the fraction of requests, from 0 to 1, answered with
+                       a 500 error instead.
+    """
+
+    def __init__(self, latency=0, error_rate=0):
+        super(FakeSolitude, self).__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.resources = {}
+        # Canned responses to POSTs keyed by path.
+        self.post_responses = {}
+        self.requests = []
+        self.prefix = ''
+        self.last_pk = 0
+        self.lock = threading.RLock()
+
+    def add(self, path, **obj):
+        """Store a resource under path, giving it a pk and URI."""
+        with self.lock:
+            self.last_pk += 1
+            obj.setdefault('resource_pk', self.last_pk)
+            obj.setdefault('resource_uri', '/{0}/{1}/'.format(
+                path, obj['resource_pk']))
+            self.resources.setdefault(path, []).append(obj)
+        return obj
+
+    def on_post(self, path, **response):
+        """Respond to POSTs to path with response instead of creating."""
+        self.post_responses[path] = response
+
+    @contextlib.contextmanager
+    def installed(self, api):
+        """Mount this on the session of a SlumberWrapper while in use."""
+        base_url = api.slumber._store['base_url']
+        session = api.slumber._store['session']
+        prefix = host_prefix(base_url)
+        self.prefix = urlparse.urlparse(base_url).path
+        old = session.adapters[prefix]
+        session.mount(prefix, self)
+        try:
+            yield self
+        finally:
+            session.mount(prefix, old)
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        url = urlparse.urlparse(request.url)
+        path = url.path[len(self.prefix):].strip('/')
+        query = dict(urlparse.parse_qsl(url.query))
+        data = json.loads(request.body) if request.body else None
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests.append((request.method, path, query))
+            if self.error_rate and random.random() < self.error_rate:
+                status, content = 500, {'error': 'Injected error'}
+            else:
+                status, content = self.handle(request.method, path, query,
+                                              data)
+        return self.response(request, status, content)
+
+    def response(self, request, status, content):
+        res = Response()
+        res.status_code = status
+        res._content = json.dumps(content) if content is not None else ''
+        res.headers['Content-Type'] = 'application/json'
+        res.url = request.url
+        res.request = request
+        return res
+
+    def split(self, path):
+        """Split a path into (collection, pk or None)."""
+        head, _, tail = path.rpartition('/')
+        if tail.isdigit():
+            return head, int(tail)
+        return path, None
+
+    def find(self, collection, pk):
+        for obj in self.resources.get(collection, []):
+            if obj['resource_pk'] == pk:
+                return obj
+
+    def matches(self, value, wanted):
+        """
+        Compare a field to a filter value. Like Solitude, a related object
+        stored by URI can be filtered by its pk.
+        """
+        if unicode(value) == unicode(wanted):
+            return True
+        return (isinstance(value, basestring) and
+                value.endswith('/{0}/'.format(wanted)))
+
+    def handle(self, method, path, query, data):
+        if path == 'generic/batch' and method == 'POST':
+            return 200, {'responses': [
+                dict(zip(('status', 'body'),
+                         self.handle('GET', req['path'].strip('/'),
+                                     req.get('params', {}), None)))
+                for req in data['requests']]}
+
+        collection, pk = self.split(path)
+        if pk is not None:
+            obj = self.find(collection, pk)
+            if obj is None:
+                return 404, {}
+            if method == 'PATCH':
+                obj.update(data)
+            return 200, obj
+
+        if method == 'GET':
+            query.pop('format', None)
+            offset = int(query.pop('offset', 0))
+            limit = int(query.pop('limit', 0))
+            objects = [item for item in self.resources.get(collection, [])
+                       if all(self.matches(item.get(k), v)
+                              for k, v in query.items())]
+            page = objects[offset:offset + limit if limit else None]
+            more = limit and offset + limit < len(objects)
+            return 200, {'meta': {'total_count': len(objects),
+                                  'next': path if more else None},
+                         'objects': page}
+
+        if method == 'POST':
+            if collection in self.post_responses:
+                return 201, self.post_responses[collection]
+            return 201, self.add(collection, **data)
+
+        return 405, {}
@@ -1,27 +1,35 @@
 import json
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import (MultipleObjectsReturned,
+                                    ObjectDoesNotExist)
 from django.test import TestCase
+from django.test.utils import override_settings
 
+from curling.lib import HttpServerError
 import mobile_codes
 import mock
 from mpconstants import countries
 from nose.tools import eq_, raises
 from slumber.exceptions import HttpClientError
 
-from lib.solitude.api import (BokuProvider, client,
-                              ProviderHelper, SellerNotConfigured)
+from lib.solitude.api import (BokuProvider, BuyerNotConfigured, client,
+                              provider_routes, ProviderHelper,
+                              SellerNotConfigured)
 from lib.solitude import constants
+from lib.solitude.fake import FakeSolitude
 from lib.solitude.exceptions import ResourceModified, ResourceNotModified
 from webpay.base import dev_messages as msg
+from webpay.base.cache import request_cache
 
 
 @mock.patch('lib.solitude.api.client.slumber')
 class SolitudeAPITest(TestCase):
 
     def setUp(self):
+        client.buyer_cache.clear()
         self.uuid = 'dat:uuid'
         self.email = 'buyer@buying.com'
         self.pin = '1234'
@@ -75,6 +83,44 @@ class SolitudeAPITest(TestCase):
         buyer2 = client.get_buyer(self.uuid)
         eq_(buyer.get('etag'), buyer2.get('etag'))
 
+    def test_get_buyer_once_per_request(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        request_cache.start()
+        try:
+            eq_(client.get_buyer(self.uuid), client.get_buyer(self.uuid))
+        finally:
+            request_cache.stop()
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 1)
+
+    def test_get_buyer_outside_request(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        client.get_buyer(self.uuid)
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 2)
+
+    def test_get_buyer_local_etag(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        # The etag and buyer are still known without the shared cache.
+        cache.clear()
+        slumber.generic.buyer.get_object_or_404.side_effect = (
+            ResourceNotModified())
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+        kw = slumber.generic.buyer.get_object_or_404.call_args[1]
+        eq_(kw['headers'], {'If-None-Match': self.buyer_data['etag']})
+
+    def test_verify_pin_forgets_buyer(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        slumber.generic.verify_pin.post.return_value = {'valid': False}
+        request_cache.start()
+        try:
+            client.get_buyer(self.uuid)
+            client.verify_pin(self.uuid, self.pin)
+            client.get_buyer(self.uuid)
+        finally:
+            request_cache.stop()
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 2)
+
     def test_non_existent_get_buyer(self, slumber):
         slumber.generic.buyer.get_object_or_404.side_effect = HttpClientError(
             response=self.create_error_response())
@@ -292,6 +338,39 @@ class SolitudeAPITest(TestCase):
         buyer.patch.assert_called_with({'pin': '1234', 'pin_confirmed': False},
                                        headers={'If-Match': ''})
 
+    def test_update_buyer_with_known_buyer(self, slumber):
+        buyer = self.setup_buyer(slumber)
+        client.change_pin(self.uuid, '1234', buyer=self.buyer_data)
+        assert not slumber.generic.buyer.get_object_or_404.called
+        slumber.generic.buyer.assert_called_with(id='5678')
+        assert buyer.patch.called
+
+    def test_update_buyer_with_cached_pk(self, slumber):
+        buyer = self.setup_buyer(slumber)
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        slumber.generic.buyer.get_object_or_404.reset_mock()
+
+        client.set_new_pin(self.uuid, '1122')
+        assert not slumber.generic.buyer.get_object_or_404.called
+        slumber.generic.buyer.assert_called_with(id='5678')
+        buyer.patch.assert_called_with({'new_pin': '1122'},
+                                       headers={'If-Match': ''})
+
+    def test_update_buyer_with_stale_pk(self, slumber):
+        buyer = self.setup_buyer(slumber)
+        buyer.patch.side_effect = [
+            HttpClientError(response=self.create_error_response(
+                status_code=404)),
+            {}]
+        new_buyer = dict(self.buyer_data, resource_pk='91011')
+        slumber.generic.buyer.get_object_or_404.return_value = new_buyer
+
+        eq_(client.change_pin(self.uuid, '1234', buyer=self.buyer_data), {})
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 1)
+        slumber.generic.buyer.assert_called_with(id='91011')
+        eq_(buyer.patch.call_count, 2)
+
     def test_change_pin_clear_was_locked(self, slumber):
         buyer = self.setup_buyer(slumber)
         client.change_pin(self.uuid, '1234', clear_was_locked=True)
@@ -352,6 +431,38 @@ class TestBango(TestCase):
         with self.assertRaises(SellerNotConfigured):
             self.start()
 
+    def test_no_buyer(self):
+        slumber = self.slumber
+        slumber.generic.buyer.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        with self.assertRaises(BuyerNotConfigured):
+            self.start()
+
+    def test_no_buyer_or_seller(self):
+        # The buyer error wins, as if the lookups were made in order.
+        slumber = self.slumber
+        slumber.generic.buyer.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        slumber.generic.seller.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        with self.assertRaises(BuyerNotConfigured):
+            self.start()
+
+    def test_no_seller_sequential_lookups(self):
+        slumber = self.slumber
+        slumber.generic.seller.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        with self.settings(SOLITUDE_CONCURRENT_LOOKUPS=False):
+            with self.assertRaises(SellerNotConfigured):
+                self.start()
+
+    def test_seller_lookup_error(self):
+        slumber = self.slumber
+        slumber.generic.seller.get_object_or_404.side_effect = (
+            HttpClientError)
+        with self.assertRaises(HttpClientError):
+            self.start()
+
     def test_no_bango_product(self):
         slumber = self.slumber
         slumber.generic.seller.get_object_or_404.return_value = self.seller
@@ -359,7 +470,7 @@ class TestBango(TestCase):
             'billingConfigurationId': 'bill_id'}
         slumber.bango.product.get_object_or_404.side_effect = (
             ObjectDoesNotExist)
-        trans_id, pay_url, seller_uuid = self.start()
+        trans_id, pay_url, seller_uuid, trans = self.start()
         eq_(trans_id, 'bill_id')
 
     def test_with_bango_product(self):
@@ -369,7 +480,7 @@ class TestBango(TestCase):
             'billingConfigurationId': 'bill_id'}
         slumber.bango.product.get_object.return_value = {
             'resource_uri': 'foo'}
-        trans_id, pay_url, seller_uuid = self.start()
+        trans_id, pay_url, seller_uuid, trans = self.start()
         eq_(trans_id, 'bill_id')
 
     def test_pay_url(self):
@@ -382,7 +493,7 @@ class TestBango(TestCase):
         with self.settings(
             PAY_URLS={'bango': {'base': 'http://bango',
                                 'pay': '/pay?bcid={uid_pay}'}}):
-            trans_id, pay_url, seller_uuid = self.start()
+            trans_id, pay_url, seller_uuid, trans = self.start()
 
         eq_(pay_url, 'http://bango/pay?bcid={b}'.format(b=bill_id))
 
@@ -417,8 +528,9 @@ class TestBango(TestCase):
             'seller': '/generic/seller/1/',
         }
 
-        self.start()
+        trans = self.start()[3]
         slumber.generic.transaction.post.assert_called_with(data)
+        eq_(trans, slumber.generic.transaction.post.return_value)
 
 
 class ProviderTestCase(TestCase):
@@ -494,7 +606,7 @@ class TestReferenceProvider(ProviderTestCase):
             'resource_uri': self.buyer_uri,
         }
 
-        trans_id, pay_url, seller_id = self.configure(
+        trans_id, pay_url, seller_id, trans = self.configure(
             seller_uuid=self.seller_uuid, product_uuid=self.product_uuid)
 
         eq_(trans_id, 'zippy-trans-token')
@@ -653,7 +765,7 @@ class TestBoku(ProviderTestCase):
             'transaction_id': boku_transaction_id,
         }
 
-        trans_id, pay_url, seller_uuid = self.configure(
+        trans_id, pay_url, seller_uuid, trans = self.configure(
             seller_uuid=self.seller_uuid, user_uuid=user_uuid,
             provider_seller_uuid=provider_seller_uuid)
 
@@ -697,7 +809,7 @@ class TestBoku(ProviderTestCase):
             'transaction_id': 'boku-trans-id',
         }
 
-        trans_id, pay_url, seller_uuid = self.configure(
+        trans_id, pay_url, seller_uuid, trans = self.configure(
             seller_uuid=seller_uuid, product_uuid=external_id)
 
         # Make sure the new in-app product was created.
@@ -728,6 +840,156 @@ class TestBoku(ProviderTestCase):
         eq_(self.provider.provider.transaction_from_notice({}), None)
 
 
+class TestBatch(TestCase):
+
+    def setUp(self):
+        self.fake = FakeSolitude()
+        self.buyer = self.fake.add('generic/buyer', uuid='buyer:uuid')
+        self.seller = self.fake.add('generic/seller', uuid='seller:uuid')
+        self.product = self.fake.add('generic/product', external_id='ext:id',
+                                     seller=self.seller['resource_pk'])
+        self.bango_product = self.fake.add(
+            'bango/product', seller_product__external_id='ext:id',
+            seller_product__seller=self.seller['resource_pk'])
+        self.provider = ProviderHelper('bango', slumber=client.slumber)
+
+    def lookups(self):
+        batch = client.batch()
+        batch.get_object_or_404(client.slumber.generic.buyer,
+                                uuid='buyer:uuid')
+        batch.get_object_or_404(client.slumber.generic.seller,
+                                uuid='nope')
+        with self.fake.installed(client):
+            return batch.run()
+
+    def test_concurrent(self):
+        (buyer, no_error), (seller, exc_info) = self.lookups()
+        eq_(buyer, self.buyer)
+        eq_(no_error, None)
+        eq_(exc_info[0], ObjectDoesNotExist)
+        eq_(len(self.fake.requests), 2)
+
+    def test_composite(self):
+        with self.settings(SOLITUDE_BATCH_ENDPOINT='generic/batch'):
+            (buyer, no_error), (seller, exc_info) = self.lookups()
+        eq_(buyer, self.buyer)
+        eq_(exc_info[0], ObjectDoesNotExist)
+        eq_(self.fake.requests, [('POST', 'generic/batch', {})])
+
+    def test_composite_multiple(self):
+        self.fake.add('generic/seller', uuid='nope')
+        self.fake.add('generic/seller', uuid='nope')
+        with self.settings(SOLITUDE_BATCH_ENDPOINT='generic/batch'):
+            (buyer, no_error), (seller, exc_info) = self.lookups()
+        eq_(exc_info[0], MultipleObjectsReturned)
+
+    def test_composite_with_other_calls(self):
+        batch = client.batch()
+        batch.add(lambda: 'other')
+        batch.get_object_or_404(client.slumber.generic.buyer,
+                                uuid='buyer:uuid')
+        with self.settings(SOLITUDE_BATCH_ENDPOINT='generic/batch'):
+            with self.fake.installed(client):
+                eq_(batch.run(), [('other', None), (self.buyer, None)])
+
+    def test_composite_client_error(self):
+        batch = client.batch()
+        resource = client.slumber.generic.buyer
+        with self.assertRaises(HttpClientError) as cm:
+            batch.result(resource, {'status': 400,
+                                    'body': {'uuid': ['INVALID']}})
+        eq_(cm.exception.response.status_code, 400)
+        eq_(client.parse_res(cm.exception.response.content),
+            {'uuid': ['INVALID']})
+
+    def test_buyer_and_products(self):
+        with self.settings(SOLITUDE_BATCH_ENDPOINT='generic/batch'):
+            with self.fake.installed(client):
+                buyer, products = self.provider.get_buyer_and_products(
+                    'buyer:uuid', self.seller, 'ext:id')
+        eq_(buyer, self.buyer)
+        eq_(products, (self.product, self.bango_product, True))
+        # One batch for the generic lookups, one for the Bango product.
+        eq_(len(self.fake.requests), 2)
+
+    def test_no_provider_product(self):
+        self.fake.resources['bango/product'] = []
+        with self.fake.installed(client):
+            eq_(self.provider.get_products(self.seller, 'ext:id'),
+                (self.product, None, False))
+
+    def test_no_product(self):
+        with self.fake.installed(client):
+            eq_(self.provider.get_products(self.seller, 'other:id'),
+                (None, None, False))
+
+    def test_no_buyer(self):
+        with self.fake.installed(client):
+            with self.assertRaises(BuyerNotConfigured):
+                self.provider.get_buyer_and_products('nope', self.seller,
+                                                     'ext:id')
+
+    def test_buyer_and_seller(self):
+        with self.fake.installed(client):
+            eq_(self.provider.get_buyer_and_seller('buyer:uuid',
+                                                   'seller:uuid'),
+                (self.buyer, self.seller))
+
+
+@override_settings(PRODUCT_CACHE_TIMEOUT=60)
+class TestProductCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.fake = FakeSolitude()
+        self.seller = self.fake.add('generic/seller', uuid='seller:uuid')
+        self.product = self.fake.add('generic/product', external_id='ext:id',
+                                     seller=self.seller['resource_pk'])
+        self.fake.add('bango/product', seller_product__external_id='ext:id',
+                      seller_product__seller=self.seller['resource_pk'])
+        self.provider = ProviderHelper('bango', slumber=client.slumber)
+
+    def get_products(self, external_id='ext:id'):
+        with self.fake.installed(client):
+            return self.provider.get_products(self.seller, external_id)
+
+    def test_cached(self):
+        products = self.get_products()
+        eq_(products[2], True)
+        eq_(len(self.fake.requests), 2)
+        eq_(self.get_products(), products)
+        eq_(len(self.fake.requests), 2)
+
+    def test_not_found_not_cached(self):
+        self.get_products('other:id')
+        self.get_products('other:id')
+        eq_(len(self.fake.requests), 4)
+
+    def test_by_provider(self):
+        self.get_products()
+        other = ProviderHelper('boku', slumber=client.slumber)
+        with self.fake.installed(client):
+            other.get_products(self.seller, 'ext:id')
+        eq_(len(self.fake.requests), 3)
+
+    def test_disabled(self):
+        with self.settings(PRODUCT_CACHE_TIMEOUT=0):
+            self.get_products()
+            self.get_products()
+        eq_(len(self.fake.requests), 4)
+
+    def test_created_invalidates(self):
+        self.get_products()
+        with mock.patch.object(self.provider.provider, 'get_seller'), \
+                mock.patch.object(self.provider.provider, 'create_product'):
+            self.provider.create_product(
+                external_id='ext:id', product_name='Sword',
+                generic_seller=self.seller, provider_seller_uuid='xyz',
+                generic_product=self.product)
+        self.get_products()
+        eq_(len(self.fake.requests), 4)
+
+
 @mock.patch('lib.solitude.api.client.slumber')
 class TransactionTest(TestCase):
 
@@ -773,3 +1035,66 @@ class TestProviderHelper(TestCase):
         providers = ProviderHelper.supported_providers(mcc=mcc, mnc=mnc)
         provider_names = [provider.name for provider in providers]
         eq_(provider_names, [settings.PAYMENT_PROVIDER])
+
+    def test_shared_helpers(self):
+        eq_(ProviderHelper.get('bango'), ProviderHelper.get('bango'))
+        eq_(ProviderHelper.supported_providers()[0],
+            ProviderHelper.get('bango'))
+
+    def test_helper_follows_client(self):
+        with mock.patch.object(client, 'slumber') as slumber:
+            eq_(ProviderHelper.get('bango').slumber, slumber)
+        eq_(ProviderHelper.get('bango').slumber, client.slumber)
+
+    def test_routes_follow_settings(self):
+        eq_(provider_routes.get('334', '020'), ('boku', 'bango'))
+        with self.settings(PAYMENT_PROVIDER='reference'):
+            eq_(provider_routes.get('334', '020'), ('boku', 'reference'))
+            eq_(provider_routes.get(), ('reference',))
+
+    def test_routes_follow_networks(self):
+        provider_routes.get()
+        with mock.patch.dict(BokuProvider.network_data,
+                             {('214', '01'): {'currency': 'EUR'}}):
+            eq_(provider_routes.get('214', '01'), ('boku', 'bango'))
+        eq_(provider_routes.get('214', '01'), ('bango',))
+
+    @raises(ValueError)
+    def test_boku_not_default(self):
+        with self.settings(PAYMENT_PROVIDER='boku'):
+            ProviderHelper.supported_providers()
+
+
+class TestFakeSolitude(TestCase):
+
+    def setUp(self):
+        self.fake = FakeSolitude()
+        self.seller = self.fake.add('generic/seller', uuid='seller:uuid')
+        for external_id in ('a', 'b', 'c'):
+            self.fake.add('generic/product', external_id=external_id,
+                          seller=self.seller['resource_uri'])
+
+    def get(self, **params):
+        with self.fake.installed(client):
+            return client.slumber.generic.product.get(**params)
+
+    def test_filter_by_related_pk(self):
+        eq_(self.get(seller=self.seller['resource_pk'])['meta']
+            ['total_count'], 3)
+
+    def test_paging(self):
+        res = self.get(offset=1, limit=1)
+        eq_([obj['external_id'] for obj in res['objects']], ['b'])
+        assert res['meta']['next']
+        assert not self.get(offset=2, limit=1)['meta']['next']
+
+    @mock.patch('lib.solitude.fake.time.sleep')
+    def test_latency(self, sleep):
+        self.fake.latency = 0.1
+        self.get()
+        sleep.assert_called_with(0.1)
+
+    @raises(HttpServerError)
+    def test_errors(self):
+        self.fake.error_rate = 1
+        self.get()
@@ -0,0 +1,250 @@
+import threading
+from time import sleep as real_sleep
+
+from django.test import TestCase
+
+import mock
+from nose.tools import eq_, raises
+
+from requests.exceptions import ConnectionError
+
+from lib.utils import (call_concurrently, call_tracer, endpoint_name,
+                       host_prefix, pool_config, PooledSession, retry_config,
+                       RetryPolicy)
+from webpay.base.logger import get_transaction_id, set_transaction_id
+
+
+class TestPooledSession(TestCase):
+
+    def setUp(self):
+        self.session = PooledSession()
+        self.session.add_pool('solitude', 'http://Solitude:2602/api/',
+                              pool_maxsize=5, timeout=3)
+
+    def test_host_prefix(self):
+        eq_(host_prefix('https://Mkt.Org/api/v1/?foo=bar'), 'https://mkt.org/')
+
+    def test_pool_mounted(self):
+        adapter = self.session.get_adapter('http://solitude:2602/generic/')
+        eq_(adapter._pool_maxsize, 5)
+        assert adapter is not self.session.get_adapter('http://other/')
+
+    @mock.patch('requests.Session.request')
+    def test_default_timeout(self, request):
+        self.session.request('GET', 'http://solitude:2602/generic/buyer/')
+        eq_(request.call_args[1]['timeout'], 3)
+
+    @mock.patch('requests.Session.request')
+    def test_explicit_timeout(self, request):
+        self.session.request('GET', 'http://solitude:2602/generic/buyer/',
+                             timeout=1)
+        eq_(request.call_args[1]['timeout'], 1)
+
+    @mock.patch('requests.Session.request')
+    def test_unknown_host(self, request):
+        self.session.request('GET', 'http://other/')
+        eq_(request.call_args[1].get('timeout'), None)
+
+    def test_pool_stats(self):
+        adapter = self.session.get_adapter('http://solitude:2602/')
+        pool = adapter.poolmanager.connection_from_url('http://solitude:2602/')
+        pool.num_requests = 4
+        eq_(self.session.pool_stats()['solitude']['requests'], 4)
+
+    @mock.patch('lib.utils.statsd')
+    def test_send_pool_stats(self, statsd):
+        self.session.stats_interval = 60
+        self.session.response_hook(mock.Mock())
+        statsd.gauge.assert_any_call('slumber.solitude.pool.requests', 0)
+        # Stats are not sent again until the interval has passed.
+        statsd.reset_mock()
+        self.session.response_hook(mock.Mock())
+        assert not statsd.gauge.called
+
+    @mock.patch('lib.utils.statsd')
+    def test_trace_hook(self, statsd):
+        response = mock.Mock(content='{"pk": 1}')
+        response.request.url = 'http://solitude:2602/generic/buyer/1/'
+        response.elapsed.total_seconds.return_value = 0.02
+        call_tracer.start()
+        try:
+            self.session.trace_hook(response)
+        finally:
+            trace = call_tracer.stop()
+        statsd.timing.assert_any_call('slumber.solitude.generic.buyer', 20)
+        statsd.timing.assert_any_call('slumber.solitude.generic.buyer.bytes',
+                                      9)
+        eq_(trace.endpoints.items(),
+            [(('solitude', 'generic.buyer'), [1, 20, 9])])
+
+    def test_pool_config(self):
+        pools = {'default': {'timeout': 30, 'pool_maxsize': 10},
+                 'solitude': {'timeout': 5}}
+        with self.settings(SLUMBER_POOLS=pools):
+            eq_(pool_config('solitude'), {'timeout': 5, 'pool_maxsize': 10})
+            eq_(pool_config('marketplace'),
+                {'timeout': 30, 'pool_maxsize': 10})
+
+
+class TestCallConcurrently(TestCase):
+
+    def test_results_in_order(self):
+        eq_(call_concurrently(lambda: 1, lambda: 2), [(1, None), (2, None)])
+
+    def test_errors(self):
+        def fail():
+            raise ValueError('nope')
+
+        (res, exc_info), (ok, no_error) = call_concurrently(fail, lambda: 2)
+        eq_(res, None)
+        eq_(exc_info[0], ValueError)
+        eq_((ok, no_error), (2, None))
+
+    def test_threads(self):
+        threads = call_concurrently(threading.current_thread,
+                                    threading.current_thread)
+        assert threads[0][0] is not threads[1][0]
+
+    def test_sequential(self):
+        threads = call_concurrently(threading.current_thread,
+                                    threading.current_thread,
+                                    concurrent=False)
+        assert threads[0][0] is threads[1][0]
+
+    def test_transaction_id(self):
+        set_transaction_id('webpay:xyz')
+        try:
+            eq_(call_concurrently(get_transaction_id, get_transaction_id),
+                [('webpay:xyz', None), ('webpay:xyz', None)])
+        finally:
+            set_transaction_id(None)
+
+
+class TestCallTracer(TestCase):
+
+    def tearDown(self):
+        call_tracer.stop()
+
+    def test_endpoint_name(self):
+        eq_(endpoint_name('http://solitude/generic/buyer/12/'),
+            'generic.buyer')
+        eq_(endpoint_name('http://mkt/api/v1/webpay/prices/?provider=boku'),
+            'webpay.prices')
+        eq_(endpoint_name('http://solitude/'), 'root')
+
+    def test_not_started(self):
+        call_tracer.record('solitude', 'generic.buyer', 10, 100)
+        eq_(call_tracer.trace, None)
+
+    def test_record(self):
+        trace = call_tracer.start()
+        call_tracer.record('solitude', 'generic.buyer', 10, 100)
+        call_tracer.record('solitude', 'generic.buyer', 5, 50)
+        call_tracer.record('solitude', 'generic.seller', 1, 10)
+        eq_(trace.calls, 3)
+        eq_(trace.server_timing(),
+            'solitude.generic.buyer;dur=15.0;desc="2 calls, 150 bytes", '
+            'solitude.generic.seller;dur=1.0;desc="1 calls, 10 bytes"')
+
+    def test_threads(self):
+        trace = call_tracer.start()
+        call_concurrently(
+            lambda: call_tracer.record('solitude', 'generic.buyer', 1, 1),
+            lambda: call_tracer.record('solitude', 'generic.seller', 1, 1))
+        eq_(trace.calls, 2)
+
+
+@mock.patch('lib.utils.time.sleep')
+class TestRetryPolicy(TestCase):
+
+    def flaky(self, failures, result='ok'):
+        calls = []
+
+        def func():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise ConnectionError
+            return result
+
+        func.calls = calls
+        return func
+
+    def test_success(self, sleep):
+        eq_(RetryPolicy('test', attempts=3)(self.flaky(2)), 'ok')
+        eq_(sleep.call_count, 2)
+
+    def test_gives_up(self, sleep):
+        func = self.flaky(5)
+        with self.assertRaises(ConnectionError):
+            RetryPolicy('test', attempts=3)(func)
+        eq_(len(func.calls), 3)
+
+    @raises(ValueError)
+    def test_no_attempts(self, sleep):
+        RetryPolicy('test', attempts=0)
+
+    def test_other_errors(self, sleep):
+        def func():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            RetryPolicy('test', attempts=3)(func)
+        assert not sleep.called
+
+    def test_backoff(self, sleep):
+        policy = RetryPolicy('test', backoff=1, max_backoff=3)
+        with mock.patch('lib.utils.random.uniform') as uniform:
+            for attempt in range(1, 5):
+                policy.delay(attempt)
+        eq_([c[0] for c in uniform.call_args_list],
+            [(0, 1), (0, 2), (0, 3), (0, 3)])
+
+    @mock.patch('lib.utils.time.time')
+    def test_deadline(self, now, sleep):
+        now.return_value = 1000
+        func = self.flaky(5)
+        policy = RetryPolicy('test', attempts=5, backoff=1, deadline=0.5)
+        with mock.patch.object(policy, 'delay', return_value=1):
+            with self.assertRaises(ConnectionError):
+                policy(func)
+        eq_(len(func.calls), 1)
+
+    def test_hedge(self, sleep):
+        calls = []
+
+        def slow_first():
+            calls.append(1)
+            if len(calls) == 1:
+                real_sleep(0.5)
+                return 'slow'
+            return 'fast'
+
+        eq_(RetryPolicy('test', hedge_after=0.01)(slow_first), 'fast')
+        eq_(len(calls), 2)
+
+    def test_hedge_failure(self, sleep):
+        calls = []
+
+        def fail_fast():
+            calls.append(1)
+            if len(calls) == 1:
+                real_sleep(0.05)
+                return 'slow'
+            raise ConnectionError
+
+        eq_(RetryPolicy('test', hedge_after=0.01)(fail_fast), 'slow')
+
+    def test_no_hedge(self, sleep):
+        calls = []
+        eq_(RetryPolicy('test', hedge_after=1)(lambda: calls.append(1)),
+            None)
+        eq_(len(calls), 1)
+
+    def test_config(self, sleep):
+        retry = {'default': {'attempts': 1, 'deadline': 10},
+                 'marketplace.prices': {'attempts': 3}}
+        with self.settings(SLUMBER_RETRY=retry):
+            eq_(retry_config('marketplace.prices', attempts=5, deadline=1),
+                {'attempts': 3, 'deadline': 1})
+            eq_(retry_config('solitude.buyer'),
+                {'attempts': 1, 'deadline': 10})
@@ -1,10 +1,25 @@
+import collections
 import json
+import Queue
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
 
+from django.conf import settings
+
+import requests
 from curling.lib import API
+from django_statsd.clients import statsd
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
 from slumber.exceptions import HttpClientError
 
 from solitude.exceptions import ResourceModified, ResourceNotModified
-from webpay.base.logger import getLogger, get_transaction_id
+from webpay.base.logger import (getLogger, get_transaction_id,
+                                set_transaction_id)
 
 log = getLogger('lib.utils')
 
@@ -13,17 +28,380 @@ def add_transaction_id(slumber, headers=None, **kwargs):
     headers['Transaction-Id'] = get_transaction_id()
 
 
+def endpoint_name(url):
+    """
+    Return a statsd friendly name for the endpoint of a URL, dropping the
+    API version and object IDs, for example 'generic.buyer' for
+    http://solitude/generic/buyer/12/.
+    """
+    parts = [part for part in urlparse.urlparse(url).path.split('/')
+             if part and part != 'api' and not re.match(r'^v\d+$', part)]
+    return '.'.join(part for part in parts
+                    if re.match(r'^[a-z_-]+$', part)) or 'root'
+
+
+class CallTrace(object):
+    """
+    The Slumber calls made while handling one request.
+
+    Calls may be recorded from several threads, see call_concurrently().
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # Maps (api, endpoint) to [calls, milliseconds, bytes].
+        self.endpoints = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, api, endpoint, ms, size):
+        with self._lock:
+            totals = self.endpoints.setdefault((api, endpoint), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += ms
+            totals[2] += size
+
+    @property
+    def calls(self):
+        return sum(totals[0] for totals in self.endpoints.values())
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header for the calls."""
+        return ', '.join(
+            '{0}.{1};dur={2:.1f};desc="{3} calls, {4} bytes"'
+            .format(api, endpoint, ms, calls, size)
+            for (api, endpoint), (calls, ms, size)
+            in self.endpoints.items())
+
+
+class CallTracer(threading.local):
+    """
+    Records the Slumber calls of the current request in a CallTrace.
+
+    It is started and stopped by CallBudgetMiddleware. Outside of a
+    request (for example in a Celery task) calls are not recorded.
+    """
+
+    def __init__(self):
+        self.trace = None
+
+    def start(self):
+        self.trace = CallTrace()
+        return self.trace
+
+    def stop(self):
+        trace, self.trace = self.trace, None
+        return trace
+
+    def adopt(self, trace):
+        """Record the calls of this thread in the trace of another one."""
+        self.trace = trace
+
+    def record(self, api, endpoint, ms, size):
+        if self.trace is not None:
+            self.trace.add(api, endpoint, ms, size)
+
+
+call_tracer = CallTracer()
+
+
+def host_prefix(url):
+    """
+    Return the scheme://host:port/ prefix that a connection pool is
+    mounted on for this URL.
+    """
+    parsed = urlparse.urlparse(url)
+    return u'{0}://{1}/'.format(parsed.scheme, parsed.netloc).lower()
+
+
+def pool_config(name):
+    """
+    Return the connection pool settings for the named API, falling back to
+    the defaults in settings.SLUMBER_POOLS.
+    """
+    config = dict(settings.SLUMBER_POOLS.get('default', {}))
+    config.update(settings.SLUMBER_POOLS.get(name, {}))
+    return config
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session that keeps one keep-alive connection pool per API
+    host and applies that API's timeout to every request.
+
+    A single session is shared by all Slumber clients so that Solitude and
+    Marketplace connections are reused across calls instead of paying for
+    TCP/TLS setup on every request.
+    """
+
+    def __init__(self):
+        super(PooledSession, self).__init__()
+        # Maps a host prefix to a (name, timeout) tuple.
+        self.pools = {}
+        self.stats_interval = 0
+        self.stats_sent = 0
+        self.hooks['response'].append(self.response_hook)
+        self.hooks['response'].append(self.trace_hook)
+
+    def add_pool(self, name, url, pool_connections=10, pool_maxsize=10,
+                 max_retries=0, timeout=None, stats_interval=0):
+        """
+        Mount a connection pool for the host of `url`.
+
+        :param name: name of the API, used in statsd keys.
+        :param pool_connections: number of host pools to keep.
+        :param pool_maxsize: maximum number of keep-alive connections.
+        :param max_retries: retries on failed connections (not requests).
+        :param timeout: default timeout in seconds for each request.
+        :param stats_interval: seconds between sending pool stats to
+                               statsd, zero to disable.
+        """
+        prefix = host_prefix(url)
+        self.mount(prefix, HTTPAdapter(pool_connections=pool_connections,
+                                       pool_maxsize=pool_maxsize,
+                                       max_retries=max_retries))
+        self.pools[prefix] = (name, timeout)
+        if stats_interval:
+            self.stats_interval = (min(self.stats_interval, stats_interval)
+                                   if self.stats_interval else stats_interval)
+        log.info('Connection pool for {name} at {prefix}: '
+                 'maxsize={size} timeout={timeout}'
+                 .format(name=name, prefix=prefix, size=pool_maxsize,
+                         timeout=timeout))
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            pool = self.pools.get(host_prefix(url))
+            if pool:
+                kwargs['timeout'] = pool[1]
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+    def pool_stats(self):
+        """
+        Returns a dict of API name to a dict of connection pool counters:
+
+        * connections: connections opened since the pool was created.
+        * requests: requests made over those connections.
+        * idle: keep-alive connections waiting to be reused.
+        """
+        stats = {}
+        for prefix, (name, timeout) in self.pools.items():
+            counts = stats.setdefault(
+                name, {'connections': 0, 'requests': 0, 'idle': 0})
+            manager = self.adapters[prefix].poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    # The pool was evicted while we were looking.
+                    continue
+                counts['connections'] += pool.num_connections
+                counts['requests'] += pool.num_requests
+                counts['idle'] += pool.pool.qsize() if pool.pool else 0
+        return stats
+
+    def send_pool_stats(self):
+        for name, counts in self.pool_stats().items():
+            for counter, value in counts.items():
+                statsd.gauge('slumber.{0}.pool.{1}'.format(name, counter),
+                             value)
+
+    def response_hook(self, response, **kwargs):
+        now = time.time()
+        if self.stats_interval and (now - self.stats_sent >
+                                    self.stats_interval):
+            self.stats_sent = now
+            self.send_pool_stats()
+        return response
+
+    def trace_hook(self, response, **kwargs):
+        """
+        Send the latency and size of a call to statsd and record it in the
+        trace of the current request.
+        """
+        url = response.request.url
+        pool = self.pools.get(host_prefix(url))
+        api = pool[0] if pool else 'other'
+        endpoint = endpoint_name(url)
+        ms = response.elapsed.total_seconds() * 1000
+        size = len(response.content or '')
+        stat = 'slumber.{0}.{1}'.format(api, endpoint)
+        statsd.timing(stat, ms)
+        statsd.timing(stat + '.bytes', size)
+        call_tracer.record(api, endpoint, ms, size)
+        return response
+
+
+def call_concurrently(*funcs, **kw):
+    """
+    Call each function with no arguments and return a list of
+    (result, exc_info) tuples in the same order as the functions.
+
+    exc_info is None when the call succeeded, otherwise it is the
+    sys.exc_info() of the exception so the caller can decide which error
+    to re-raise.
+
+    Keyword arguments:
+
+    **concurrent**
+        When True (the default) all but the first function are run in
+        their own thread and joined. This works under gevent as well
+        because gevent patches threading.
+    """
+    concurrent = kw.pop('concurrent', True)
+    results = [None] * len(funcs)
+    trans_id = get_transaction_id()
+    trace = call_tracer.trace
+
+    def run(index, func):
+        # Keep the Transaction-Id header, logging context and call trace
+        # in threads.
+        set_transaction_id(trans_id)
+        call_tracer.adopt(trace)
+        try:
+            results[index] = (func(), None)
+        except:
+            results[index] = (None, sys.exc_info())
+
+    if not concurrent:
+        for index, func in enumerate(funcs):
+            run(index, func)
+        return results
+
+    threads = [threading.Thread(target=run, args=(index, func))
+               for index, func in enumerate(funcs) if index > 0]
+    for thread in threads:
+        thread.start()
+    if funcs:
+        run(0, funcs[0])
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def retry_config(name, **defaults):
+    """
+    Return the retry settings for an endpoint. The defaults in
+    settings.SLUMBER_RETRY are overridden by `defaults` which are in turn
+    overridden by the entry for the endpoint.
+    """
+    config = dict(settings.SLUMBER_RETRY.get('default', {}))
+    config.update(defaults)
+    config.update(settings.SLUMBER_RETRY.get(name, {}))
+    return config
+
+
+class RetryPolicy(object):
+    """
+    Calls a function, retrying it on connection errors.
+
+    :param name: name of the endpoint, used in statsd keys.
+    :param attempts: maximum number of attempts, at least 1.
+    :param backoff: seconds to wait after the first failure. This doubles
+                    with every failure up to `max_backoff` and a random
+                    amount up to that (full jitter) is waited for.
+    :param max_backoff: maximum seconds to wait between attempts.
+    :param deadline: no attempt is started after this many seconds.
+    :param hedge_after: when set, a second identical call is started if
+                        the first hasn't returned after this many seconds
+                        (for example the endpoint's p95) and whichever
+                        succeeds first is used. Only use this for reads.
+    """
+    retry_on = (ConnectionError,)
+
+    def __init__(self, name, attempts=1, backoff=0.1, max_backoff=2,
+                 deadline=10, hedge_after=None):
+        if attempts < 1:
+            raise ValueError('{0} must make at least 1 attempt, not {1}'
+                             .format(name, attempts))
+        self.name = name
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+
+    def delay(self, attempt):
+        """Seconds to wait after `attempt` failed."""
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** (attempt - 1)))
+
+    def __call__(self, func):
+        give_up = time.time() + self.deadline
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return self.attempt(func)
+            except self.retry_on:
+                log.error('{0} failed, attempt: {1}'.format(self.name,
+                                                            attempt))
+                statsd.incr('slumber.{0}.retry'.format(self.name))
+                delay = self.delay(attempt)
+                if (attempt == self.attempts or
+                        time.time() + delay > give_up):
+                    raise
+                time.sleep(delay)
+
+    def attempt(self, func):
+        if not self.hedge_after:
+            return func()
+
+        results = Queue.Queue()
+        trans_id = get_transaction_id()
+        trace = call_tracer.trace
+
+        def run():
+            set_transaction_id(trans_id)
+            call_tracer.adopt(trace)
+            try:
+                results.put((func(), None))
+            except:
+                results.put((None, sys.exc_info()))
+
+        def start():
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        try:
+            result, exc_info = results.get(timeout=self.hedge_after)
+        except Queue.Empty:
+            statsd.incr('slumber.{0}.hedge'.format(self.name))
+            start()
+            result, exc_info = results.get()
+            if exc_info:
+                # The first call to finish failed, wait for the other one.
+                result, exc_info = results.get()
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return result
+
+
+# All Slumber clients share this session and its connection pools.
+session = PooledSession()
+
+
 class SlumberWrapper(object):
     """
     A wrapper around the Slumber API.
     """
+    # Name of the settings.SLUMBER_POOLS entry for this API.
+    pool_name = 'default'
 
     def __init__(self, url, oauth):
-        self.slumber = API(url)
+        session.add_pool(self.pool_name, url, **pool_config(self.pool_name))
+        self.slumber = API(url, session=session)
         self.slumber.activate_oauth(oauth.get('key'), oauth.get('secret'))
         self.slumber._add_callback({'method': add_transaction_id})
         self.api = self.slumber.api.v1
 
+    def with_retries(self, endpoint, func, **defaults):
+        """
+        Call func with the retry policy of an endpoint of this API. The
+        policy is configured in settings.SLUMBER_RETRY under
+        '<pool_name>.<endpoint>'.
+        """
+        name = '{0}.{1}'.format(self.pool_name, endpoint)
+        return RetryPolicy(name, **retry_config(name, **defaults))(func)
+
     def parse_res(self, res):
         if res == '':
             return {}
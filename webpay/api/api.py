@@ -5,6 +5,7 @@ from rest_framework import response, viewsets
 from webpay.api.base import BuyerIsLoggedIn
 from webpay.base.logger import getLogger
 from webpay.pay import tasks
+from webpay.pay.notes import get_notes, PayRequestMissing
 
 log = getLogger('w.api')
 
@@ -17,7 +18,13 @@ class SimulateViewSet(viewsets.ViewSet):
             log.info('Request to simulate without a valid session')
             return http.HttpResponseForbidden()
 
-        tasks.simulate_notify.delay(request.session['notes']['issuer_key'],
-                                    request.session['notes']['pay_request'])
+        try:
+            notes = get_notes(request)
+        except PayRequestMissing, exc:
+            return response.Response({
+                'error_code': exc.error_code,
+                'error': 'The pay request is no longer stored.',
+            }, status=400)
+        tasks.simulate_notify.delay(notes['issuer_key'], notes['pay_request'])
 
         return response.Response(status=204)
@@ -92,7 +92,7 @@ def update_session(request, uuid, new_uuid, email, buyer=None):
     # If all buyers have emails set then this can
     # be safely removed
     if not buyer.get('email', None):
-        client.update_buyer(uuid, email=email)
+        client.update_buyer(uuid, email=email, buyer=buyer)
 
     set_user_has_pin(request, buyer.get('pin', False))
     set_user_has_confirmed_pin(request, buyer.get('pin_confirmed', False))
@@ -1,6 +1,5 @@
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseForbidden
-from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 
 from django_paranoia.decorators import require_GET, require_POST
@@ -13,6 +12,7 @@ from webpay.base.helpers import fxa_auth_info
 from webpay.base.logger import getLogger
 from webpay.base.utils import system_error
 from webpay.pay import tasks
+from webpay.spa.shell import render_index
 
 log = getLogger('w.bango')
 RECORDED_OK = 'RECORDED_OK'
@@ -103,7 +103,7 @@ def success(request):
     ctx = {'start_view': 'payment-success',
            'fxa_state': state,
            'fxa_auth_url': fxa_url}
-    return render(request, 'spa/index.html', ctx)
+    return render_index(request, ctx)
 
 
 @require_GET
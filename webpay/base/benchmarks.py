@@ -0,0 +1,285 @@
+"""
+Microbenchmarks of the code that uses the most CPU per request.
+
+Run them with ``manage.py bench``. Each benchmark is registered with
+@benchmark and returns the function to time; anything that shouldn't be
+timed, such as building the payload, happens before it returns. Results
+can be saved as JSON and compared with the results of an earlier release
+to spot regressions.
+"""
+import json
+import math
+import platform
+import subprocess
+import time
+
+from django.conf import settings
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.importlib import import_module
+
+from webpay.base.middleware import LocaleMiddleware
+
+# Maps a benchmark name to a (setup function, settings) tuple.
+registry = {}
+
+
+def benchmark(name, **overrides):
+    """
+    Register a benchmark. The decorated function is called once to set it
+    up and returns the function to time. The benchmark is set up and run
+    with the settings in `overrides`.
+    """
+    def decorator(setup):
+        registry[name] = (setup, overrides)
+        return setup
+    return decorator
+
+
+def sample_session():
+    """A session like the one of a user in the middle of a purchase."""
+    return {
+        'uuid': 'buyer:{0}'.format('x' * 32),
+        'trans_id': 'webpay:{0}'.format('x' * 36),
+        'is_simulation': False,
+        'notes': {
+            'issuer_key': 'marketplace.firefox.com',
+            'network': {'mcc': '334', 'mnc': '020'},
+            'pay_request': sample_pay_request(iss='marketplace.firefox.com',
+                                              aud='marketplace.firefox.com'),
+        },
+    }
+
+
+def sample_pay_request(**kw):
+    """A pay request like the ones the Marketplace sends."""
+    # Imported here because it pulls in the test helpers.
+    from webpay.pay.samples import JWTtester
+
+    kw.setdefault('typ', 'mozilla/payments/pay/v1')
+    return JWTtester('payload').payload(
+        include_response=False,
+        extra_req={
+            'description': 'A fancy sword. ' * 15,
+            'icons': dict((size, 'https://app/{0}.png'.format(size))
+                          for size in ('32', '48', '64', '128')),
+            'productData': 'public_id={0}&application_size=1024'
+                           .format('x' * 36),
+            'locales': {
+                'de': {'name': 'Schwert', 'description': 'Ein Schwert.'},
+                'fr': {'name': 'Epee', 'description': 'Une epee.'},
+            },
+        }, **kw)
+
+
+# Accept-Language headers as browsers and Firefox OS send them.
+ACCEPT_LANGUAGES = (
+    'en-US,en;q=0.5',
+    'de-DE,de;q=0.8,en-US;q=0.5,en;q=0.3',
+    'es-MX,es;q=0.8,en;q=0.5',
+    'pt-BR,pt;q=0.8,en-US;q=0.6,en;q=0.4',
+    'fr',
+    'pl,en-US;q=0.7,en;q=0.3',
+    'zh-TW,zh;q=0.8,en-US;q=0.5,en;q=0.3',
+    'xx-YY',
+)
+
+
+@benchmark('jwt.verify')
+def verify_pay_request():
+    """Decode the pay request in the form and verify it."""
+    from webpay.pay.forms import VerifyForm
+    from webpay.pay.samples import JWTtester
+    from webpay.pay.verify import verify_jwt
+
+    data = {'req': JWTtester('request').request(
+        app_secret=settings.SECRET,
+        payload=sample_pay_request(iss=settings.KEY, aud=settings.DOMAIN))}
+
+    def run():
+        form = VerifyForm(data)
+        assert form.is_valid(), form.errors
+        verify_jwt(form.jwt, settings.DOMAIN, form.secret,
+                   algorithms=settings.SUPPORTED_JWT_ALGORITHMS)
+    return run
+
+
+def session_store():
+    request = RequestFactory().get('/', HTTP_USER_AGENT='Mozilla/5.0')
+    store = import_module('encrypted_cookies').SessionStore
+
+    def new(session_key=None):
+        return store(session_key=session_key, request_meta=request.META)
+    return new
+
+
+@benchmark('session.cookie.load')
+def load_session():
+    """Decrypt the session cookie of a purchase."""
+    new = session_store()
+    session = new()
+    session.update(sample_session())
+    session.save()
+    key = session.session_key
+
+    def run():
+        new(key).load()
+    return run
+
+
+@benchmark('session.cookie.save')
+def save_session():
+    """Encrypt the session of a purchase into its cookie."""
+    new = session_store()
+    session = new()
+    session.update(sample_session())
+
+    def run():
+        session.modified = True
+        session.save()
+    return run
+
+
+@benchmark('notice.sign', CACHE_SIGNED_NOTICES=False)
+def sign_notice():
+    """Sign the notice posted to the app after a payment."""
+    from lib.solitude.constants import TYPE_PAYMENT
+    from webpay.constants import TYP_POSTBACK
+    from webpay.pay.tasks import _sign_notice
+
+    trans = {
+        'uuid': 'webpay:{0}'.format('x' * 36),
+        'type': TYPE_PAYMENT,
+        'amount': '0.99',
+        'currency': 'USD',
+        'notes': {'issuer_key': settings.KEY,
+                  'pay_request': sample_pay_request(iss=settings.KEY)},
+    }
+
+    def run():
+        _sign_notice(trans, TYP_POSTBACK, 'https://app/postback')
+    return run
+
+
+@benchmark('locale.best_language')
+def best_language():
+    """Pick the locale of each of a few typical Accept-Language headers."""
+    middleware = LocaleMiddleware()
+
+    def run():
+        for header in ACCEPT_LANGUAGES:
+            middleware.get_best_language(header)
+    return run
+
+
+@benchmark('spa.index.render', SPA_INDEX_PRERENDER=False)
+def render_spa_index():
+    """Render spa/index.html with Jinja."""
+    return spa_index()
+
+
+@benchmark('spa.index.shell', SPA_INDEX_PRERENDER=True)
+def fill_spa_index():
+    """Fill in spa/index.html pre-rendered for the locale and build."""
+    return spa_index()
+
+
+def spa_index():
+    from webpay.spa.shell import render_index
+
+    request = RequestFactory().get('/mozpay/')
+    request.session = {'logged_in_user': 'buyer@example.com'}
+    request.csrf_token = 'x' * 32
+    ctx = {'start_view': 'payment-success',
+           'fxa_state': 'x' * 32,
+           'fxa_auth_url': 'https://accounts/v1/authorization?state=x'}
+
+    def run():
+        render_index(request, ctx)
+    return run
+
+
+def revision():
+    """Return the git revision being benchmarked, if there is one."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.ROOT,
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmark(name, iterations=1000, rounds=5):
+    """
+    Time a benchmark, returning a dict of the microseconds each call took:
+    the min, median and mean over the rounds, and their standard
+    deviation.
+    """
+    setup, overrides = registry[name]
+    with override_settings(**overrides):
+        func = setup()
+        # Warm up caches and lazy imports.
+        func()
+        times = []
+        for i in range(rounds):
+            start = time.time()
+            for j in xrange(iterations):
+                func()
+            times.append((time.time() - start) * 1e6 / iterations)
+    mean = sum(times) / len(times)
+    return {
+        'iterations': iterations,
+        'rounds': rounds,
+        'min': min(times),
+        'median': median(times),
+        'mean': mean,
+        'stdev': math.sqrt(sum((t - mean) ** 2 for t in times) / len(times)),
+    }
+
+
+def run(names=None, iterations=1000, rounds=5):
+    """
+    Run the benchmarks in `names`, all of them by default, and return the
+    results in the format saved by ``manage.py bench --output``.
+    """
+    return {
+        'created': int(time.time()),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'results': dict((name, run_benchmark(name, iterations, rounds))
+                        for name in sorted(names or registry)),
+    }
+
+
+def compare(previous, current):
+    """
+    Compare the results of two runs, returning a list of (name, previous
+    median, current median, change in percent) for the benchmarks in both.
+    """
+    changes = []
+    for name in sorted(current['results']):
+        if name not in previous['results']:
+            continue
+        before = previous['results'][name]['median']
+        after = current['results'][name]['median']
+        changes.append((name, before, after,
+                        (after - before) * 100.0 / before if before else 0))
+    return changes
+
+
+def load(path):
+    with open(path) as results:
+        return json.load(results)
+
+
+def save(results, path):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
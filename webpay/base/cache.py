@@ -0,0 +1,184 @@
+import collections
+import functools
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+from django_statsd.clients import statsd
+
+log = logging.getLogger('w.cache')
+
+_missing = object()
+
+
+class LocalCache(object):
+    """
+    A bounded, thread safe, in-process LRU cache.
+
+    Entries expire after `timeout` seconds and the least recently used
+    entry is evicted when there are more than `size` entries. This is
+    meant to sit in front of the shared Django cache for small, hot data
+    so that repeated reads don't cost a network hop.
+
+    :param name: used to count hits and misses in statsd.
+    :param size: maximum number of entries.
+    :param timeout: seconds an entry lives for, 0 means forever.
+    """
+
+    def __init__(self, name, size=1000, timeout=60):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            expires, value = self._data.pop(key, (None, _missing))
+            if value is _missing or (expires and expires < time.time()):
+                self.misses += 1
+                hit = False
+            else:
+                # Put it back at the most recently used end.
+                self._data[key] = (expires, value)
+                self.hits += 1
+                hit = True
+        statsd.incr('local_cache.{0}.{1}'
+                    .format(self.name, 'hit' if hit else 'miss'))
+        return value if hit else default
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = time.time() + timeout if timeout else 0
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RequestCache(threading.local):
+    """
+    A memo that only lives for the current request.
+
+    It is started and stopped by RequestCacheMiddleware. Outside of a
+    request (for example in a Celery task) nothing is stored and every
+    lookup is a miss.
+    """
+
+    def __init__(self):
+        self.data = None
+
+    @property
+    def active(self):
+        return self.data is not None
+
+    def start(self):
+        self.data = {}
+
+    def stop(self):
+        self.data = None
+
+    def get(self, key, default=None):
+        if self.data is None:
+            return default
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        if self.data is not None:
+            self.data[key] = value
+
+    def delete(self, key):
+        if self.data is not None:
+            self.data.pop(key, None)
+
+
+request_cache = RequestCache()
+
+
+def stale_while_revalidate(prefix, timeout=60, max_stale=600, lock_timeout=30):
+    """
+    Cache the result of a function in the shared cache, serving stale
+    results while a single background refresh gets a new one.
+
+    For `timeout` seconds a result is fresh and returned as is. For a
+    further `max_stale` seconds it is still returned, but the first caller
+    to see it stale takes a lock in the cache and refreshes it in a
+    background thread; everyone else keeps getting the stale result. After
+    that the result is gone and the function is called inline.
+
+    Statsd counts `<prefix>.hit`, `.miss`, `.stale` and `.refresh_failed`
+    with the colons of the prefix turned into dots.
+
+    :param prefix: used to build the cache key from the arguments.
+    :param lock_timeout: seconds a refresh may take before another caller
+                         may start one.
+    """
+    stat = prefix.replace(':', '.')
+
+    def decorator(func):
+        def store(key, value):
+            cache.set(key, {'value': value,
+                            'fresh_until': time.time() + timeout},
+                      timeout + max_stale)
+
+        def refresh(key, args, kwargs):
+            try:
+                store(key, func(*args, **kwargs))
+            except Exception:
+                log.exception('Refreshing {0} failed'.format(key))
+                statsd.incr('{0}.refresh_failed'.format(stat))
+            finally:
+                cache.delete(key + ':lock')
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Arguments are keyed by their text so that 10 and '10' share
+            # a result, as in the other cache keys.
+            digest = hashlib.md5(repr((
+                [smart_str(arg) for arg in args],
+                sorted((name, smart_str(value))
+                       for name, value in kwargs.items()))))
+            key = '{0}:{1}:swr:{2}'.format(settings.CACHE_PREFIX, prefix,
+                                           digest.hexdigest())
+            cached = cache.get(key)
+            if cached is None:
+                statsd.incr('{0}.miss'.format(stat))
+                value = func(*args, **kwargs)
+                store(key, value)
+                return value
+
+            if cached['fresh_until'] > time.time():
+                statsd.incr('{0}.hit'.format(stat))
+            else:
+                statsd.incr('{0}.stale'.format(stat))
+                if cache.add(key + ':lock', 1, lock_timeout):
+                    thread = threading.Thread(target=refresh,
+                                              args=(key, args, kwargs))
+                    thread.daemon = True
+                    thread.start()
+            return cached['value']
+
+        return wrapper
+    return decorator
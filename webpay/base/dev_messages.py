@@ -1,3 +1,7 @@
+import hashlib
+import json
+from collections import namedtuple
+
 from django.conf import settings
 from django.utils import translation
 
@@ -29,6 +33,7 @@ INVALID_JWT_OBJ = 'INVALID_JWT_OBJ'
 INVALID_PIN_REAUTH = 'INVALID_PIN_REAUTH'
 INVALID_REDIR_URL = 'INVALID_REDIR_URL'
 JWT_DECODE_ERR = 'JWT_DECODE_ERR'
+JWT_TOO_LARGE = 'JWT_TOO_LARGE'
 LOGIN_TIMEOUT = 'LOGIN_TIMEOUT'
 LOGOUT_TIMEOUT = 'LOGOUT_TIMEOUT'
 LOGOUT_URL_MISSING = 'LOGOUT_URL_MISSING'
@@ -45,6 +50,7 @@ NO_VALID_SELLER = 'NO_VALID_SELLER'
 NOTICE_ERROR = 'NOTICE_ERROR'
 NOTICE_EXCEPTION = 'NOTICE_EXCEPTION'
 PAY_DISABLED = 'PAY_DISABLED'
+PAY_REQUEST_MISSING = 'PAY_REQUEST_MISSING'
 PIN_4_NUMBERS_LONG = 'PIN_4_NUMBERS_LONG'
 PIN_ALREADY_CREATED = 'PIN_ALREADY_CREATED'
 PIN_ONLY_NUMBERS = 'PIN_ONLY_NUMBERS'
@@ -120,6 +126,42 @@ def legend(locale=None):
         tower.activate(old_locale)
 
 
+# The legend of a locale as the error legend service sends it: the JSON
+# content and its ETag.
+CompiledLegend = namedtuple('CompiledLegend', 'content etag')
+
+# Maps a locale to its CompiledLegend. Translations only change on deploy,
+# which restarts the process, so these never go stale.
+_compiled = {}
+
+
+def compiled_legend(locale):
+    """
+    Return the CompiledLegend of `locale`, compiling it the first time
+    unless build_legends() already did.
+    """
+    compiled = _compiled.get(locale)
+    if compiled is None:
+        content = json.dumps({'legend': legend(locale=locale),
+                              'errors': None,
+                              'locale': locale}, sort_keys=True)
+        compiled = CompiledLegend(
+            content, '"{0}"'.format(hashlib.md5(content).hexdigest()))
+        # Two threads compiling the same locale make the same legend so
+        # there's no need to lock.
+        _compiled[locale] = compiled
+    return compiled
+
+
+def build_legends(locales=None):
+    """
+    Compile the legend of every locale in `locales`, all of PROD_LANGUAGES
+    by default, so that no request has to.
+    """
+    for locale in locales or settings.PROD_LANGUAGES:
+        compiled_legend(locale)
+
+
 class DevMessage(Exception):
     """
     A catchable developer message exception.
@@ -179,6 +221,9 @@ def _build_legend():
         # L10n: JWT stands for JSON Web Token and does not need to be
         # localized.
         JWT_DECODE_ERR: _('Error decoding JWT.'),
+        # L10n: JWT stands for JSON Web Token and does not need to be
+        # localized.
+        JWT_TOO_LARGE: _('The JWT is too large.'),
         LOGIN_TIMEOUT: _('The system timed out while trying to log in.'),
         LOGOUT_TIMEOUT: _('The system timed out while trying to log out.'),
         LOGOUT_URL_MISSING: _('The logout URL is missing from configuration.'),
@@ -215,6 +260,9 @@ def _build_legend():
                             'unexpected exception while verifying the '
                             'payment notice'),
         PAY_DISABLED: _('Payments are temporarily disabled.'),
+        PAY_REQUEST_MISSING:
+            _('The payment request is no longer available, please start '
+              'the purchase again.'),
         PIN_4_NUMBERS_LONG: _('PIN must be exactly 4 numbers long'),
         PIN_ALREADY_CREATED:
             _('The user cannot create a PIN because they already have a PIN.'),
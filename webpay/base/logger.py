@@ -11,7 +11,19 @@ def get_remote_addr():
 
 
 def get_transaction_id():
-    return getattr(_local, 'TRANSACTION_ID', None)
+    trans_id = getattr(_local, 'TRANSACTION_ID', None)
+    session = getattr(_local, 'SESSION', None)
+    if trans_id is None and session is not None:
+        # Only read the session once something is logged, see
+        # LoggerMiddleware. Anything logged while it loads gets '-'.
+        _local.TRANSACTION_ID = '-'
+        trans_id = _local.TRANSACTION_ID = session.get('trans_id', '-')
+    return trans_id
+
+
+def set_transaction_id(trans_id):
+    _local.TRANSACTION_ID = trans_id
+    _local.SESSION = None
 
 
 def get_client_id():
@@ -60,5 +72,8 @@ class LoggerMiddleware(object):
 
     def process_request(self, request):
         _local.CLIENT_ID = parse(request.META.get('HTTP_USER_AGENT', ''))
-        _local.TRANSACTION_ID = request.session.get('trans_id', '-')
+        # The transaction ID is read from the session when it's first
+        # needed so that requests which don't log don't load the session.
+        _local.TRANSACTION_ID = None
+        _local.SESSION = request.session
         _local.REMOTE_ADDR = request.META.get('REMOTE_ADDR', '')
@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from webpay.base import benchmarks
+
+
+class Command(BaseCommand):
+    args = '[benchmark ...]'
+    help = ('Run the microbenchmarks, all of them unless some are named, and '
+            'optionally save the results or compare them with saved ones.')
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', default=1000,
+                    help='Calls to time in each round. Default: %default'),
+        make_option('--rounds', type='int', default=5,
+                    help='Rounds to run. Default: %default'),
+        make_option('--output', help='Save the results as JSON to this file.'),
+        make_option('--compare',
+                    help='Compare the results with a JSON file saved by '
+                         '--output, for example by an earlier release.'),
+        make_option('--list', action='store_true', default=False,
+                    help='List the benchmarks and exit.'),
+    )
+
+    def handle(self, *names, **options):
+        if options['list']:
+            for name in sorted(benchmarks.registry):
+                setup = benchmarks.registry[name][0]
+                self.stdout.write('{0:<24} {1}'.format(
+                    name, (setup.__doc__ or '').strip()))
+            return
+
+        unknown = set(names) - set(benchmarks.registry)
+        if unknown:
+            raise CommandError('Unknown benchmarks: {0}'
+                               .format(', '.join(sorted(unknown))))
+        previous = (benchmarks.load(options['compare'])
+                    if options['compare'] else None)
+
+        results = benchmarks.run(names, iterations=options['iterations'],
+                                 rounds=options['rounds'])
+        self.stdout.write('{0:<24} {1:>12} {2:>12} {3:>10}'.format(
+            'benchmark', 'median (us)', 'min (us)', 'stdev'))
+        for name, result in sorted(results['results'].items()):
+            self.stdout.write(
+                '{0:<24} {median:>12.2f} {min:>12.2f} {stdev:>10.2f}'
+                .format(name, **result))
+
+        if previous:
+            self.stdout.write('')
+            self.stdout.write('Compared with {0}:'.format(
+                previous.get('revision') or options['compare']))
+            for name, before, after, change in benchmarks.compare(previous,
+                                                                  results):
+                self.stdout.write('{0:<24} {1:>12.2f} -> {2:>10.2f} {3:+7.1f}%'
+                                  .format(name, before, after, change))
+
+        if options['output']:
+            benchmarks.save(results, options['output'])
+            self.stdout.write('Saved results to {0}'.format(options['output']))
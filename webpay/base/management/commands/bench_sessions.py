@@ -0,0 +1,62 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.client import RequestFactory
+from django.utils.importlib import import_module
+
+from webpay.base.benchmarks import sample_session
+
+ENGINES = ('encrypted_cookies', 'webpay.base.sessions')
+
+
+class Command(BaseCommand):
+    help = ('Compare the cost of loading and saving a typical session with '
+            'each session engine.')
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', default=1000,
+                    help='Requests to time for each case, default: 1000'),
+    )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        self.request = RequestFactory().get(
+            '/mozpay/', HTTP_USER_AGENT='Mozilla/5.0 Firefox/30.0')
+        self.stdout.write('{0:<24} {1:>14} {2:>10} {3:>10} {4:>10}'.format(
+            'engine', 'untouched (ms)', 'read (ms)', 'write (ms)', 'cookie'))
+        for engine in ENGINES:
+            store = import_module(engine).SessionStore
+            key = self.create(store)
+            results = [self.run(store, key, case, iterations)
+                       for case in (self.untouched, self.read, self.write)]
+            self.stdout.write(
+                '{0:<24} {1:>14.3f} {2:>10.3f} {3:>10.3f} {4:>10}'.format(
+                    engine, *(results + [len(key)])))
+
+    def create(self, store):
+        session = store(request_meta=self.request.META)
+        session.update(sample_session())
+        session.save()
+        return session.session_key
+
+    def run(self, store, key, case, iterations):
+        """Return the mean time in milliseconds of a request doing case."""
+        start = time.time()
+        for i in xrange(iterations):
+            session = store(session_key=key,
+                            request_meta=self.request.META)
+            case(session)
+            # This is what the middleware does at the end of each request.
+            if session.modified:
+                session.save()
+            session.check_request_data(self.request)
+        return (time.time() - start) * 1000 / iterations
+
+    def untouched(self, session):
+        pass
+
+    def read(self, session):
+        session.get('trans_id')
+
+    def write(self, session):
+        session['last_seen'] = time.time()
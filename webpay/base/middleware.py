@@ -1,5 +1,6 @@
 import json
 import sys
+import threading
 import traceback
 import urlparse
 
@@ -7,9 +8,12 @@ from django.conf import settings
 from django.utils.cache import patch_vary_headers
 from django.utils.translation.trans_real import parse_accept_lang_header
 
+from django_statsd.clients import statsd
 import tower
 from csp.middleware import CSPMiddleware as BaseCSPMiddleware
 
+from lib.utils import call_tracer
+from webpay.base.cache import LocalCache, request_cache
 from webpay.base.logger import getLogger
 from webpay.base.utils import log_cef
 
@@ -48,6 +52,82 @@ class LogExceptionsMiddleware:
         traceback.print_exception(*sys.exc_info())
 
 
+class LocaleTables(object):
+    """
+    Lookup tables for picking one of the supported locales.
+
+    The tables are built once from settings.LANGUAGE_URL_MAP and rebuilt
+    when the languages in settings change, so that picking a locale is a
+    dict lookup. The best locale for each Accept-Language header is also
+    kept in an LRU cache since only a few hundred distinct headers are
+    seen in practice.
+    """
+    # Longer headers are not cached so that they can't flush the cache.
+    max_header_length = 256
+
+    def __init__(self):
+        self._table = None
+        self._lock = threading.Lock()
+        self.accept_cache = LocalCache(
+            'accept_language', size=settings.ACCEPT_LANGUAGE_CACHE_SIZE,
+            timeout=0)
+
+    def signature(self):
+        return (settings.DEV, id(settings.DEV_LANGUAGES),
+                id(settings.PROD_LANGUAGES), id(settings.LANGUAGE_URL_MAP))
+
+    def build(self):
+        url_map = dict(settings.LANGUAGE_URL_MAP)
+        # The first locale found for each language prefix, en -> en-US.
+        prefixes = {}
+        for lang, locale in url_map.items():
+            prefixes.setdefault(lang.split('-')[0], locale)
+        # Exact matches win over prefixes.
+        accept = dict(prefixes)
+        accept.update(url_map)
+        return self.signature(), url_map, prefixes, accept
+
+    def tables(self):
+        table = self._table
+        if table is None or table[0] != self.signature():
+            with self._lock:
+                table = self._table = self.build()
+                self.accept_cache.clear()
+        return table[1:]
+
+    def from_accept(self, accept_lang):
+        """
+        Return the best locale for an Accept-Language header or False if
+        none of its languages are supported.
+        """
+        url_map, prefixes, accept = self.tables()
+        cache = len(accept_lang) <= self.max_header_length
+        best = self.accept_cache.get(accept_lang) if cache else None
+        if best is None:
+            best = False
+            for lang, _ in parse_accept_lang_header(accept_lang):
+                lang = lang.lower()
+                best = accept.get(lang) or accept.get(lang.split('-')[0])
+                if best:
+                    break
+            if cache:
+                self.accept_cache.set(accept_lang, best or False)
+        return best or False
+
+    def from_input(self, lang):
+        """
+        Return a tuple of (locale, exact) for a locale given by the user,
+        locale being None if it isn't supported.
+        """
+        url_map, prefixes, accept = self.tables()
+        if lang in url_map:
+            return url_map[lang], True
+        return prefixes.get(lang.lower().split('-', 1)[0]), False
+
+
+locale_tables = LocaleTables()
+
+
 class LocaleMiddleware(object):
     """
     1. Search for the locale.
@@ -73,20 +153,7 @@ class LocaleMiddleware(object):
         """
         Given an Accept-Language header, return the best-matching language.
         """
-        LUM = settings.LANGUAGE_URL_MAP
-        langs = LUM.copy()
-        langs.update((k.split('-')[0], v) for k, v in LUM.items() if
-                     k.split('-')[0] not in langs)
-        ranked = parse_accept_lang_header(accept_lang)
-        for lang, _ in ranked:
-            lang = lang.lower()
-            if lang in langs:
-                return langs[lang]
-            pre = lang.split('-')[0]
-            if pre in langs:
-                return langs[pre]
-        # Could not find an acceptable language.
-        return False
+        return locale_tables.from_accept(accept_lang)
 
     def find_from_input(self, lang):
         """
@@ -94,16 +161,12 @@ class LocaleMiddleware(object):
 
         When not supported, returns the default locale.
         """
-        if lang in settings.LANGUAGE_URL_MAP:
-            return settings.LANGUAGE_URL_MAP[lang]
-        else:
-            # en-xx -> en-US, en-GB, ...
-            supported = [settings.LANGUAGE_URL_MAP[x] for
-                         x in settings.LANGUAGE_URL_MAP if
-                         x.split('-', 1)[0] == lang.lower().split('-', 1)[0]]
-            if len(supported):
-                log.info('mapped locale {0} -> {1}'.format(lang, supported[0]))
-                return supported[0]
+        locale, exact = locale_tables.from_input(lang)
+        if locale:
+            if not exact:
+                # en-xx -> en-US, en-GB, ...
+                log.info('mapped locale {0} -> {1}'.format(lang, locale))
+            return locale
 
         log.info('unsupported locale: {0}'.format(lang))
         return settings.LANGUAGE_CODE
@@ -126,6 +189,88 @@ class LocaleMiddleware(object):
         return response
 
 
+class RequestCacheMiddleware(object):
+    """
+    Scopes webpay.base.cache.request_cache to a single request.
+    """
+
+    def process_request(self, request):
+        request_cache.start()
+
+    def process_response(self, request, response):
+        request_cache.stop()
+        return response
+
+    def process_exception(self, request, exception):
+        request_cache.stop()
+
+
+class SessionSizeMiddleware(object):
+    """
+    Records the size in bytes of the session cookie set on each response.
+
+    This must come before the session middleware so that it sees the
+    cookie the session middleware sets.
+    """
+
+    def process_response(self, request, response):
+        cookie = response.cookies.get(settings.SESSION_COOKIE_NAME)
+        if cookie is not None and cookie.value:
+            # A timer so that statsd reports the distribution of sizes.
+            statsd.timing('session.cookie_bytes', len(cookie.value))
+        return response
+
+
+class CallBudgetMiddleware(object):
+    """
+    Traces the Solitude and Marketplace calls made by each request.
+
+    The number of calls is sent to statsd per view and a warning is logged
+    when a view makes more calls than its budget in
+    settings.SLUMBER_CALL_BUDGET. When settings.SLUMBER_SERVER_TIMING is
+    True, or the buyer has super powers, the time spent in each endpoint
+    is added to the response in a Server-Timing header.
+
+    This should come early so that calls made by other middleware are
+    traced as well.
+    """
+
+    def process_request(self, request):
+        call_tracer.start()
+
+    def process_response(self, request, response):
+        trace = call_tracer.stop()
+        if trace is None or not trace.endpoints:
+            return response
+
+        view = view_name(request)
+        calls = trace.calls
+        statsd.timing('slumber.calls.{0}'.format(view), calls)
+        budget = settings.SLUMBER_CALL_BUDGET.get(
+            view, settings.SLUMBER_CALL_BUDGET['default'])
+        if budget and calls > budget:
+            log.warning('{view} made {calls} API calls, the budget is '
+                        '{budget}: {endpoints}'.format(
+                            view=view, calls=calls, budget=budget,
+                            endpoints=', '.join(
+                                '{0}.{1} x{2}'.format(api, endpoint, n)
+                                for (api, endpoint), (n, ms, size)
+                                in trace.endpoints.items())))
+            statsd.incr('slumber.over_budget.{0}'.format(view))
+        session = getattr(request, 'session', {})
+        if settings.SLUMBER_SERVER_TIMING or session.get('super_powers'):
+            response['Server-Timing'] = trace.server_timing()
+        return response
+
+
+def view_name(request):
+    """Return the dotted path of the view that handled a request."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unknown'
+    return '{0}.{1}'.format(match.func.__module__, match.func.__name__)
+
+
 class CEFMiddleware(object):
 
     def process_request(self, request):
@@ -0,0 +1,108 @@
+"""
+A cache backed session engine.
+
+Select it with SESSION_ENGINE = 'webpay.base.sessions' instead of the
+encrypted cookie engine. The cookie then only holds a random session key
+and the session data stays on the server.
+
+- Nothing is fetched from the cache until the session is first read.
+  Requests that never read the session, including the tamper check made
+  by django_paranoia, never look it up.
+- Setting a key to the value it already holds doesn't mark the session
+  as modified, so the middleware doesn't write it back.
+- The time of the last write is kept in the session. Once half of its
+  expiry has passed, reading the session marks it as modified so that it
+  is written again with a new expiry. Active sessions don't expire part
+  way through a purchase but aren't rewritten on every request.
+- With SESSION_WRITE_THROUGH every write also goes to the database and a
+  session missing from the cache is read back from there, so sessions
+  survive a cache restart.
+
+See the bench_sessions command to compare it with the cookie engine.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.exceptions import SuspiciousOperation
+from django.utils import timezone
+
+from django_paranoia.sessions import (KEY_PREFIX,
+                                      SessionStore as ParanoidSessionStore)
+from django_statsd.clients import statsd
+
+# When the session was last written, as a unix timestamp.
+TOUCHED_KEY = '_session_touched'
+
+# Values that can't be changed in place, so that setting an equal one
+# again really is no change.
+IMMUTABLE = (basestring, bool, int, long, float, type(None))
+
+
+class SessionStore(ParanoidSessionStore):
+
+    def load(self):
+        try:
+            data = self._cache.get(self.cache_key)
+        except Exception:
+            # Memcache raises on invalid keys, treat it as a new session.
+            data = None
+        if data is None and settings.SESSION_WRITE_THROUGH:
+            data = self.load_from_db()
+        if data is None:
+            statsd.incr('session.miss')
+            self.create()
+            return {}
+        age = self.get_expiry_age(expiry=data.get('_session_expiry'))
+        if data.get(TOUCHED_KEY, 0) + age / 2 < time.time():
+            # Write it back to extend its expiry.
+            statsd.incr('session.touched')
+            self.modified = True
+        return data
+
+    def load_from_db(self):
+        try:
+            session = Session.objects.get(session_key=self.session_key,
+                                          expire_date__gt=timezone.now())
+            data = self.decode(session.session_data)
+        except (Session.DoesNotExist, SuspiciousOperation):
+            return None
+        statsd.incr('session.db_hit')
+        self._cache.set(self.cache_key, data, self.get_expiry_age())
+        return data
+
+    def __setitem__(self, key, value):
+        session = self._get_session()
+        if key in session:
+            current = session[key]
+            # A dict or list may have been changed in place and set again.
+            if current == value and (current is not value or
+                                     isinstance(value, IMMUTABLE)):
+                statsd.incr('session.unchanged')
+                return
+        super(SessionStore, self).__setitem__(key, value)
+
+    def save(self, must_create=False):
+        data = self._get_session(no_load=must_create)
+        data[TOUCHED_KEY] = time.time()
+        super(SessionStore, self).save(must_create=must_create)
+        if settings.SESSION_WRITE_THROUGH:
+            Session(session_key=self._get_or_create_session_key(),
+                    session_data=self.encode(data),
+                    expire_date=self.get_expiry_date()).save()
+
+    def exists(self, session_key):
+        return (KEY_PREFIX + session_key) in self._cache
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key is None:
+            return
+        self._cache.delete(KEY_PREFIX + session_key)
+        if settings.SESSION_WRITE_THROUGH:
+            Session.objects.filter(session_key=session_key).delete()
+
+    def check_request_data(self, request):
+        # There is nothing to check if the session was never read.
+        if self.accessed:
+            super(SessionStore, self).check_request_data(request)
@@ -0,0 +1,24 @@
+from nose.plugins import Plugin
+
+
+class ResetCaches(Plugin):
+    """
+    Empty the shared cache and the in-process caches before each test.
+
+    The tests run with the same caching as production so without this a
+    test could see what an earlier test cached.
+    """
+    name = 'reset-caches'
+
+    def beforeTest(self, test):
+        # Imported here because settings aren't configured when nose
+        # loads its plugins.
+        from django.core.cache import cache
+        from lib.marketplace.api import client as marketplace
+        from lib.solitude.api import client as solitude
+        from webpay.spa.shell import shells
+
+        cache.clear()
+        marketplace.price_index.clear()
+        solitude.buyer_cache.clear()
+        shells.clear()
@@ -0,0 +1,44 @@
+from django.test import TestCase
+
+import mock
+from nose.tools import eq_
+
+from webpay.base import benchmarks
+
+
+class TestBenchmarks(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        registry = {'noop': (lambda: lambda: self.calls.append(1), {})}
+        p = mock.patch.object(benchmarks, 'registry', registry)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_run(self):
+        results = benchmarks.run(iterations=3, rounds=2)
+        result = results['results']['noop']
+        eq_(result['iterations'], 3)
+        eq_(result['rounds'], 2)
+        assert result['min'] <= result['median']
+        # One warm up call then the timed ones.
+        eq_(len(self.calls), 7)
+
+    def test_compare(self):
+        previous = {'results': {'noop': {'median': 10.0},
+                                'gone': {'median': 1.0}}}
+        current = {'results': {'noop': {'median': 12.0},
+                               'new': {'median': 1.0}}}
+        eq_(benchmarks.compare(previous, current),
+            [('noop', 10.0, 12.0, 20.0)])
+
+    def test_median(self):
+        eq_(benchmarks.median([3, 1, 2]), 2)
+        eq_(benchmarks.median([4, 1, 2, 3]), 2.5)
+
+
+class TestRegistered(TestCase):
+
+    def test_all_run(self):
+        for name in benchmarks.registry:
+            benchmarks.run_benchmark(name, iterations=1, rounds=1)
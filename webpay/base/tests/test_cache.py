@@ -0,0 +1,158 @@
+from django import http
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+import mock
+from nose.tools import eq_
+
+from webpay.base.cache import (LocalCache, request_cache,
+                               stale_while_revalidate)
+from webpay.base.middleware import RequestCacheMiddleware
+
+
+class TestLocalCache(TestCase):
+
+    def setUp(self):
+        self.cache = LocalCache('test', size=2, timeout=60)
+
+    def test_get(self):
+        self.cache.set('a', 1)
+        eq_(self.cache.get('a'), 1)
+        eq_(self.cache.get('b', 'default'), 'default')
+        eq_((self.cache.hits, self.cache.misses), (1, 1))
+
+    @mock.patch('webpay.base.cache.statsd')
+    def test_counters(self, statsd):
+        self.cache.get('a')
+        statsd.incr.assert_called_with('local_cache.test.miss')
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        statsd.incr.assert_called_with('local_cache.test.hit')
+
+    def test_evict_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        eq_(self.cache.get('b'), None)
+        eq_(self.cache.get('a'), 1)
+        eq_(len(self.cache), 2)
+
+    @mock.patch('webpay.base.cache.time')
+    def test_expires(self, time):
+        time.time.return_value = 100
+        self.cache.set('a', 1)
+        time.time.return_value = 161
+        eq_(self.cache.get('a'), None)
+
+    @mock.patch('webpay.base.cache.time')
+    def test_no_timeout(self, time):
+        time.time.return_value = 100
+        self.cache.set('a', 1, timeout=0)
+        time.time.return_value = 10 ** 9
+        eq_(self.cache.get('a'), 1)
+
+    def test_delete(self):
+        self.cache.set('a', 1)
+        self.cache.delete('a')
+        eq_(self.cache.get('a'), None)
+
+
+class TestRequestCache(TestCase):
+
+    def tearDown(self):
+        request_cache.stop()
+
+    def test_inactive(self):
+        request_cache.set('a', 1)
+        eq_(request_cache.get('a'), None)
+
+    def test_middleware(self):
+        middleware = RequestCacheMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        request_cache.set('a', 1)
+        eq_(request_cache.get('a'), 1)
+        middleware.process_response(request, http.HttpResponse())
+        eq_(request_cache.get('a'), None)
+
+    def test_middleware_exception(self):
+        middleware = RequestCacheMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        middleware.process_exception(request, ValueError())
+        assert not request_cache.active
+
+
+@mock.patch('webpay.base.cache.threading.Thread')
+@mock.patch('webpay.base.cache.time.time')
+class TestStaleWhileRevalidate(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+        @stale_while_revalidate('test:swr', timeout=10, max_stale=100)
+        def lookup(point):
+            self.calls.append(point)
+            return 'tier {0}:{1}'.format(point, len(self.calls))
+
+        self.lookup = lookup
+
+    def run_refresh(self, thread):
+        target = thread.call_args[1]['target']
+        target(*thread.call_args[1]['args'])
+
+    def test_fresh(self, now, thread):
+        now.return_value = 1000
+        eq_(self.lookup(1), 'tier 1:1')
+        eq_(self.lookup(1), 'tier 1:1')
+        eq_(self.lookup(2), 'tier 2:2')
+        assert not thread.called
+
+    def test_normalised_arguments(self, now, thread):
+        now.return_value = 1000
+        eq_(self.lookup(10), 'tier 10:1')
+        eq_(self.lookup('10'), 'tier 10:1')
+        eq_(self.lookup(u'10'), 'tier 10:1')
+        eq_(self.calls, [10])
+
+    def test_stale(self, now, thread):
+        now.return_value = 1000
+        self.lookup(1)
+        now.return_value = 1011
+        eq_(self.lookup(1), 'tier 1:1')
+        # Only one refresh is started.
+        eq_(self.lookup(1), 'tier 1:1')
+        eq_(thread.call_count, 1)
+        self.run_refresh(thread)
+        eq_(self.lookup(1), 'tier 1:2')
+
+    def test_max_stale(self, now, thread):
+        now.return_value = 1000
+        self.lookup(1)
+        now.return_value = 1111
+        eq_(self.lookup(1), 'tier 1:2')
+        assert not thread.called
+
+    def test_refresh_failed(self, now, thread):
+        now.return_value = 1000
+        self.lookup(1)
+        now.return_value = 1011
+        self.lookup(1)
+        self.calls = None
+        self.run_refresh(thread)
+        # The stale value is kept and the lock is released.
+        eq_(self.lookup(1), 'tier 1:1')
+        eq_(thread.call_count, 2)
+
+    @mock.patch('webpay.base.cache.statsd')
+    def test_stats(self, statsd, now, thread):
+        now.return_value = 1000
+        self.lookup(1)
+        self.lookup(1)
+        now.return_value = 1011
+        self.lookup(1)
+        eq_([c[0][0] for c in statsd.incr.call_args_list],
+            ['test.swr.miss', 'test.swr.hit', 'test.swr.stale'])
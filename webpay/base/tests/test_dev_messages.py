@@ -1,4 +1,11 @@
-from webpay.base.dev_messages import legend
+import json
+
+import mock
+from nose.tools import eq_
+
+from webpay.base import dev_messages
+from webpay.base.dev_messages import (BAD_ICON_KEY, build_legends,
+                                      compiled_legend, legend)
 from webpay.base.tests import TestCase
 
 
@@ -7,3 +14,33 @@ class TestDevMessages(TestCase):
     def test_legend(self):
         # Make sure there are no exceptions.
         legend()
+
+
+class TestCompiledLegend(TestCase):
+
+    def setUp(self):
+        dev_messages._compiled.clear()
+
+    def tearDown(self):
+        dev_messages._compiled.clear()
+
+    def test_content(self):
+        data = json.loads(compiled_legend('pl').content)
+        eq_(data['locale'], 'pl')
+        eq_(data['errors'], None)
+        assert BAD_ICON_KEY in data['legend'], data
+
+    def test_compiled_once(self):
+        with mock.patch('webpay.base.dev_messages.legend',
+                        wraps=legend) as built:
+            first = compiled_legend('pl')
+            eq_(compiled_legend('pl'), first)
+        eq_(built.call_count, 1)
+
+    def test_etag(self):
+        assert compiled_legend('pl').etag != compiled_legend('de').etag
+
+    def test_build_legends(self):
+        with self.settings(PROD_LANGUAGES=('de', 'pl')):
+            build_legends()
+        eq_(sorted(dev_messages._compiled), ['de', 'pl'])
@@ -10,8 +10,11 @@ import fudge
 import mock
 from nose.tools import eq_, ok_
 
-from webpay.base.middleware import (CEFMiddleware, CSPMiddleware,
-                                    LocaleMiddleware, LogJSONerror)
+from lib.utils import call_tracer
+from webpay.base.middleware import (CallBudgetMiddleware, CEFMiddleware,
+                                    CSPMiddleware, LocaleMiddleware,
+                                    LocaleTables, LogJSONerror,
+                                    SessionSizeMiddleware)
 
 
 class TestLocaleMiddleware(TestCase):
@@ -75,6 +78,53 @@ class TestLocaleMiddleware(TestCase):
         eq_(self.process()[0], settings.LANGUAGE_CODE)
 
 
+class TestLocaleTables(TestCase):
+
+    def setUp(self):
+        self.tables = LocaleTables()
+        self.url_map = {'en-us': 'en-US', 'pt-br': 'pt-BR', 'de': 'de'}
+
+    def test_accept(self):
+        with self.settings(LANGUAGE_URL_MAP=self.url_map):
+            eq_(self.tables.from_accept('pt-PT,en;q=0.5'), 'pt-BR')
+            eq_(self.tables.from_accept('de-AT'), 'de')
+            eq_(self.tables.from_accept('xx'), False)
+
+    @mock.patch('webpay.base.middleware.parse_accept_lang_header')
+    def test_accept_cached(self, parse):
+        parse.return_value = [('de', 1.0)]
+        with self.settings(LANGUAGE_URL_MAP=self.url_map):
+            eq_(self.tables.from_accept('de'), 'de')
+            eq_(self.tables.from_accept('de'), 'de')
+        eq_(parse.call_count, 1)
+
+    @mock.patch('webpay.base.middleware.parse_accept_lang_header')
+    def test_no_match_cached(self, parse):
+        parse.return_value = [('xx', 1.0)]
+        with self.settings(LANGUAGE_URL_MAP=self.url_map):
+            eq_(self.tables.from_accept('xx'), False)
+            eq_(self.tables.from_accept('xx'), False)
+        eq_(parse.call_count, 1)
+
+    def test_long_header_not_cached(self):
+        header = 'de,' + 'xx;q=0.1,' * 100
+        with self.settings(LANGUAGE_URL_MAP=self.url_map):
+            eq_(self.tables.from_accept(header), 'de')
+        eq_(len(self.tables.accept_cache), 0)
+
+    def test_rebuilt_when_languages_change(self):
+        with self.settings(LANGUAGE_URL_MAP=self.url_map):
+            eq_(self.tables.from_accept('fr'), False)
+        with self.settings(LANGUAGE_URL_MAP={'fr': 'fr'}):
+            eq_(self.tables.from_accept('fr'), 'fr')
+
+    def test_input(self):
+        with self.settings(LANGUAGE_URL_MAP=self.url_map):
+            eq_(self.tables.from_input('en-us'), ('en-US', True))
+            eq_(self.tables.from_input('EN-xx'), ('en-US', False))
+            eq_(self.tables.from_input('xx'), (None, False))
+
+
 class ExcWithContent(Exception):
 
     def __init__(self, msg, content):
@@ -107,6 +157,76 @@ class TestCEFMiddleware(TestCase):
         log_cef.assert_called_with('ExcWithContent', None, severity=8)
 
 
+@mock.patch('webpay.base.middleware.statsd')
+class TestSessionSizeMiddleware(TestCase):
+
+    def test_cookie_size(self, statsd):
+        response = http.HttpResponse()
+        response.set_cookie(settings.SESSION_COOKIE_NAME, 'x' * 10)
+        SessionSizeMiddleware().process_response(None, response)
+        statsd.timing.assert_called_with('session.cookie_bytes', 10)
+
+    def test_no_cookie(self, statsd):
+        SessionSizeMiddleware().process_response(None, http.HttpResponse())
+        assert not statsd.timing.called
+
+
+@mock.patch('webpay.base.middleware.statsd')
+class TestCallBudgetMiddleware(TestCase):
+
+    def setUp(self):
+        self.middleware = CallBudgetMiddleware()
+        self.request = RequestFactory().get('/')
+        self.request.resolver_match = mock.Mock()
+        self.request.resolver_match.func.__module__ = 'webpay.pay.views'
+        self.request.resolver_match.func.__name__ = 'lobby'
+
+    def process(self, calls):
+        self.middleware.process_request(self.request)
+        for call in range(calls):
+            call_tracer.record('solitude', 'generic.buyer', 10, 100)
+        return self.middleware.process_response(self.request,
+                                                http.HttpResponse())
+
+    def test_no_calls(self, statsd):
+        response = self.process(0)
+        assert not statsd.timing.called
+        assert not response.has_header('Server-Timing')
+
+    @override_settings(SLUMBER_SERVER_TIMING=True)
+    def test_calls(self, statsd):
+        response = self.process(2)
+        statsd.timing.assert_called_with(
+            'slumber.calls.webpay.pay.views.lobby', 2)
+        eq_(response['Server-Timing'],
+            'solitude.generic.buyer;dur=20.0;desc="2 calls, 200 bytes"')
+        eq_(call_tracer.trace, None)
+
+    def test_no_header(self, statsd):
+        assert not self.process(1).has_header('Server-Timing')
+
+    def test_super_powers(self, statsd):
+        self.request.session = {'super_powers': True}
+        assert self.process(1).has_header('Server-Timing')
+
+    @mock.patch('webpay.base.middleware.log')
+    def test_over_budget(self, log, statsd):
+        budget = {'default': 10, 'webpay.pay.views.lobby': 2}
+        with self.settings(SLUMBER_CALL_BUDGET=budget):
+            self.process(2)
+            assert not log.warning.called
+            self.process(3)
+            assert log.warning.called
+        statsd.incr.assert_called_with(
+            'slumber.over_budget.webpay.pay.views.lobby')
+
+    @mock.patch('webpay.base.middleware.log')
+    def test_no_budget(self, log, statsd):
+        with self.settings(SLUMBER_CALL_BUDGET={'default': 0}):
+            self.process(20)
+        assert not log.warning.called
+
+
 class TestCSPMiddleware(TestCase):
     # Override the setting so it gets reset
     @override_settings(SPARTACUS_STATIC='',
@@ -0,0 +1,140 @@
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+import mock
+from nose.tools import eq_
+
+from webpay.base.sessions import SessionStore
+
+
+class TestSessionStore(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/')
+        session = self.store()
+        session['trans_id'] = 'trans:1'
+        session.save()
+        self.key = session.session_key
+
+    def store(self, key=None):
+        return SessionStore(session_key=key, request_meta=self.request.META)
+
+    def test_load(self):
+        eq_(self.store(self.key)['trans_id'], 'trans:1')
+
+    def test_lazy(self):
+        session = self.store(self.key)
+        with mock.patch.object(session, '_cache') as session_cache:
+            session.check_request_data(self.request)
+        assert not session_cache.get.called
+
+    def test_unknown_key(self):
+        session = self.store('nope')
+        eq_(session.get('trans_id'), None)
+        assert session.session_key != 'nope'
+
+    def test_same_value_not_modified(self):
+        session = self.store(self.key)
+        session['trans_id'] = ''.join(['trans:', '1'])
+        assert not session.modified
+
+    def test_same_dict_modified(self):
+        session = self.store()
+        notes = {'network': {}}
+        session['notes'] = notes
+        notes['network'] = {'mcc': '123'}
+        session['notes'] = notes
+        session.save()
+        eq_(self.store(session.session_key)['notes'],
+            {'network': {'mcc': '123'}})
+
+    def test_different_value_modified(self):
+        session = self.store(self.key)
+        session['trans_id'] = 'trans:2'
+        assert session.modified
+
+    @mock.patch('webpay.base.sessions.time.time')
+    def test_recent_not_touched(self, now):
+        now.return_value = 1000
+        with self.settings(SESSION_COOKIE_AGE=60):
+            session = self.store()
+            session['trans_id'] = 'trans:1'
+            session.save()
+            now.return_value = 1029
+            session = self.store(session.session_key)
+            session.get('trans_id')
+            assert not session.modified
+
+    @mock.patch('django.core.cache.backends.locmem.time')
+    @mock.patch('webpay.base.sessions.time.time')
+    def test_touched_extends_expiry(self, now, clock):
+        now.return_value = clock.time.return_value = 1000
+        with self.settings(SESSION_COOKIE_AGE=60):
+            session = self.store()
+            session['trans_id'] = 'trans:1'
+            session.save()
+            now.return_value = clock.time.return_value = 1050
+            session = self.store(session.session_key)
+            session.get('trans_id')
+            # This is what the middleware does at the end of a request.
+            assert session.modified
+            session.save()
+            clock.time.return_value = 1100
+            eq_(self.store(session.session_key).get('trans_id'), 'trans:1')
+            clock.time.return_value = 1111
+            eq_(self.store(session.session_key).get('trans_id'), None)
+
+    def test_changed_saved(self):
+        session = self.store(self.key)
+        session['trans_id'] = 'trans:2'
+        session.save()
+        eq_(self.store(self.key)['trans_id'], 'trans:2')
+
+    def test_delete(self):
+        self.store(self.key).delete()
+        assert not self.store().exists(self.key)
+
+
+class TestWriteThrough(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/')
+
+    def store(self, key=None):
+        return SessionStore(session_key=key, request_meta=self.request.META)
+
+    def test_read_back_from_db(self):
+        with self.settings(SESSION_WRITE_THROUGH=True):
+            session = self.store()
+            session['trans_id'] = 'trans:1'
+            session.save()
+            cache.clear()
+            eq_(self.store(session.session_key)['trans_id'], 'trans:1')
+
+    def test_unchanged_not_modified(self):
+        with self.settings(SESSION_WRITE_THROUGH=True):
+            session = self.store()
+            session['trans_id'] = 'trans:1'
+            session.save()
+            session = self.store(session.session_key)
+            session['trans_id'] = ''.join(['trans:', '1'])
+        assert not session.modified
+
+    def test_delete(self):
+        with self.settings(SESSION_WRITE_THROUGH=True):
+            session = self.store()
+            session['trans_id'] = 'trans:1'
+            session.save()
+            session.delete()
+        assert not Session.objects.filter(
+            session_key=session.session_key).exists()
+
+    def test_off(self):
+        session = self.store()
+        session['trans_id'] = 'trans:1'
+        session.save()
+        assert not Session.objects.exists()
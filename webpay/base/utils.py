@@ -6,7 +6,6 @@ import time
 from django.conf import settings
 from django.core.cache import cache
 from django.http import HttpResponse
-from django.shortcuts import render
 
 from cef import log_cef as _log_cef
 from tower import ugettext as _
@@ -69,6 +68,7 @@ def system_error(request, **kw):
 
 def custom_error(request, user_message, code=msg.UNEXPECTED_ERROR, status=400):
     from webpay.base.helpers import fxa_auth_info
+    from webpay.spa.shell import render_index
     error = {'error': user_message, 'error_code': code}
     if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
         return HttpResponse(
@@ -81,7 +81,7 @@ def custom_error(request, user_message, code=msg.UNEXPECTED_ERROR, status=400):
            'error_code': code,
            'fxa_state': state,
            'fxa_auth_url': fxa_url}
-    return render(request, 'spa/index.html', ctx, status=status)
+    return render_index(request, ctx, status=status)
 
 
 def uri_to_pk(uri):
@@ -0,0 +1,238 @@
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+from django_statsd.clients import statsd
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from lib.utils import host_prefix
+
+log = logging.getLogger('w.pay.dispatch')
+
+
+class HostBusy(RequestException):
+    """Too many notices are already outstanding to this host."""
+
+
+class CircuitOpen(RequestException):
+    """Notices to this host are being held back by its circuit breaker."""
+
+
+def incr(key, timeout):
+    """Increment a counter in the shared cache, creating it if needed."""
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The key expired between the add and the incr.
+        cache.set(key, 1, timeout)
+        return 1
+
+
+class NoticeDispatcher(object):
+    """
+    Sends notices to app servers.
+
+    All notices sent from a worker process go through one keep-alive
+    session so repeated notices to the same app reuse their connections.
+    The number of notices in flight to any one host, from all workers, is
+    capped by NOTICE_DISPATCHER['max_per_host']. It is counted in the
+    shared cache because with Celery's prefork pool each worker process
+    only sends one notice at a time. When a host already has that many
+    outstanding, HostBusy is raised straight away so that the worker slot
+    is given back and the notice is retried later.
+    """
+
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+
+    def key(self, host):
+        return 'dispatch:{0}:in-flight'.format(
+            hashlib.md5(smart_str(host)).hexdigest())
+
+    def acquire(self, host):
+        """Take one of the slots of host, returning False if none are left."""
+        config = settings.NOTICE_DISPATCHER
+        # The count expires in case a worker dies without releasing its slot.
+        count = incr(self.key(host), config['slot_timeout'])
+        if count > config['max_per_host']:
+            self.release(host)
+            return False
+        return True
+
+    def release(self, host):
+        try:
+            cache.decr(self.key(host))
+        except ValueError:
+            # The count expired while the notice was being sent.
+            pass
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                config = settings.NOTICE_DISPATCHER
+                session = requests.Session()
+                for prefix in ('http://', 'https://'):
+                    session.mount(prefix, HTTPAdapter(
+                        pool_connections=config['pool_connections'],
+                        pool_maxsize=config['pool_maxsize']))
+                self._session = session
+            return self._session
+
+    def post(self, url, data, timeout=5):
+        """
+        POST data to url, returning the response.
+
+        :raises HostBusy: if the host has too many outstanding notices.
+        """
+        host = host_prefix(url)
+        if not self.acquire(host):
+            statsd.incr('purchase.notice_dispatcher.host_busy')
+            log.warning('Too many notices outstanding to {0}'.format(host))
+            raise HostBusy('Too many notices outstanding to {0}'.format(host))
+        try:
+            return self.session.post(url, data, timeout=timeout)
+        finally:
+            self.release(host)
+
+
+dispatcher = NoticeDispatcher()
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker for each app host that we send notices to.
+
+    Outcomes are counted in the shared cache over a window of
+    POSTBACK_BREAKER['window'] seconds so that all workers see the same
+    state. When at least `min_requests` notices were sent in the window
+    and at least `failure_rate` of them failed, the circuit opens and no
+    notices are sent to the host for `open_for` seconds. After that the
+    circuit is half open: one probe notice at a time is let through and
+    after `probes` successes in a row the circuit closes again. A failed
+    probe opens the circuit again.
+    """
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half-open'
+
+    # A registry of tripped hosts, used for reporting only.
+    tripped_key = 'breaker:tripped'
+
+    def key(self, host, name):
+        return 'breaker:{0}:{1}'.format(
+            hashlib.md5(smart_str(host)).hexdigest(), name)
+
+    def state(self, host):
+        opened_until = cache.get(self.key(host, 'open'))
+        if opened_until is None:
+            return self.closed
+        if opened_until > time.time():
+            return self.open
+        return self.half_open
+
+    def allow(self, url):
+        """Return True if a notice may be sent to url right now."""
+        if not settings.POSTBACK_BREAKER_ENABLED:
+            return True
+        host = host_prefix(url)
+        state = self.state(host)
+        if state == self.closed:
+            return True
+        if state == self.half_open:
+            # Only one probe at a time.
+            return cache.add(self.key(host, 'probe'), 1,
+                             settings.POSTBACK_BREAKER['probe_timeout'])
+        return False
+
+    def release(self, url):
+        """
+        Give back the probe slot that allow() took for a notice to url
+        that was not sent after all, for example because the host was busy.
+        """
+        if not settings.POSTBACK_BREAKER_ENABLED:
+            return
+        host = host_prefix(url)
+        if self.state(host) == self.half_open:
+            cache.delete(self.key(host, 'probe'))
+
+    def retry_in(self, url):
+        """
+        Return the number of seconds until a notice to url that allow()
+        turned down may be sent.
+        """
+        host = host_prefix(url)
+        opened_until = cache.get(self.key(host, 'open'))
+        if opened_until is not None and opened_until > time.time():
+            return max(int(opened_until - time.time()) + 1, 1)
+        # The circuit is half open and another notice is probing the host.
+        return settings.POSTBACK_BREAKER['probe_timeout']
+
+    def record(self, url, success):
+        """Record the outcome of a notice sent to url."""
+        if not settings.POSTBACK_BREAKER_ENABLED:
+            return
+        config = settings.POSTBACK_BREAKER
+        host = host_prefix(url)
+        state = self.state(host)
+        if state == self.half_open:
+            cache.delete(self.key(host, 'probe'))
+            if not success:
+                self.trip(host)
+            elif (incr(self.key(host, 'probes'), config['open_for']) >=
+                    config['probes']):
+                self.reset(host)
+        elif state == self.closed:
+            window = config['window']
+            total = incr(self.key(host, 'total'), window)
+            if success:
+                return
+            failures = incr(self.key(host, 'failures'), window)
+            if (total >= config['min_requests'] and
+                    float(failures) / total >= config['failure_rate']):
+                self.trip(host)
+
+    def trip(self, host):
+        config = settings.POSTBACK_BREAKER
+        log.warning('Opening the notice circuit breaker for {0}'.format(host))
+        statsd.incr('purchase.notice_breaker.open')
+        opened_until = time.time() + config['open_for']
+        # Keep the key around after opened_until so that we know the
+        # circuit is half open until the probes succeed.
+        cache.set(self.key(host, 'open'), opened_until,
+                  config['open_for'] * 10)
+        cache.delete_many([self.key(host, name)
+                           for name in ('probes', 'total', 'failures')])
+        tripped = cache.get(self.tripped_key) or {}
+        tripped[host] = opened_until
+        cache.set(self.tripped_key, tripped, config['open_for'] * 10)
+
+    def reset(self, host):
+        log.info('Closing the notice circuit breaker for {0}'.format(host))
+        statsd.incr('purchase.notice_breaker.close')
+        cache.delete_many([self.key(host, name) for name in
+                           ('open', 'probe', 'probes', 'total', 'failures')])
+        tripped = cache.get(self.tripped_key) or {}
+        if tripped.pop(host, None):
+            cache.set(self.tripped_key, tripped,
+                      settings.POSTBACK_BREAKER['open_for'] * 10)
+
+    def states(self):
+        """
+        Return the state of every host whose circuit has opened, as a
+        dict of host to state.
+        """
+        tripped = cache.get(self.tripped_key) or {}
+        return dict((host, self.state(host)) for host in tripped)
+
+
+breaker = CircuitBreaker()
@@ -2,7 +2,7 @@ from django import forms
 from django.conf import settings
 
 from django_paranoia.forms import ParanoidForm
-import jwt
+from mozpay.exc import InvalidJWT
 
 from lib.solitude.constants import ACCESS_SIMULATE
 from tower import ugettext_lazy as _
@@ -11,6 +11,7 @@ from webpay.base import dev_messages as msg
 from webpay.base.logger import getLogger
 
 from .utils import lookup_issuer, UnknownIssuer
+from .verify import decode_jwt, JWTTooLarge
 
 log = getLogger('w.pay')
 
@@ -29,6 +30,8 @@ class VerifyForm(ParanoidForm):
     key = settings.KEY
     secret = settings.SECRET
     is_simulation = False
+    # The DecodedJWT of req, to be verified once the secret is known.
+    jwt = None
 
     def clean(self):
         cleaned_data = super(VerifyForm, self).clean()
@@ -41,12 +44,16 @@ class VerifyForm(ParanoidForm):
     def clean_req(self):
         data = self.cleaned_data['req']
         jwt_data = data.encode('ascii', 'ignore')
-        log.debug('incoming JWT data: %r' % jwt_data)
+        log.debug('incoming JWT data: %r' % jwt_data[:1024])
         try:
-            payload = jwt.decode(jwt_data, verify=False)
-        except jwt.InvalidTokenError, exc:
+            self.jwt = decode_jwt(jwt_data)
+        except JWTTooLarge, exc:
+            log.info(str(exc))
+            raise forms.ValidationError(msg.JWT_TOO_LARGE)
+        except InvalidJWT, exc:
             log.debug('Error decoding JWT: {0}'.format(exc))
             raise forms.ValidationError(msg.JWT_DECODE_ERR)
+        payload = self.jwt.payload
         log.debug('Received JWT: %r' % payload)
         if not isinstance(payload, dict):
             # It seems that some JWT libs are encoding strings of JSON
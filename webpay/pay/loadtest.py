@@ -0,0 +1,326 @@
+"""
+Drive the whole purchase flow through webpay, in process, under load.
+
+Each purchase goes through the same requests as a buyer on a phone:
+
+1. ``pay``: POST the pay request JWT to /mozpay/v1/api/pay/, which
+   verifies it and configures the transaction (start_pay).
+2. ``trans_start_url``: poll until the provider pay URL is ready.
+3. ``success``: the reference provider redirects back to webpay which
+   then notifies the app (payment_notify).
+
+Solitude and Marketplace are replaced by FakeSolitude adapters and the
+app that receives the notice by FakeApp, so no server needs to be
+running, and latency and server errors can be injected into both APIs.
+Celery tasks run eagerly in the thread of the request; they are also
+timed on their own as ``task:start_pay`` and ``task:payment_notify``.
+
+See the loadtest management command.
+"""
+import contextlib
+import json
+import math
+import threading
+import time
+import urlparse
+import uuid
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils.importlib import import_module
+
+from celery import current_app
+from celery.signals import task_postrun, task_prerun
+import jwt
+from mpconstants import countries
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from lib.marketplace.api import client as marketplace
+from lib.solitude.api import client as solitude
+from lib.solitude.fake import FakeSolitude
+from lib.utils import host_prefix
+from webpay.base.logger import getLogger
+from webpay.base.utils import gmtime
+
+from .dispatch import dispatcher
+
+log = getLogger('w.pay.loadtest')
+
+APP_URL = 'https://app.loadtest/'
+PRICE_POINT = '10'
+PRODUCT_ID = 'loadtest:product'
+PUBLIC_ID = 'loadtest:app'
+STEPS = ('pay', 'task:start_pay', 'trans_start_url', 'success',
+         'task:payment_notify')
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class FakeApp(BaseAdapter):
+    """
+    Stands in for the app server, answering notices with the transaction
+    ID as an app is meant to.
+    """
+
+    def __init__(self):
+        super(FakeApp, self).__init__()
+        self.notices = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        notice = urlparse.parse_qs(request.body)['notice'][0]
+        payload = jwt.decode(notice, verify=False)
+        with self.lock:
+            self.notices += 1
+        res = Response()
+        res.status_code = 200
+        res._content = str(payload['response']['transactionID'])
+        res.url = request.url
+        res.request = request
+        return res
+
+
+class LoadTestClient(Client):
+    """
+    A test client that can be used alongside others in other threads.
+
+    Client re-raises exceptions from views through a signal receiver that
+    is shared by all clients, so an error could be raised by the client
+    of another buyer. Here views that fail return a 500 as they would in
+    production.
+    """
+
+    def store_exc_info(self, **kwargs):
+        pass
+
+
+class LoadTest(object):
+    """
+    :param purchases: the number of purchases to make.
+    :param concurrency: the number of buyers purchasing at the same time.
+    :param latency: seconds Solitude and Marketplace take to answer.
+    :param error_rate: the fraction of Solitude and Marketplace requests,
+                       from 0 to 1, answered with a 500 error.
+    :param max_polls: how many times to ask for the pay URL before giving
+                      up on a purchase.
+    """
+
+    def __init__(self, purchases=100, concurrency=1, latency=0,
+                 error_rate=0, max_polls=10):
+        self.purchases = purchases
+        self.concurrency = concurrency
+        self.max_polls = max_polls
+        self.solitude = FakeSolitude(latency=latency, error_rate=error_rate)
+        self.marketplace = FakeSolitude(latency=latency,
+                                        error_rate=error_rate)
+        self.app = FakeApp()
+        self.times = dict((step, []) for step in STEPS)
+        self.errors = dict((step, 0) for step in STEPS)
+        self.completed = 0
+        self.lock = threading.Lock()
+        self._task_started = {}
+        self.setup()
+
+    def setup(self):
+        """Add the seller, product and prices every purchase uses."""
+        seller = self.solitude.add('generic/seller', uuid='loadtest:seller')
+        self.solitude.add('generic/product', public_id=PUBLIC_ID,
+                          external_id=PRODUCT_ID,
+                          seller=seller['resource_uri'],
+                          seller_uuids={'reference': 'loadtest:reference'})
+        reference_seller = self.solitude.add(
+            'provider/reference/sellers', seller__uuid='loadtest:reference')
+        product = self.solitude.add(
+            'provider/reference/products',
+            seller_product__seller=seller['resource_pk'],
+            seller_product__external_id=PRODUCT_ID,
+            seller_reference=reference_seller['resource_uri'],
+            reference={'uuid': 'loadtest:reference-product'})
+        product['id'] = product['resource_pk']
+        self.solitude.on_post('provider/reference/transactions',
+                              token='loadtest-token')
+        self.solitude.on_post('provider/reference/notices', result='OK')
+
+        prices = self.api_path(marketplace.api.webpay.prices)
+        usa = countries.COUNTRY_DETAILS['USA']['id']
+        for provider in settings.PAYMENT_PROVIDERS:
+            self.marketplace.add(prices, provider=provider,
+                                 pricePoint=PRICE_POINT, prices=[
+                                     {'price': '0.99', 'amount': '0.99',
+                                      'currency': 'USD', 'region': usa}])
+
+    def api_path(self, resource):
+        """Return the path a FakeSolitude keeps a Marketplace resource at."""
+        base = urlparse.urlparse(marketplace.slumber._store['base_url']).path
+        path = urlparse.urlparse(resource._store['base_url']).path
+        return path[len(base):].strip('/')
+
+    def pay_request(self):
+        issued_at = gmtime()
+        return jwt.encode({
+            'iss': settings.KEY,
+            'aud': settings.DOMAIN,
+            'typ': 'mozilla/payments/pay/v1',
+            'iat': issued_at,
+            'exp': issued_at + 3600,
+            'request': {
+                'id': PRODUCT_ID,
+                'pricePoint': PRICE_POINT,
+                'name': 'Load test',
+                'description': 'A purchase made by the load test',
+                'postbackURL': APP_URL + 'postback',
+                'chargebackURL': APP_URL + 'chargeback',
+                'productData': 'public_id={0}'.format(PUBLIC_ID),
+            },
+        }, settings.SECRET, algorithm='HS256')
+
+    def login(self):
+        """Return a test client logged in as a new buyer."""
+        buyer = self.solitude.add('generic/buyer',
+                                  uuid='loadtest:{0}'.format(uuid.uuid4()))
+        client = LoadTestClient()
+        request = RequestFactory().get('/')
+        engine = import_module(settings.SESSION_ENGINE)
+        session = engine.SessionStore(request_meta=request.META)
+        session['uuid'] = buyer['uuid']
+        session.save()
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        return client
+
+    def record(self, step, start, ok=True):
+        with self.lock:
+            self.times[step].append((time.time() - start) * 1000)
+            if not ok:
+                self.errors[step] += 1
+
+    def step(self, name, func, *args, **kw):
+        """Time one request of a purchase, returning the response or None."""
+        start = time.time()
+        try:
+            res = func(*args, **kw)
+        except Exception:
+            log.exception('Load test step {0} failed'.format(name))
+            self.record(name, start, ok=False)
+            return None
+        ok = res.status_code < 400
+        self.record(name, start, ok=ok)
+        return res if ok else None
+
+    def purchase(self, client):
+        """Make one purchase, returning True if it completed."""
+        res = self.step('pay', client.post, reverse('api:pay'),
+                        {'req': self.pay_request()},
+                        HTTP_ACCEPT='application/json')
+        if res is None:
+            return False
+
+        start = time.time()
+        for poll in range(self.max_polls):
+            res = client.get(reverse('api:pay.trans_start_url'))
+            if res.status_code >= 400:
+                pay_url = None
+                break
+            pay_url = json.loads(res.content)['url']
+            if pay_url:
+                break
+        self.record('trans_start_url', start, ok=bool(pay_url))
+        if not pay_url:
+            return False
+
+        notices = self.app.notices
+        res = self.step('success', client.get,
+                        reverse('provider.success', args=['reference']),
+                        {'ext_transaction_id': client.session['trans_id']})
+        return res is not None and self.app.notices > notices
+
+    def buyer(self, purchases):
+        client = self.login()
+        for i in range(purchases):
+            if self.purchase(client):
+                with self.lock:
+                    self.completed += 1
+
+    def task_prerun(self, task_id=None, **kw):
+        self._task_started[task_id] = time.time()
+
+    def task_postrun(self, task_id=None, task=None, state=None, **kw):
+        start = self._task_started.pop(task_id, None)
+        step = 'task:{0}'.format(task.name.split('.')[-1])
+        if start and step in self.times:
+            self.record(step, start, ok=state == 'SUCCESS')
+
+    @contextlib.contextmanager
+    def installed(self):
+        """Install the fakes and run tasks eagerly while in use."""
+        eager = current_app.conf.CELERY_ALWAYS_EAGER
+        current_app.conf.CELERY_ALWAYS_EAGER = True
+        task_prerun.connect(self.task_prerun)
+        task_postrun.connect(self.task_postrun)
+        session = dispatcher.session
+        session.mount(APP_URL, self.app)
+        try:
+            with override_settings(PAYMENT_PROVIDER='reference'):
+                with self.solitude.installed(solitude):
+                    with self.marketplace.installed(marketplace):
+                        yield
+        finally:
+            session.adapters.pop(host_prefix(APP_URL), None)
+            task_prerun.disconnect(self.task_prerun)
+            task_postrun.disconnect(self.task_postrun)
+            current_app.conf.CELERY_ALWAYS_EAGER = eager
+
+    def run(self):
+        """Make the purchases and return a report, see report()."""
+        share, extra = divmod(self.purchases, self.concurrency)
+        threads = [threading.Thread(target=self.buyer,
+                                    args=(share + (1 if i < extra else 0),))
+                   for i in range(self.concurrency)]
+        with self.installed():
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        """
+        Return a dict of the results:
+
+        * purchases, completed: purchases attempted and completed.
+        * seconds, throughput: the time taken and completed purchases per
+          second.
+        * steps: for each step the count, errors and p50, p95 and p99
+          latencies in milliseconds.
+        * solitude_calls, marketplace_calls: requests per purchase.
+        """
+        steps = {}
+        for step in STEPS:
+            times = self.times[step]
+            steps[step] = {'count': len(times), 'errors': self.errors[step]}
+            for pct in (50, 95, 99):
+                steps[step]['p{0}'.format(pct)] = percentile(times, pct)
+        purchases = float(self.purchases or 1)
+        return {
+            'purchases': self.purchases,
+            'completed': self.completed,
+            'seconds': elapsed,
+            'throughput': self.completed / elapsed if elapsed else 0,
+            'steps': steps,
+            'solitude_calls': len(self.solitude.requests) / purchases,
+            'marketplace_calls': len(self.marketplace.requests) / purchases,
+        }
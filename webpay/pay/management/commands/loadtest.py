@@ -0,0 +1,57 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from webpay.pay.loadtest import LoadTest, STEPS
+
+
+class Command(BaseCommand):
+    help = ('Make purchases end to end against in-process stand-ins for '
+            'Solitude and Marketplace and report how long each step took.')
+    option_list = BaseCommand.option_list + (
+        make_option('--purchases', type='int', default=100,
+                    help='Purchases to make. Default: %default'),
+        make_option('--concurrency', type='int', default=1,
+                    help='Buyers purchasing at the same time. '
+                         'Default: %default'),
+        make_option('--latency', type='float', default=0,
+                    help='Milliseconds Solitude and Marketplace take to '
+                         'answer. Default: %default'),
+        make_option('--error-rate', type='float', default=0,
+                    help='Fraction of Solitude and Marketplace requests that '
+                         'fail with a 500. Default: %default'),
+        make_option('--max-polls', type='int', default=10,
+                    help='Times to ask for the pay URL before giving up. '
+                         'Default: %default'),
+    )
+
+    def handle(self, *args, **options):
+        if options['purchases'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--purchases and --concurrency must be at '
+                               'least 1')
+        if not 0 <= options['error_rate'] <= 1:
+            raise CommandError('--error-rate must be between 0 and 1')
+
+        report = LoadTest(purchases=options['purchases'],
+                          concurrency=options['concurrency'],
+                          latency=options['latency'] / 1000.0,
+                          error_rate=options['error_rate'],
+                          max_polls=options['max_polls']).run()
+
+        self.stdout.write(
+            '{completed} of {purchases} purchases completed in '
+            '{seconds:.2f}s, {throughput:.2f} purchases/s'.format(**report))
+        self.stdout.write('Solitude calls per purchase: {0:.1f}'
+                          .format(report['solitude_calls']))
+        self.stdout.write('Marketplace calls per purchase: {0:.1f}'
+                          .format(report['marketplace_calls']))
+        self.stdout.write('')
+        self.stdout.write('{0:<22} {1:>6} {2:>6} {3:>9} {4:>9} {5:>9}'.format(
+            'step', 'count', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+        for step in STEPS:
+            stats = report['steps'][step]
+            if not stats['count']:
+                continue
+            self.stdout.write(
+                '{0:<22} {count:>6} {errors:>6} {p50:>9.1f} {p95:>9.1f} '
+                '{p99:>9.1f}'.format(step, **stats))
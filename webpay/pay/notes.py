@@ -0,0 +1,81 @@
+"""
+Keep the notes of a purchase small in the session.
+
+The session lives in an encrypted cookie so everything in it is sent,
+decrypted and encrypted again on every request. The verified pay request
+is by far the biggest part of the notes, so when COMPACT_SESSION_NOTES is
+True it is kept in the shared cache and the session only holds a
+reference to it and the few fields that views read directly. Use
+get_notes() to get the complete notes, for example to hand them to a
+task.
+"""
+import copy
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_statsd.clients import statsd
+
+from webpay.base import dev_messages as msg
+from webpay.base.logger import getLogger
+
+log = getLogger('w.pay.notes')
+
+# The fields of the pay request kept in the session, as (section, key).
+SESSION_FIELDS = (('request', 'pricePoint'), ('request', 'simulate'))
+
+
+class PayRequestMissing(Exception):
+    """The pay request referenced by the session is no longer stored."""
+    error_code = msg.PAY_REQUEST_MISSING
+
+
+def pay_request_key(ref):
+    return '{0}:pay_request:{1}'.format(settings.CACHE_PREFIX, ref)
+
+
+def compact_pay_request(pay_req):
+    """Return the part of a pay request that is kept in the session."""
+    compact = {'iss': pay_req.get('iss')}
+    for section, key in SESSION_FIELDS:
+        if key in pay_req.get(section, {}):
+            compact.setdefault(section, {})[key] = pay_req[section][key]
+    return compact
+
+
+def set_pay_request(request, notes, pay_req):
+    """
+    Save a verified pay request into notes and notes into the session.
+    """
+    notes = notes.copy()
+    if settings.COMPACT_SESSION_NOTES:
+        ref = uuid.uuid4().hex
+        cache.set(pay_request_key(ref), pay_req, settings.SESSION_COOKIE_AGE)
+        notes['pay_request_ref'] = ref
+        notes['pay_request'] = compact_pay_request(pay_req)
+    else:
+        notes.pop('pay_request_ref', None)
+        notes['pay_request'] = pay_req
+    request.session['notes'] = notes
+
+
+def get_notes(request):
+    """
+    Return a copy of the notes in the session with the complete pay
+    request.
+
+    :raises PayRequestMissing: if the pay request has been evicted from
+        the cache.
+    """
+    notes = copy.deepcopy(request.session.get('notes', {}))
+    ref = notes.pop('pay_request_ref', None)
+    if ref:
+        pay_req = cache.get(pay_request_key(ref))
+        if pay_req is None:
+            # The session outlived the cache entry.
+            log.error('Pay request {0} is no longer stored'.format(ref))
+            statsd.incr('purchase.notes.pay_request_missing')
+            raise PayRequestMissing(ref)
+        notes['pay_request'] = pay_req
+    return notes
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import sys
@@ -5,10 +6,12 @@ import urlparse
 import uuid
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 
 from celeryutils import task
+from django_statsd.clients import statsd
 import jwt
 from lib.marketplace.api import client as mkt_client, UnknownPricePoint
 from lib.solitude import constants
@@ -20,7 +23,8 @@ from webpay.base.utils import gmtime, uri_to_pk
 from webpay.constants import TYP_CHARGEBACK, TYP_POSTBACK
 from webpay.pay.errors import InvalidPublicID, NoValidSeller
 from .constants import NOT_SIMULATED, SIMULATED_POSTBACK, SIMULATED_CHARGEBACK
-from .utils import send_pay_notice, trans_id
+from .notes import get_notes, PayRequestMissing
+from .utils import get_issuer_product, send_pay_notice, trans_id
 
 log = logging.getLogger('w.pay.tasks')
 notify_kw = dict(default_retry_delay=15,  # seconds
@@ -83,35 +87,42 @@ def configure_transaction(request, trans=None, mcc=None, mnc=None):
                  % (request.session['trans_id'], trans.get('status')))
         return (False, None)
 
+    try:
+        notes = get_notes(request)
+    except PayRequestMissing, exc:
+        return (False, exc.error_code)
+
     # Prevent configuration from running twice.
     request.session['configured_trans'] = request.session['trans_id']
 
     # Localize the product before sending it off to solitude/bango.
-    _localize_pay_request(request)
+    _localize_pay_request(request, notes)
 
     log.info('configuring payment in background for trans {t} (status={s}); '
              'Last configured: {c}'.format(t=request.session['trans_id'],
                                            s=trans.get('status'),
                                            c=last_configured))
 
-    network = request.session['notes'].get('network', {})
+    network = notes.get('network', {})
     providers = ProviderHelper.supported_providers(
         mcc=network.get('mcc'),
         mnc=network.get('mnc'),
     )
 
     start_pay.delay(request.session['trans_id'],
-                    request.session['notes'],
+                    notes,
                     request.session['uuid'],
                     [p.name for p in providers])
 
     return (True, None)
 
 
-def _localize_pay_request(request):
+def _localize_pay_request(request, notes=None):
+    if notes is None:
+        notes = request.session.get('notes', {})
     if hasattr(request, 'locale'):
         try:
-            pay_req = request.session['notes']['pay_request']
+            pay_req = notes['pay_request']
             req = pay_req['request']
         except KeyError:
             return
@@ -139,13 +150,19 @@ def _localize_pay_request(request):
             req['description'] = loc.get('description') or req['description']
 
 
-def get_secret(issuer_key):
-    """Resolve the secret for this JWT."""
+def get_secret(issuer_key, fresh=False):
+    """
+    Resolve the secret for this JWT.
+
+    Pass fresh=True to look the secret up in Solitude instead of the
+    issuer cache, for example when the app turned down a notice signed
+    with the cached secret.
+    """
     if is_marketplace(issuer_key):
         return settings.SECRET
     else:
-        return (client.slumber.generic.product
-                      .get_object_or_404(public_id=issuer_key))['secret']
+        return get_issuer_product(issuer_key, active_only=False,
+                                  fresh=fresh)['secret']
 
 
 def get_provider_seller_uuid(issuer_key, product_data, provider_names):
@@ -192,13 +209,16 @@ def get_best_provider(price_point, seller_uuids, provider_names):
                          s='found' if provider_seller_uuid else 'NOT FOUND'))
 
         if provider_seller_uuid:
+            # Tiers come from the price index or the shared price cache
+            # before zamboni, so the tier that process_pay_req validated
+            # is not fetched again.
             prices = mkt_client.get_price(price_point, provider=provider)
             if not prices['prices']:
                 log.info('No prices for provider: {p}'.format(p=provider))
                 continue
 
             log.info('Price found for provider: {p}' .format(p=provider))
-            return ProviderHelper(provider), provider_seller_uuid, prices
+            return ProviderHelper.get(provider), provider_seller_uuid, prices
 
     raise NoValidSeller(
         'Unable to find a valid seller_uuid '
@@ -243,6 +263,7 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
     product_data = urlparse.parse_qs(pay['request'].get('productData', ''))
     provider_helper, provider_seller_uuid, generic_seller_uuid = (
         None, None, None)
+    trans = None
 
     try:
         product, seller, generic_seller_uuid = get_provider_seller_uuid(
@@ -270,7 +291,7 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
             icon_url = None
         log.info('icon URL for %s: %s' % (transaction_uuid, icon_url))
 
-        bill_id, pay_url, seller_id = provider_helper.start_transaction(
+        bill_id, pay_url, seller_id, trans = provider_helper.start_transaction(
             transaction_uuid=transaction_uuid,
             generic_seller_uuid=generic_seller_uuid,
             provider_seller_uuid=provider_seller_uuid,
@@ -282,11 +303,10 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
             application_size=application_size,
             source=source,
             mcc=network.get('mcc'),
-            mnc=network.get('mnc')
+            mnc=network.get('mnc'),
+            generic_seller=seller,
         )
-        trans_pk = client.slumber.generic.transaction.get_object(
-            uuid=transaction_uuid)['resource_pk']
-        client.slumber.generic.transaction(trans_pk).patch({
+        client.slumber.generic.transaction(trans['resource_pk']).patch({
             'notes': json.dumps(notes),
             'uid_pay': bill_id,
             'pay_url': pay_url,
@@ -305,6 +325,7 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
                 provider_helper=provider_helper,
                 source=source,
                 transaction_uuid=transaction_uuid,
+                transaction=trans,
             )
         except:
             log.exception('while recording reason for failure {t}'
@@ -317,20 +338,25 @@ def pay_error_handler(
         error_type,
         provider_helper,
         source,
-        transaction_uuid):
+        transaction_uuid,
+        transaction=None):
     """
     Record a transaction error into solitude. At this point the transaction
-    may, or may not exist in solitude.
+    may, or may not exist in solitude. If the caller has the transaction
+    it can pass it as `transaction` to save looking it up.
 
     Unfortunately many things (buyer, seller, seller_product) are buried inside
     start_transaction, which might need its own wrapper.
     """
     pk = None
     api = client.slumber.generic.transaction
-    try:
-        pk = api.get_object_or_404(uuid=transaction_uuid)['resource_pk']
-    except ObjectDoesNotExist:
-        pass
+    if transaction:
+        pk = transaction['resource_pk']
+    else:
+        try:
+            pk = api.get_object_or_404(uuid=transaction_uuid)['resource_pk']
+        except ObjectDoesNotExist:
+            pass
 
     # If the provider_helper is None, then no provider was found.
     provider = None
@@ -380,8 +406,10 @@ def payment_notify(transaction_uuid, **kw):
     :param response.price: object that contains the amount and currency the
       customer actually paid in.
     """
+    if _resend_notice(payment_notify, transaction_uuid, TYP_POSTBACK):
+        return
     transaction = client.get_transaction(transaction_uuid)
-    _notify(payment_notify, transaction)
+    _notify(payment_notify, transaction, reuse=False)
 
 
 @task(**notify_kw)
@@ -396,9 +424,13 @@ def chargeback_notify(transaction_uuid, **kw):
     trans_id: pk of Transaction
     reason: either 'reversal' or 'refund'
     """
+    extra_response = {'reason': kw.get('reason', '')}
+    if _resend_notice(chargeback_notify, transaction_uuid, TYP_CHARGEBACK,
+                      extra_response):
+        return
     transaction = client.get_transaction(transaction_uuid)
-    _notify(chargeback_notify, transaction,
-            extra_response={'reason': kw.get('reason', '')})
+    _notify(chargeback_notify, transaction, extra_response=extra_response,
+            reuse=False)
 
 
 def _fake_amount(price_point):
@@ -518,17 +550,87 @@ def get_icon_url(request):
 
 
 def _notify(notifier_task, trans, extra_response=None, simulated=NOT_SIMULATED,
-            task_args=None):
+            task_args=None, reuse=True):
     """
     Post JWT notice to an app server about a payment.
+
+    On a retry the notice signed by an earlier attempt is sent again. Pass
+    reuse=False when _resend_notice() already found there isn't one.
     """
     # TODO(Kumar) yell if transaction is not completed?
     typ, url = _prepare_notice(trans)
-    response = {'transactionID': trans['uuid']}
-    notes = trans['notes']
     if not task_args:
         task_args = [trans['uuid']]
 
+    # See send_pay_notice() for when a retry signs the notice again.
+    resign = (notifier_task.request.kwargs or {}).get('resign', False)
+    signed_notice = _sign_notice(
+        trans, typ, url, extra_response,
+        retrying=reuse and notifier_task.request.retries > 0 and not resign,
+        fresh_secret=resign)
+    send_pay_notice(url, trans['type'], signed_notice, trans['uuid'],
+                    notifier_task, task_args, simulated=simulated)
+
+
+def _notice_key(trans_uuid, typ, extra_response=None):
+    # Chargebacks of the same transaction differ by their reason.
+    extra = hashlib.md5(json.dumps(extra_response or {}, sort_keys=True))
+    return 'notice:{0}:{1}:{2}'.format(trans_uuid, typ, extra.hexdigest())
+
+
+def _cached_notice(trans_uuid, typ, extra_response=None):
+    """
+    Return the notice signed for the transaction by an earlier attempt,
+    or None if there isn't one or it is close to expiring.
+    """
+    if not settings.CACHE_SIGNED_NOTICES:
+        return None
+    cached = cache.get(_notice_key(trans_uuid, typ, extra_response))
+    if cached and cached['exp'] - gmtime() > settings.NOTICE_RESIGN_MARGIN:
+        statsd.incr('purchase.notice_cache.hit')
+        return cached
+    statsd.incr('purchase.notice_cache.miss')
+    return None
+
+
+def _resend_notice(notifier_task, trans_uuid, typ, extra_response=None):
+    """
+    Send the notice signed by an earlier attempt of notifier_task again,
+    without looking the transaction up. Returns False if this isn't a
+    retry or there is no notice to send.
+
+    The first attempt always signs a new notice so that the transaction
+    is up to date, and so does a retry after the app turned it down.
+    """
+    if (not notifier_task.request.retries or
+            (notifier_task.request.kwargs or {}).get('resign')):
+        return False
+    cached = _cached_notice(trans_uuid, typ, extra_response)
+    if not cached:
+        return False
+    log.info('resending notice for {0}'.format(trans_uuid))
+    send_pay_notice(cached['url'], cached['type'], cached['notice'],
+                    trans_uuid, notifier_task, [trans_uuid])
+    return True
+
+
+def _sign_notice(trans, typ, url, extra_response=None, retrying=False,
+                 fresh_secret=False):
+    """
+    Return the signed JWT notice for a transaction.
+
+    The signed notice is kept for retries of the same notice so that they
+    send the same bytes; it is only signed again when close to expiring.
+    Pass retrying=True to reuse it and fresh_secret=True to sign it with
+    a secret looked up in Solitude rather than the issuer cache.
+    """
+    if retrying:
+        cached = _cached_notice(trans['uuid'], typ, extra_response)
+        if cached:
+            return cached['notice']
+
+    notes = trans['notes']
+    response = {'transactionID': trans['uuid']}
     if extra_response:
         response.update(extra_response)
 
@@ -546,10 +648,15 @@ def _notify(notifier_task, trans, extra_response=None, simulated=NOT_SIMULATED,
               'response': response}
     log.info('preparing notice %s' % notice)
 
-    signed_notice = jwt.encode(notice, get_secret(notes['issuer_key']),
-                               algorithm='HS256')
-    send_pay_notice(url, trans['type'], signed_notice, trans['uuid'],
-                    notifier_task, task_args, simulated=simulated)
+    signed_notice = jwt.encode(
+        notice, get_secret(notes['issuer_key'], fresh=fresh_secret),
+        algorithm='HS256')
+    if settings.CACHE_SIGNED_NOTICES:
+        cache.set(_notice_key(trans['uuid'], typ, extra_response),
+                  {'exp': notice['exp'], 'notice': signed_notice,
+                   'url': url, 'type': trans['type']},
+                  notice['exp'] - issued_at)
+    return signed_notice
 
 
 def _prepare_notice(trans):
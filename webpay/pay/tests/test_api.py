@@ -17,6 +17,7 @@ from lib.solitude import constants
 from lib.solitude.constants import STATUS_PENDING
 from webpay.api.tests.base import BaseAPICase
 from webpay.base import dev_messages as msg
+from webpay.pay.notes import get_notes
 from webpay.pay.tests import Base, sample
 
 
@@ -107,6 +108,30 @@ class TestPay(PayTester):
                                             app_secret=self.secret + 'nope'))
         eq_(res.status_code, 400, res)
 
+    @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
+    def test_inapp_rotated_secret(self, get_active_product):
+        get_active_product.return_value = {
+            'secret': 'old.secret', 'access': constants.ACCESS_PURCHASE}
+        self.post(request_kwargs=dict(iss=self.key, app_secret='old.secret'))
+        self.set_secret(get_active_product)
+        res = self.post(request_kwargs=dict(iss=self.key,
+                                            app_secret=self.secret))
+        eq_(res.status_code, 200, res)
+        eq_(get_active_product.call_count, 2)
+
+    @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
+    def test_inapp_forged_keeps_cache(self, get_active_product):
+        self.set_secret(get_active_product)
+        for i in range(2):
+            res = self.post(request_kwargs=dict(iss=self.key,
+                                                app_secret='forged'))
+            self.assert_error_code(res, msg.INVALID_JWT)
+        res = self.post(request_kwargs=dict(iss=self.key,
+                                            app_secret=self.secret))
+        eq_(res.status_code, 200, res)
+        # One lookup to cache the issuer and one to check each forgery.
+        eq_(get_active_product.call_count, 3)
+
     @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
     def test_inapp_wrong_key(self, get_active_product):
         get_active_product.side_effect = ObjectDoesNotExist
@@ -129,9 +154,24 @@ class TestPay(PayTester):
         res = self.post(req=req)
 
         eq_(res.status_code, 200)
-        req = self.client.session['notes']['pay_request']['request']
+        req = get_notes(self.client)['pay_request']['request']
         eq_(len(req['locales']['it']['description']), 255)
 
+    def test_compact_session_notes(self):
+        eq_(self.post(req=self.request()).status_code, 200)
+        notes = self.client.session['notes']
+        eq_(notes['pay_request']['request'].keys(), ['pricePoint'])
+        eq_(get_notes(self.client)['pay_request']['request']['name'],
+            self.payload()['request']['name'])
+
+    @override_settings(COMPACT_SESSION_NOTES=False)
+    def test_full_session_notes(self):
+        eq_(self.post(req=self.request()).status_code, 200)
+        notes = self.client.session['notes']
+        eq_(notes['pay_request']['request']['name'],
+            self.payload()['request']['name'])
+        assert 'pay_request_ref' not in notes
+
     def test_handle_none_type_locale_description(self):
         payjwt = self.payload()
         payjwt['request']['defaultLocale'] = 'en'
@@ -151,7 +191,7 @@ class TestPay(PayTester):
         res = self.post(req=req)
 
         eq_(res.status_code, 200)
-        req = self.client.session['notes']['pay_request']['request']
+        req = get_notes(self.client)['pay_request']['request']
         eq_(len(req['description']), 255)
         assert req['description'].endswith('...'), 'ellipsis added'
 
@@ -238,6 +278,10 @@ class TestBadPayRequests(PayTester):
     def test_non_ascii_jwt(self):
         self.assert_error_code(self.post(req=u'Հ'), msg.JWT_DECODE_ERR)
 
+    def test_jwt_too_large(self):
+        with self.settings(JWT_MAX_LENGTH=10):
+            self.assert_error_code(self.post(), msg.JWT_TOO_LARGE)
+
     def test_missing_tier(self):
         payjwt = self.payload()
         del payjwt['request']['pricePoint']
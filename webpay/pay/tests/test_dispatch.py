@@ -0,0 +1,163 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_, raises
+
+from webpay.base.tests import TestCase
+from webpay.pay.dispatch import CircuitBreaker, HostBusy, NoticeDispatcher
+
+
+@mock.patch('requests.Session.post')
+class TestNoticeDispatcher(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.dispatcher = NoticeDispatcher()
+
+    def config(self, **kw):
+        return dict(settings.NOTICE_DISPATCHER, **kw)
+
+    def test_post(self, post):
+        res = self.dispatcher.post('https://app.com/postback', {'notice': 'x'})
+        eq_(res, post.return_value)
+        post.assert_called_with('https://app.com/postback', {'notice': 'x'},
+                                timeout=5)
+
+    def test_session_reused(self, post):
+        eq_(self.dispatcher.session, self.dispatcher.session)
+
+    @raises(HostBusy)
+    def test_host_busy(self, post):
+        with self.settings(NOTICE_DISPATCHER=self.config(max_per_host=1)):
+            assert self.dispatcher.acquire('https://app.com/')
+            self.dispatcher.post('https://APP.com/chargeback', {})
+
+    def test_busy_across_workers(self, post):
+        # Another worker process has its own dispatcher.
+        other = NoticeDispatcher()
+        with self.settings(NOTICE_DISPATCHER=self.config(max_per_host=1)):
+            assert other.acquire('https://app.com/')
+            with self.assertRaises(HostBusy):
+                self.dispatcher.post('https://app.com/postback', {})
+            other.release('https://app.com/')
+            self.dispatcher.post('https://app.com/postback', {})
+        eq_(post.call_count, 1)
+
+    def test_other_host_not_busy(self, post):
+        with self.settings(NOTICE_DISPATCHER=self.config(max_per_host=1)):
+            self.dispatcher.acquire('https://app.com/')
+            self.dispatcher.post('https://other.com/postback', {})
+        assert post.called
+
+    def test_released(self, post):
+        post.side_effect = ValueError
+        with self.settings(NOTICE_DISPATCHER=self.config(max_per_host=1)):
+            for i in range(2):
+                with self.assertRaises(ValueError):
+                    self.dispatcher.post('https://app.com/postback', {})
+
+    def test_busy_released(self, post):
+        with self.settings(NOTICE_DISPATCHER=self.config(max_per_host=1)):
+            self.dispatcher.acquire('https://app.com/')
+            for i in range(2):
+                with self.assertRaises(HostBusy):
+                    self.dispatcher.post('https://app.com/postback', {})
+            eq_(cache.get(self.dispatcher.key('https://app.com/')), 1)
+
+    def test_expired_release(self, post):
+        self.dispatcher.release('https://app.com/')
+
+
+@override_settings(POSTBACK_BREAKER_ENABLED=True,
+                   POSTBACK_BREAKER={'window': 60, 'min_requests': 4,
+                                     'failure_rate': 0.5, 'open_for': 60,
+                                     'probes': 2, 'probe_timeout': 30})
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker()
+        self.url = 'https://app.com/postback'
+        self.host = 'https://app.com/'
+
+    def fail(self, times):
+        for i in range(times):
+            self.breaker.record(self.url, success=False)
+
+    def half_open(self):
+        self.fail(4)
+        cache.set(self.breaker.key(self.host, 'open'), time.time() - 1)
+
+    def test_non_ascii_host(self):
+        url = u'https://\u0430pp.com/postback'
+        self.breaker.record(url, success=False)
+        assert self.breaker.allow(url)
+
+    def test_closed(self):
+        self.fail(3)
+        eq_(self.breaker.state(self.host), CircuitBreaker.closed)
+        assert self.breaker.allow(self.url)
+
+    def test_open(self):
+        self.fail(4)
+        eq_(self.breaker.state(self.host), CircuitBreaker.open)
+        assert not self.breaker.allow('https://APP.com/chargeback')
+        assert self.breaker.allow('https://other.com/postback')
+
+    def test_failure_rate(self):
+        for i in range(3):
+            self.breaker.record(self.url, success=True)
+        self.fail(2)
+        eq_(self.breaker.state(self.host), CircuitBreaker.closed)
+
+    def test_one_probe_at_a_time(self):
+        self.half_open()
+        eq_(self.breaker.state(self.host), CircuitBreaker.half_open)
+        assert self.breaker.allow(self.url)
+        assert not self.breaker.allow(self.url)
+
+    def test_probes_close(self):
+        self.half_open()
+        for i in range(2):
+            assert self.breaker.allow(self.url)
+            self.breaker.record(self.url, success=True)
+        eq_(self.breaker.state(self.host), CircuitBreaker.closed)
+        eq_(self.breaker.states(), {})
+
+    def test_probe_fails(self):
+        self.half_open()
+        assert self.breaker.allow(self.url)
+        self.breaker.record(self.url, success=False)
+        eq_(self.breaker.state(self.host), CircuitBreaker.open)
+
+    def test_release_probe(self):
+        self.half_open()
+        assert self.breaker.allow(self.url)
+        self.breaker.release(self.url)
+        assert self.breaker.allow(self.url)
+
+    def test_release_closed(self):
+        cache.set(self.breaker.key(self.host, 'probe'), 1)
+        self.breaker.release(self.url)
+        assert cache.get(self.breaker.key(self.host, 'probe'))
+
+    def test_retry_in_open(self):
+        self.fail(4)
+        assert 0 < self.breaker.retry_in(self.url) <= 61
+
+    def test_retry_in_half_open(self):
+        self.half_open()
+        eq_(self.breaker.retry_in(self.url), 30)
+
+    def test_states(self):
+        self.fail(4)
+        eq_(self.breaker.states(), {self.host: CircuitBreaker.open})
+
+    def test_disabled(self):
+        with self.settings(POSTBACK_BREAKER_ENABLED=False):
+            self.fail(4)
+            assert self.breaker.allow(self.url)
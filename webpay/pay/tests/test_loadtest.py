@@ -0,0 +1,76 @@
+from StringIO import StringIO
+import urllib
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+import jwt
+from nose.tools import eq_, raises
+from requests import Request
+
+from webpay.pay.loadtest import APP_URL, FakeApp, LoadTest, percentile, STEPS
+
+
+class TestPercentile(TestCase):
+
+    def test_percentiles(self):
+        values = range(1, 101)
+        eq_(percentile(values, 50), 50)
+        eq_(percentile(values, 95), 95)
+        eq_(percentile(values, 99), 99)
+
+    def test_small(self):
+        eq_(percentile([3, 1], 99), 3)
+        eq_(percentile([3, 1], 50), 1)
+
+    def test_empty(self):
+        eq_(percentile([], 50), None)
+
+
+class TestFakeApp(TestCase):
+
+    def test_answers_notice(self):
+        notice = jwt.encode({'response': {'transactionID': 'trans:1'}},
+                            'secret')
+        request = Request('POST', APP_URL + 'postback',
+                          data=urllib.urlencode({'notice': notice}))
+        app = FakeApp()
+        res = app.send(request.prepare())
+        eq_(res.text, 'trans:1')
+        eq_(app.notices, 1)
+
+
+class TestLoadTest(TestCase):
+
+    def test_run(self):
+        test = LoadTest(purchases=3, concurrency=2)
+        report = test.run()
+        eq_(report['purchases'], 3)
+        eq_(report['completed'], 3)
+        eq_(test.app.notices, 3)
+        eq_(sorted(report['steps']), sorted(STEPS))
+        for step in ('pay', 'trans_start_url', 'success'):
+            eq_(report['steps'][step]['count'], 3)
+            eq_(report['steps'][step]['errors'], 0)
+            assert report['steps'][step]['p99'] is not None
+        assert report['throughput'] > 0
+        assert report['solitude_calls'] > 0
+
+    def test_errors(self):
+        report = LoadTest(purchases=2, error_rate=1).run()
+        eq_(report['completed'], 0)
+        eq_(report['steps']['success']['count'], 0)
+
+
+class TestLoadTestCommand(TestCase):
+
+    def test_report(self):
+        out = StringIO()
+        call_command('loadtest', purchases=1, stdout=out)
+        assert '1 of 1 purchases completed' in out.getvalue()
+        assert 'Solitude calls per purchase' in out.getvalue()
+
+    @raises(CommandError)
+    def test_no_purchases(self):
+        call_command('loadtest', purchases=0, stdout=StringIO())
@@ -0,0 +1,57 @@
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from nose.tools import eq_, raises
+
+from webpay.pay.notes import get_notes, PayRequestMissing, set_pay_request
+
+
+@override_settings(COMPACT_SESSION_NOTES=True)
+class TestNotes(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+        self.pay_req = {'iss': 'issuer', 'aud': 'webpay',
+                        'request': {'pricePoint': '1', 'name': 'Sword',
+                                    'description': 'A fancy sword',
+                                    'locales': {'de': {'name': 'Schwert'}}}}
+
+    def test_compact(self):
+        set_pay_request(self.request, {'issuer_key': 'key'}, self.pay_req)
+        notes = self.request.session['notes']
+        eq_(notes['pay_request'],
+            {'iss': 'issuer', 'request': {'pricePoint': '1'}})
+        eq_(notes['issuer_key'], 'key')
+        assert notes['pay_request_ref']
+
+    def test_simulate(self):
+        self.pay_req['request']['simulate'] = {'result': 'postback'}
+        set_pay_request(self.request, {}, self.pay_req)
+        eq_(self.request.session['notes']['pay_request']['request'],
+            {'pricePoint': '1', 'simulate': {'result': 'postback'}})
+
+    def test_get_notes(self):
+        set_pay_request(self.request, {'issuer_key': 'key'}, self.pay_req)
+        eq_(get_notes(self.request),
+            {'issuer_key': 'key', 'pay_request': self.pay_req})
+
+    def test_get_notes_copy(self):
+        set_pay_request(self.request, {}, self.pay_req)
+        get_notes(self.request)['network'] = {'mcc': '123'}
+        assert 'network' not in self.request.session['notes']
+
+    @raises(PayRequestMissing)
+    def test_missing(self):
+        set_pay_request(self.request, {}, self.pay_req)
+        cache.clear()
+        get_notes(self.request)
+
+    def test_not_compact(self):
+        with self.settings(COMPACT_SESSION_NOTES=False):
+            set_pay_request(self.request, {}, self.pay_req)
+        eq_(self.request.session['notes'], {'pay_request': self.pay_req})
+        eq_(get_notes(self.request), {'pay_request': self.pay_req})
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import contextlib
+from datetime import datetime
 import urllib2
 from urllib import urlencode
 
@@ -25,6 +27,7 @@ from webpay.base.tests import TestCase
 from webpay.base.utils import gmtime
 from webpay.constants import TYP_CHARGEBACK, TYP_POSTBACK
 from webpay.pay import tasks
+from webpay.pay.dispatch import HostBusy
 from webpay.pay.errors import InvalidPublicID, NoValidSeller
 from webpay.pay.samples import JWTtester
 
@@ -53,7 +56,7 @@ class NotifyTest(JWTtester, TestCase):
         return protocol + '://' + self.domain + path
 
 
-class TestNotifyApp(NotifyTest):
+class NotifyAppTest(NotifyTest):
 
     def transaction(self, amount=1, currency='USD',
                     status=constants.STATUS_COMPLETED, payload=None,
@@ -81,7 +84,10 @@ class TestNotifyApp(NotifyTest):
         with self.settings(INAPP_KEY_PATHS={None: sample}, DEBUG=True):
             tasks.payment_notify('some:uuid')
 
-    @fudge.patch('webpay.pay.utils.requests')
+
+class TestNotifyApp(NotifyAppTest):
+
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_pay(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -106,7 +112,7 @@ class TestNotifyApp(NotifyTest):
 
         self.notify(payload=payload)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_refund_chargeback(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -131,7 +137,7 @@ class TestNotifyApp(NotifyTest):
 
         self.do_chargeback('refund')
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_reversal_chargeback(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -149,26 +155,26 @@ class TestNotifyApp(NotifyTest):
                                  .expects('raise_for_status'))
         self.do_chargeback('reversal')
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
-    def test_notify_marketplace(self, marketplace, solitude, requests):
+    def test_notify_marketplace(self, marketplace, solitude, dispatcher):
         self.set_secret_mock(solitude, 'f')
-        requests.post.side_effect = Timeout('Timeout')
+        dispatcher.post.side_effect = Timeout('Timeout')
         self.notify()
         assert marketplace.webpay.failure.called
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
-    def test_notify_timeout(self, marketplace, solitude, requests):
+    def test_notify_timeout(self, marketplace, solitude, dispatcher):
         self.set_secret_mock(solitude, 'f')
-        requests.post.side_effect = Timeout('Timeout')
+        dispatcher.post.side_effect = Timeout('Timeout')
         self.notify()
 
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
     def test_retry_http_error(self, post, retry, slumber):
         self.set_secret_mock(slumber, 'f')
         post.side_effect = RequestException('500 error')
@@ -176,7 +182,7 @@ class TestNotifyApp(NotifyTest):
         assert post.called, 'notification was sent'
         assert retry.called, 'task should be retried after error'
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_any_error(self, fake_req, marketplace, solitude):
@@ -184,7 +190,7 @@ class TestNotifyApp(NotifyTest):
         fake_req.expects('post').raises(RequestException('some http error'))
         self.notify()
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_bad_status(self, fake_req, marketplace, solitude):
@@ -197,43 +203,121 @@ class TestNotifyApp(NotifyTest):
         self.notify()
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
-    def test_notify_retries(self, retry, requests, slumber):
+    def test_notify_retries(self, retry, dispatcher, slumber):
         self.set_secret_mock(slumber, 'f')
-        requests.post.side_effect = RequestException('some http error')
+        dispatcher.post.side_effect = RequestException('some http error')
         self.notify()
         assert retry.called, 'task should be retried after error'
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
-    def test_notify_wrong(self, retry, requests, slumber):
+    def test_notify_wrong(self, retry, dispatcher, slumber):
         self.set_secret_mock(slumber, 'f')
-        requests.post.return_value.text = '<not a valid response>'
+        dispatcher.post.return_value.text = '<not a valid response>'
         self.notify()
         assert retry.called, 'task should be retried after error'
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
-    def test_trim_notices(self, retry, requests, slumber):
+    def test_trim_notices(self, retry, dispatcher, slumber):
         self.set_secret_mock(slumber, 'f')
         # Add whitespace around transaction ID:
-        requests.post.return_value.text = '\n{0} \n'.format(self.trans_uuid)
+        dispatcher.post.return_value.text = '\n{0} \n'.format(self.trans_uuid)
         self.notify()
         assert not retry.called, 'task should not be retried on success'
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
+    @mock.patch('webpay.pay.utils.breaker')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    def test_circuit_open(self, retry, breaker, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        breaker.allow.return_value = False
+        breaker.retry_in.return_value = 60
+        self.notify()
+        assert not dispatcher.post.called, 'notice should not be sent'
+        assert not breaker.record.called, 'host did not fail'
+        assert retry.called, 'task should be retried after error'
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher')
+    @mock.patch('webpay.pay.utils.breaker')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    def test_circuit_open_not_an_attempt(self, retry, breaker, dispatcher,
+                                         slumber):
+        self.set_secret_mock(slumber, 'f')
+        breaker.allow.return_value = False
+        breaker.retry_in.return_value = 60
+        self.notify()
+        eq_(retry.call_args[1]['kwargs'], {'held_retries': 1})
+        eq_(retry.call_args[1]['max_retries'],
+            settings.POSTBACK_ATTEMPTS + 1)
+        wait = retry.call_args[1]['eta'] - datetime.now()
+        assert 0 < wait.seconds <= 60, wait
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher')
+    @mock.patch('webpay.pay.utils.breaker')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    def test_host_busy_releases_probe(self, retry, breaker, dispatcher,
+                                      slumber):
+        self.set_secret_mock(slumber, 'f')
+        dispatcher.post.side_effect = HostBusy('busy')
+        self.notify()
+        assert breaker.release.called, 'probe slot should be given back'
+        assert not breaker.record.called, 'host did not fail'
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    def test_host_busy_not_an_attempt(self, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        dispatcher.post.side_effect = HostBusy('busy')
+        self.notify()
+        eq_(retry.call_args[1]['kwargs'], {'busy_retries': 1})
+        eq_(retry.call_args[1]['max_retries'],
+            settings.POSTBACK_ATTEMPTS + 1)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    def test_host_busy_too_often(self, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        dispatcher.post.side_effect = HostBusy('busy')
+        busy = settings.NOTICE_DISPATCHER['max_busy_retries']
+        with mock.patch.object(type(tasks.payment_notify), 'request',
+                               new_callable=mock.PropertyMock) as request:
+            request.return_value.retries = busy
+            request.return_value.kwargs = {'busy_retries': busy}
+            self.notify()
+        assert 'kwargs' not in retry.call_args[1]
+        eq_(retry.call_args[1]['max_retries'],
+            settings.POSTBACK_ATTEMPTS + busy)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher')
+    @mock.patch('webpay.pay.utils.breaker')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    def test_circuit_records(self, retry, breaker, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        dispatcher.post.side_effect = RequestException('some http error')
+        self.notify()
+        eq_(breaker.record.call_args[1], {'success': False})
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.utils.notify_failure')
-    def test_failure_notifies(self, notify, requests, slumber):
+    def test_failure_notifies(self, notify, dispatcher, slumber):
         self.set_secret_mock(slumber, 'f')
-        requests.post.side_effect = RequestException('some http error')
+        dispatcher.post.side_effect = RequestException('some http error')
         self.notify()
         assert notify.called, 'failure notification sent'
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_signed_app_response(self, fake_req, slumber):
         app_payment = self.payload()
@@ -273,6 +357,115 @@ class TestNotifyApp(NotifyTest):
         self.notify(payload=app_payment)
 
 
+@mock.patch('lib.solitude.api.client.slumber')
+@mock.patch('webpay.pay.utils.dispatcher')
+@mock.patch('webpay.pay.tasks.payment_notify.retry')
+class TestNoticeCache(NotifyAppTest):
+
+    def notices(self, dispatcher):
+        return [c[0][1]['notice'] for c in dispatcher.post.call_args_list]
+
+    @contextlib.contextmanager
+    def retrying(self, task=tasks.payment_notify, **kwargs):
+        """Run the task as if it was being retried."""
+        with mock.patch.object(type(task), 'request',
+                               new_callable=mock.PropertyMock) as request:
+            request.return_value.retries = 1
+            request.return_value.kwargs = kwargs
+            yield
+
+    @mock.patch('lib.solitude.api.client.get_transaction')
+    def test_retry_reuses_notice(self, get_transaction, retry, dispatcher,
+                                 slumber):
+        self.set_secret_mock(slumber, 'f')
+        get_transaction.return_value = self.transaction()
+        dispatcher.post.side_effect = RequestException('some http error')
+        tasks.payment_notify(self.trans_uuid)
+        with self.retrying():
+            tasks.payment_notify(self.trans_uuid)
+        eq_(get_transaction.call_count, 1)
+        eq_(slumber.generic.product.get_object_or_404.call_count, 1)
+        first, second = self.notices(dispatcher)
+        eq_(first, second)
+        eq_(dispatcher.post.call_args[0][0],
+            self.payload()['request']['postbackURL'])
+        eq_(retry.call_count, 2)
+
+    @mock.patch('lib.solitude.api.client.get_transaction')
+    def test_first_attempt_signs(self, get_transaction, retry, dispatcher,
+                                 slumber):
+        self.set_secret_mock(slumber, 'f')
+        get_transaction.return_value = self.transaction()
+        tasks.payment_notify(self.trans_uuid)
+        tasks.payment_notify(self.trans_uuid)
+        eq_(get_transaction.call_count, 2)
+
+    @mock.patch('webpay.pay.tasks._cached_notice')
+    def test_retry_miss_looked_up_once(self, cached_notice, retry, dispatcher,
+                                       slumber):
+        self.set_secret_mock(slumber, 'f')
+        cached_notice.return_value = None
+        with self.retrying():
+            self.notify()
+        eq_(cached_notice.call_count, 1)
+        assert dispatcher.post.called
+
+    def test_secret_cached(self, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        self.notify()
+        self.notify()
+        eq_(slumber.generic.product.get_object_or_404.call_count, 1)
+
+    def test_rejected_notice_resigned(self, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'old')
+        dispatcher.post.return_value.text = '<not a valid response>'
+        self.notify()
+        eq_(retry.call_args[1]['kwargs'], {'resign': True})
+        # The issuer rotated its secret after it was cached.
+        self.set_secret_mock(slumber, 'new')
+        with self.retrying(resign=True):
+            self.notify()
+        first, second = self.notices(dispatcher)
+        aud = jwt.decode(second, verify=False)['aud']
+        jwt.decode(second, 'new', audience=aud)
+
+    def test_resign_cleared(self, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        dispatcher.post.side_effect = RequestException('some http error')
+        with self.retrying(resign=True):
+            self.notify()
+        assert 'resign' not in retry.call_args[1].get('kwargs', {})
+
+    @mock.patch('webpay.pay.tasks.gmtime')
+    def test_resign_near_expiry(self, gmtime, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        gmtime.return_value = 1000
+        self.notify()
+        gmtime.return_value = 1000 + 3600 - settings.NOTICE_RESIGN_MARGIN
+        with self.retrying():
+            self.notify()
+        first, second = self.notices(dispatcher)
+        assert first != second
+        eq_(jwt.decode(second, verify=False)['iat'], gmtime.return_value)
+
+    def test_postback_and_chargeback(self, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        self.notify()
+        with self.retrying(tasks.chargeback_notify):
+            self.do_chargeback('refund')
+        postback, chargeback = self.notices(dispatcher)
+        eq_(jwt.decode(chargeback, verify=False)['typ'], TYP_CHARGEBACK)
+
+    def test_chargeback_reasons(self, retry, dispatcher, slumber):
+        self.set_secret_mock(slumber, 'f')
+        self.do_chargeback('refund')
+        with self.retrying(tasks.chargeback_notify):
+            self.do_chargeback('reversal')
+        refund, reversal = self.notices(dispatcher)
+        eq_(jwt.decode(reversal, verify=False)['response']['reason'],
+            'reversal')
+
+
 @mock.patch('lib.solitude.api.client.slumber')
 class TestFreeInAppNotifications(NotifyTest):
 
@@ -288,11 +481,11 @@ class TestFreeInAppNotifications(NotifyTest):
             }
         tasks.free_notify(notes, solitude_buyer_uuid)
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.free_notify.retry')
-    def test_notify_retries(self, retry, requests, slumber):
+    def test_notify_retries(self, retry, dispatcher, slumber):
         self.set_secret_mock(slumber, 'f')
-        requests.post.side_effect = RequestException('some http error')
+        dispatcher.post.side_effect = RequestException('some http error')
         self.notify()
         assert retry.called, 'task should be retried after error'
 
@@ -307,7 +500,7 @@ class TestSimulatedNotifications(NotifyTest):
         tasks.simulate_notify(self.payment_issuer, payload,
                               trans_uuid=self.trans_uuid)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_postback(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         payload = self.payload(typ=TYP_POSTBACK,
@@ -329,7 +522,7 @@ class TestSimulatedNotifications(NotifyTest):
                                  .expects('raise_for_status'))
         self.notify(payload)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_chargeback(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         req = {'simulate': {'result': 'chargeback'}}
@@ -353,7 +546,7 @@ class TestSimulatedNotifications(NotifyTest):
 
         self.notify(payload)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_chargeback_reason(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         reason = 'something'
@@ -377,7 +570,7 @@ class TestSimulatedNotifications(NotifyTest):
         self.notify(payload)
 
     @mock.patch('webpay.pay.tasks.simulate_notify.retry')
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
     def test_retry_http_error(self, post, retry, slumber):
         self.set_secret_mock(slumber, 'f')
         post.side_effect = RequestException('500 error')
@@ -392,7 +585,7 @@ class TestSimulatedNotifications(NotifyTest):
         retry.assert_called_with(args=[self.payment_issuer, payload],
                                  max_retries=ANY, eta=ANY, exc=ANY)
 
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
     @mock.patch('webpay.pay.utils.notify_failure')
     def test_no_notifications_on_simulate(self, notify_failure, post, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -404,7 +597,7 @@ class TestSimulatedNotifications(NotifyTest):
         assert not notify_failure.called, 'Notification should not be sent'
 
     @raises(IndexError)
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_no_tier(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         payload = self.payload(typ=TYP_POSTBACK,
@@ -446,6 +639,9 @@ class TestStartPay(BaseStartPay):
         p = mock.patch('lib.marketplace.api.client.api')
         self.mkt = p.start()
         self.addCleanup(p.stop)
+        # The price index is empty so tiers are asked for one at a time.
+        self.mkt.webpay.prices.get.return_value = {'meta': {'next': None},
+                                                   'objects': []}
 
         self.providers = api.ProviderHelper.supported_providers()
         self.generic_seller_uuid = 'generic_seller_uuid'
@@ -669,11 +865,13 @@ class TestStartPay(BaseStartPay):
         assert pay_error_handler.is_called
 
     def test_transaction_called(self):
-        self.solitude.generic.transaction.get_object.return_value = {
+        self.solitude.generic.transaction.post.return_value = {
             'status': 'not-pending',
             'resource_pk': 5}
         self.start()
         self.solitude.generic.transaction.assert_called_with(5)
+        # The transaction created is patched without looking it up again.
+        assert not self.solitude.generic.transaction.get_object.called
 
     def test_price_used(self):
         prices = mock.Mock()
@@ -835,6 +1033,15 @@ class TestStartPayError(BaseStartPay):
             'status': 7,
         })
 
+    def test_transaction_passed(self):
+        transaction = mock.Mock()
+        self.solitude.generic.transaction.return_value = transaction
+
+        tasks.pay_error_handler(**self.data(transaction={'resource_pk': 1}))
+        self.solitude.generic.transaction.assert_called_with(1)
+        assert transaction.patch.called
+        assert not self.solitude.generic.transaction.get_object_or_404.called
+
     def test_no_error_type(self):
         self.solitude.generic.transaction.get_object_or_404.side_effect = (
             ObjectDoesNotExist)
@@ -874,6 +1081,28 @@ class TestBestProvider(BaseStartPay):
              call('10', provider='boku'),
              call('10', provider='reference')])
 
+    def test_price_error(self, get_price):
+        def boku_error(point, provider):
+            if provider == 'boku':
+                raise UnknownPricePoint(point)
+            return {'prices': []}
+
+        get_price.side_effect = boku_error
+        with self.assertRaises(UnknownPricePoint):
+            tasks.get_best_provider(**self.default())
+
+    def test_price_error_not_reached(self, get_price):
+        def boku_error(point, provider):
+            if provider == 'boku':
+                raise UnknownPricePoint(point)
+            return {'prices': [{'price': '0.99'}]}
+
+        get_price.side_effect = boku_error
+        provider, uid, prices = tasks.get_best_provider(**self.default())
+        eq_(uid, 'uid:bango')
+        # Providers after the first one with a price are not looked up.
+        eq_(get_price.call_args_list, [call('10', provider='bango')])
+
     def test_bango_fallback(self, get_price):
         def no_boku_price(point, provider):
             if provider == 'boku':
@@ -960,6 +1189,15 @@ class TestConfigureTransaction(BaseStartPay):
         eq_(self.start(request=request),
             (False, dev_messages.TRANS_MISSING))
 
+    def test_pay_request_missing(self):
+        self.solitude.side_effect = ObjectDoesNotExist
+        session = {}
+        self.notes['pay_request_ref'] = 'evicted'
+        eq_(self.start(session=session),
+            (False, dev_messages.PAY_REQUEST_MISSING))
+        assert 'configured_trans' not in session
+        assert not self.start_pay.called
+
     def test_restart_certain_transactions(self):
         for st in constants.STATUS_RETRY_OK:
             self.solitude.get_transaction.return_value = {
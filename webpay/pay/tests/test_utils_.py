@@ -1,9 +1,15 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.test.utils import override_settings
 
-from nose.tools import raises
+import mock
+from nose.tools import eq_, raises
 
 from webpay.base.tests import TestCase
-from webpay.pay.utils import verify_urls
+from webpay.pay.utils import (get_issuer_product, invalidate_issuer,
+                              lookup_issuer, refresh_issuer_secret,
+                              UnknownIssuer, verify_urls)
 
 
 @override_settings(ALLOWED_CALLBACK_SCHEMES=['http', 'https'])
@@ -24,3 +30,93 @@ class TestVerifyURLs(TestCase):
     def test_https_only(self):
         with self.settings(ALLOWED_CALLBACK_SCHEMES=['https']):
             verify_urls('http://foo.com')
+
+
+@override_settings(ISSUER_CACHE_TIMEOUT=60, ISSUER_NEGATIVE_CACHE_TIMEOUT=60)
+class TestIssuerCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        p = mock.patch('lib.solitude.api.client.slumber')
+        self.slumber = p.start()
+        self.addCleanup(p.stop)
+        self.get = self.slumber.generic.product.get_object_or_404
+        self.get.return_value = {'secret': 'shh', 'access': 1}
+
+    def test_marketplace(self):
+        eq_(lookup_issuer(settings.KEY), (settings.SECRET, None))
+        assert not self.get.called
+
+    def test_cached(self):
+        eq_(lookup_issuer('app')[0], 'shh')
+        eq_(lookup_issuer('app')[0], 'shh')
+        self.get.assert_called_once_with(seller__active=True,
+                                         public_id='app')
+
+    def test_any_product(self):
+        eq_(get_issuer_product('app', active_only=False)['secret'], 'shh')
+        get_issuer_product('app', active_only=False)
+        self.get.assert_called_once_with(public_id='app')
+
+    @raises(UnknownIssuer)
+    def test_unknown(self):
+        self.get.side_effect = ObjectDoesNotExist
+        lookup_issuer('app')
+
+    def test_negative_cache(self):
+        self.get.side_effect = ObjectDoesNotExist
+        for i in range(2):
+            with self.assertRaises(UnknownIssuer):
+                lookup_issuer('app')
+        eq_(self.get.call_count, 1)
+
+    def test_invalidate(self):
+        lookup_issuer('app')
+        self.get.return_value = {'secret': 'rotated'}
+        invalidate_issuer('app')
+        eq_(lookup_issuer('app')[0], 'rotated')
+
+    def test_fresh(self):
+        get_issuer_product('app', active_only=False)
+        get_issuer_product('app', active_only=False, fresh=True)
+        eq_(self.get.call_count, 2)
+
+    def test_fresh_rotated(self):
+        lookup_issuer('app')
+        self.get.return_value = {'secret': 'rotated'}
+        eq_(get_issuer_product('app', active_only=False,
+                               fresh=True)['secret'], 'rotated')
+        eq_(lookup_issuer('app')[0], 'rotated')
+        eq_(self.get.call_count, 3)
+
+    def test_non_ascii(self):
+        self.get.side_effect = ObjectDoesNotExist
+        with self.assertRaises(UnknownIssuer):
+            lookup_issuer(u'\u0430pp')
+
+    def test_refresh_rotated(self):
+        lookup_issuer('app')
+        self.get.return_value = {'secret': 'rotated'}
+        eq_(refresh_issuer_secret('app'), 'rotated')
+        eq_(lookup_issuer('app')[0], 'rotated')
+        eq_(self.get.call_count, 2)
+
+    def test_refresh_unchanged(self):
+        lookup_issuer('app')
+        eq_(refresh_issuer_secret('app'), None)
+        lookup_issuer('app')
+        eq_(self.get.call_count, 2)
+
+    def test_refresh_not_cached(self):
+        eq_(refresh_issuer_secret('app'), None)
+        assert not self.get.called
+
+    def test_refresh_marketplace(self):
+        eq_(refresh_issuer_secret(settings.KEY), None)
+        assert not self.get.called
+
+    def test_disabled(self):
+        with self.settings(ISSUER_CACHE_TIMEOUT=0):
+            lookup_issuer('app')
+            lookup_issuer('app')
+        eq_(self.get.call_count, 2)
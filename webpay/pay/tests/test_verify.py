@@ -0,0 +1,110 @@
+from django.conf import settings
+
+import jwt
+import mock
+from mozpay.exc import InvalidJWT, RequestExpired
+from nose.tools import eq_, raises
+
+from webpay.base.utils import gmtime
+from webpay.pay.samples import JWTtester
+from webpay.pay.verify import decode_jwt, JWTTooLarge, verify_jwt
+
+
+class TestVerify(JWTtester):
+
+    def verify_request(self, secret=None, algorithms=('HS256',),
+                       required_keys=('request.id',), **kw):
+        return verify_jwt(decode_jwt(self.request(**kw)), settings.DOMAIN,
+                          secret or self.secret, algorithms=algorithms,
+                          required_keys=required_keys)
+
+    def test_valid(self):
+        payload = self.payload()
+        eq_(self.verify_request(payload=payload), payload)
+
+    def test_decoded_parts(self):
+        payload = self.payload()
+        decoded = decode_jwt(self.request(payload=payload))
+        eq_(decoded.header['alg'], 'HS256')
+        eq_(decoded.payload, payload)
+
+    @mock.patch('jwt.decode')
+    def test_not_decoded_again(self, decode):
+        self.verify_request()
+        assert not decode.called
+
+    @raises(InvalidJWT)
+    def test_tampered_payload(self):
+        header, payload, signature = self.request().split('.')
+        other = self.request(extra_req={'id': 'other'})
+        verify_jwt(decode_jwt('.'.join([header, other.split('.')[1],
+                                        signature])),
+                   settings.DOMAIN, self.secret)
+
+    @raises(JWTTooLarge)
+    def test_too_large(self):
+        with self.settings(JWT_MAX_LENGTH=10):
+            decode_jwt(self.request())
+
+    @raises(InvalidJWT)
+    def test_not_a_jwt(self):
+        decode_jwt('not-a-jwt')
+
+    @raises(InvalidJWT)
+    def test_bad_json(self):
+        decode_jwt('bm90LWpzb24.bm90LWpzb24.c2ln')
+
+    @raises(InvalidJWT)
+    def test_wrong_secret(self):
+        self.verify_request(secret='wrong')
+
+    @raises(InvalidJWT)
+    def test_algorithm_not_allowed(self):
+        self.verify_request(algorithms=['HS512'])
+
+    @raises(InvalidJWT)
+    def test_none_algorithm(self):
+        token = jwt.encode(self.payload(), None, algorithm='none')
+        verify_jwt(decode_jwt(token), settings.DOMAIN, self.secret,
+                   algorithms=['HS256', 'none'])
+
+    @raises(RequestExpired)
+    def test_expired(self):
+        with self.settings(JWT_LEEWAY=60):
+            self.verify_request(exp=gmtime() - 61)
+
+    def test_expired_within_leeway(self):
+        with self.settings(JWT_LEEWAY=60):
+            self.verify_request(exp=gmtime() - 10)
+
+    @raises(InvalidJWT)
+    def test_missing_algorithm(self):
+        decoded = decode_jwt(self.request())
+        del decoded.header['alg']
+        verify_jwt(decoded, settings.DOMAIN, self.secret)
+
+    def test_not_before_within_leeway(self):
+        payload = self.payload()
+        payload['nbf'] = gmtime() + 10
+        with self.settings(JWT_LEEWAY=60):
+            self.verify_request(payload=payload)
+
+    @raises(RequestExpired)
+    def test_not_before(self):
+        payload = self.payload()
+        payload['nbf'] = gmtime() + 600
+        self.verify_request(payload=payload)
+
+    @raises(InvalidJWT)
+    def test_wrong_audience(self):
+        self.verify_request(aud='somewhere.else')
+
+    @raises(InvalidJWT)
+    def test_missing_keys(self):
+        self.verify_request(required_keys=('request.nope',))
+
+    @raises(InvalidJWT)
+    def test_missing_issuer(self):
+        payload = self.payload()
+        del payload['iss']
+        self.verify_request(payload=payload)
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+import hashlib
 import logging
 from urllib2 import HTTPError
 from urlparse import urlparse
@@ -6,17 +7,19 @@ import uuid
 
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.encoding import smart_str
 
 from celery.exceptions import RetryTaskError
 from django_statsd.clients import statsd
-import requests
 from requests.exceptions import ConnectionError, RequestException
 
 from lib.marketplace.api import client
 from lib.solitude.api import client as solitude
 
 from .constants import NOT_SIMULATED
+from .dispatch import breaker, CircuitOpen, dispatcher, HostBusy
 
 log = logging.getLogger('w.pay.utils')
 
@@ -60,9 +63,16 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
     log.info('about to notify %s of notice type %s' % (url, notice_type))
     exception = None
     success = False
+    # Whether the app answered, even if it turned the notice down.
+    answered = False
     try:
+        if not breaker.allow(url):
+            statsd.incr('purchase.send_pay_notice.circuit_open')
+            raise CircuitOpen('Circuit is open for: {0}'.format(url))
         with statsd.timer('purchase.send_pay_notice'):
-            res = requests.post(url, {'notice': signed_notice}, timeout=5)
+            res = dispatcher.post(url, {'notice': signed_notice},
+                                  timeout=5)
+        answered = True
         res.raise_for_status()  # raise exception for non-200s
         res_content = res.text.strip()
 
@@ -79,13 +89,48 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
             RequestException, ValueError), exception:
         log.error('Notice for transaction %s raised exception in URL %s'
                   % (trans_id, url), exc_info=True)
-        try:
-            notifier_task.retry(
-                args=task_args,
+        if isinstance(exception, HostBusy):
+            # The notice was never sent so it can't be the probe.
+            breaker.release(url)
+        elif not isinstance(exception, CircuitOpen):
+            breaker.record(url, success=False)
+        # Retries because the host was busy or its circuit was open are
+        # counted in the task kwargs so that they can be left out of the
+        # attempts.
+        task_kwargs = notifier_task.request.kwargs or {}
+        busy = task_kwargs.get('busy_retries', 0)
+        held = task_kwargs.get('held_retries', 0)
+        max_retries = settings.POSTBACK_ATTEMPTS + busy + held
+        retry = {'args': task_args,
+                 'eta': (datetime.now() +
+                         timedelta(seconds=settings.POSTBACK_DELAY)),
+                 'max_retries': max_retries,
+                 'exc': exception}
+        # An app that turned the notice down may be checking it with a
+        # secret that the issuer has rotated since it was cached, so the
+        # retry signs it again with a fresh secret.
+        retry_kwargs = dict((k, v) for k, v in task_kwargs.items()
+                            if k != 'resign')
+        if answered:
+            retry_kwargs['resign'] = True
+        if retry_kwargs != task_kwargs:
+            retry['kwargs'] = retry_kwargs
+        if (isinstance(exception, HostBusy) and
+                busy < settings.NOTICE_DISPATCHER['max_busy_retries']):
+            retry.update(
+                kwargs=dict(retry_kwargs, busy_retries=busy + 1),
+                eta=(datetime.now() + timedelta(
+                    seconds=settings.NOTICE_DISPATCHER['busy_retry_delay'])),
+                max_retries=max_retries + 1)
+        elif (isinstance(exception, CircuitOpen) and
+                held < settings.POSTBACK_BREAKER['max_held_retries']):
+            retry.update(
+                kwargs=dict(retry_kwargs, held_retries=held + 1),
                 eta=(datetime.now() +
-                     timedelta(seconds=settings.POSTBACK_DELAY)),
-                max_retries=settings.POSTBACK_ATTEMPTS,
-                exc=exception)
+                     timedelta(seconds=breaker.retry_in(url))),
+                max_retries=max_retries + 1)
+        try:
+            notifier_task.retry(**retry)
 
         # Retry actually raises an exception, so let that through.
         except RetryTaskError:
@@ -104,6 +149,7 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
 
     else:
         success = True
+        breaker.record(url, success=True)
         log.debug('URL %s responded OK for transaction %s '
                   'notification' % (url, trans_id))
 
@@ -155,6 +201,107 @@ class UnknownIssuer(Exception):
     """The JWT issuer is unknown."""
 
 
+# Stored in the cache for issuers that Solitude doesn't know about.
+UNKNOWN_ISSUER = 'unknown-issuer'
+
+
+def issuer_cache_key(issuer, active_only=True):
+    return 'issuer:{0}:{1}'.format('active' if active_only else 'any',
+                                   hashlib.md5(smart_str(issuer)).hexdigest())
+
+
+def get_issuer_product(issuer, active_only=True, fresh=False):
+    """
+    Return the Solitude product for a JWT issuer.
+
+    Products are cached for ISSUER_CACHE_TIMEOUT seconds and unknown
+    issuers are remembered for ISSUER_NEGATIVE_CACHE_TIMEOUT seconds so
+    that every pay request doesn't need a Solitude lookup.
+
+    :param issuer: the public_id of the product.
+    :param active_only: only match products of active sellers.
+    :param fresh: skip the cache and look the product up in Solitude.
+      If its secret was rotated, the issuer is invalidated everywhere.
+    :raises UnknownIssuer: if no product exists for the issuer.
+    """
+    key = issuer_cache_key(issuer, active_only=active_only)
+    timeout = settings.ISSUER_CACHE_TIMEOUT
+    product = cache.get(key) if timeout and not fresh else None
+    if product == UNKNOWN_ISSUER:
+        statsd.incr('purchase.issuer_cache.negative_hit')
+        raise UnknownIssuer('Unknown issuer: {0}'.format(issuer))
+    elif product is not None:
+        statsd.incr('purchase.issuer_cache.hit')
+        return product
+
+    statsd.incr('purchase.issuer_cache.miss')
+    try:
+        if active_only:
+            product = solitude.get_active_product(issuer)
+        else:
+            product = (solitude.slumber.generic.product
+                       .get_object_or_404(public_id=issuer))
+    except ObjectDoesNotExist, err:
+        log.info('get_issuer_product({0}) '
+                 'raised {1.__class__.__name__}: {1}'.format(issuer, err))
+        if timeout and settings.ISSUER_NEGATIVE_CACHE_TIMEOUT:
+            cache.set(key, UNKNOWN_ISSUER,
+                      settings.ISSUER_NEGATIVE_CACHE_TIMEOUT)
+        raise UnknownIssuer('{0.__class__.__name__}: {0}'.format(err))
+
+    if timeout:
+        cached = cache.get_many([issuer_cache_key(issuer, active_only=True),
+                                 issuer_cache_key(issuer, active_only=False)])
+        if any(isinstance(other, dict) and
+               other['secret'] != product['secret']
+               for other in cached.values()):
+            statsd.incr('purchase.issuer_cache.rotated')
+            log.info('secret of issuer {0} changed'.format(issuer))
+            invalidate_issuer(issuer)
+        cache.set(key, product, timeout)
+    return product
+
+
+def invalidate_issuer(issuer):
+    """
+    Forget the cached product of an issuer, for example after its
+    secret has been rotated.
+    """
+    cache.delete_many([issuer_cache_key(issuer, active_only=True),
+                       issuer_cache_key(issuer, active_only=False)])
+
+
+def refresh_issuer_secret(issuer):
+    """
+    Look up the secret of an issuer in Solitude, skipping the cache, and
+    return it if it differs from the cached one. Otherwise return None.
+
+    This is for a pay request that fails verification with the cached
+    secret, in case the issuer rotated it. The cache is only replaced when
+    the secret changed so that forged requests can't keep emptying it.
+    """
+    timeout = settings.ISSUER_CACHE_TIMEOUT
+    if issuer == settings.KEY or not timeout:
+        return None
+    key = issuer_cache_key(issuer)
+    cached = cache.get(key)
+    if not isinstance(cached, dict):
+        # Nothing is cached so the secret was just looked up.
+        return None
+    try:
+        product = solitude.get_active_product(issuer)
+    except ObjectDoesNotExist:
+        return None
+    if product['secret'] == cached['secret']:
+        return None
+
+    statsd.incr('purchase.issuer_cache.rotated')
+    log.info('secret of issuer {0} changed'.format(issuer))
+    invalidate_issuer(issuer)
+    cache.set(key, product, timeout)
+    return product['secret']
+
+
 def lookup_issuer(issuer):
     """
     Lookup a JWT issuer and return the secret and associated product object.
@@ -166,14 +313,8 @@ def lookup_issuer(issuer):
         active_product = None
         secret = settings.SECRET
     else:
-        try:
-            # Assuming that the issuer is also going to be the public_id.
-            active_product = solitude.get_active_product(issuer)
-        except ObjectDoesNotExist, err:
-            log.info('get_active_product({0}) '
-                     'raised {1.__class__.__name__}: {1}'.format(issuer, err))
-            raise UnknownIssuer('{0.__class__.__name__}: {0}'.format(err))
-
+        # Assuming that the issuer is also going to be the public_id.
+        active_product = get_issuer_product(issuer)
         secret = active_product['secret']
 
     return secret, active_product
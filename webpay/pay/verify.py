@@ -0,0 +1,130 @@
+"""
+Decode and verify pay request JWTs in a single pass.
+
+mozpay.verify.verify_jwt() decodes the token several times over and the
+pay request form had already decoded it once more to find the issuer.
+Here the token is checked for size, then split and decoded once by
+decode_jwt(). verify_jwt() checks the signature of that decoded token
+with PyJWT's algorithms and makes PyJWT's claim checks on its payload,
+without parsing it again. The errors raised are the ones from mozpay so
+callers can handle them the same way.
+"""
+import binascii
+import json
+
+from django.conf import settings
+
+from jwt.algorithms import get_default_algorithms
+from jwt.exceptions import InvalidKeyError
+from jwt.utils import base64url_decode
+from mozpay.exc import InvalidJWT, RequestExpired
+from mozpay.verify import verify_claims, verify_keys
+
+from webpay.base.utils import gmtime
+
+ALGORITHMS = get_default_algorithms()
+
+
+class JWTTooLarge(InvalidJWT):
+    """The JWT is longer than settings.JWT_MAX_LENGTH."""
+
+
+class DecodedJWT(object):
+    """The parts of a JWT that has been decoded but not yet verified."""
+
+    def __init__(self, signing_input, header, payload, signature):
+        self.signing_input = signing_input
+        self.header = header
+        self.payload = payload
+        self.signature = signature
+
+
+def _decode_segment(segment, name):
+    try:
+        return base64url_decode(segment)
+    except (TypeError, binascii.Error):
+        raise InvalidJWT('Invalid JWT {0} padding'.format(name))
+
+
+def decode_jwt(token):
+    """
+    Decode a JWT without verifying it, returning a DecodedJWT.
+
+    :raises JWTTooLarge: if the token is too long to be decoded.
+    :raises InvalidJWT: if the token is not a JWT.
+    """
+    if len(token) > settings.JWT_MAX_LENGTH:
+        raise JWTTooLarge('JWT is {0} bytes long, the maximum is {1}'
+                          .format(len(token), settings.JWT_MAX_LENGTH))
+    try:
+        token = str(token)
+    except UnicodeEncodeError, exc:
+        raise InvalidJWT('Non-ascii JWT: {0}'.format(exc))
+    try:
+        signing_input, signature = token.rsplit('.', 1)
+        header, payload = signing_input.split('.')
+    except ValueError:
+        raise InvalidJWT('Wrong number of JWT segments')
+
+    try:
+        header = json.loads(_decode_segment(header, 'header'))
+        payload = json.loads(_decode_segment(payload, 'payload'))
+    except ValueError, exc:
+        raise InvalidJWT('Invalid JSON for JWT: {0}'.format(exc))
+    if not isinstance(header, dict):
+        raise InvalidJWT('JWT header must be a JSON object')
+    return DecodedJWT(signing_input, header, payload,
+                      _decode_segment(signature, 'signature'))
+
+
+def verify_jwt(decoded, expected_aud, secret, algorithms=None,
+               required_keys=()):
+    """
+    Verify a DecodedJWT, returning its payload.
+
+    This makes the same checks as mozpay.verify.verify_jwt(), allowing
+    for settings.JWT_LEEWAY seconds of clock skew.
+
+    :raises RequestExpired: if the JWT has expired or is not valid yet.
+    :raises InvalidJWT: for any other problem with the JWT.
+    """
+    payload = decoded.payload
+    if not isinstance(payload, dict):
+        raise InvalidJWT('JWT is not a JSON object')
+    issuer = payload.get('iss')
+    if not issuer:
+        raise InvalidJWT('Payment JWT is missing iss (issuer)')
+
+    alg = decoded.header.get('alg')
+    if alg not in (algorithms or ['HS256']) or alg not in ALGORITHMS:
+        raise InvalidJWT('JWT algorithm {0!r} is not allowed'.format(alg),
+                         issuer=issuer)
+    algorithm = ALGORITHMS[alg]
+    try:
+        key = algorithm.prepare_key(secret)
+    except (InvalidKeyError, TypeError), exc:
+        raise InvalidJWT('Invalid key: {0}'.format(exc), issuer=issuer)
+    if not algorithm.verify(decoded.signing_input, key, decoded.signature):
+        raise InvalidJWT('Signature verification failed', issuer=issuer)
+
+    # These are the checks jwt.decode() makes after the signature.
+    verify_claims(payload, issuer=issuer)
+    now = gmtime()
+    leeway = settings.JWT_LEEWAY
+    try:
+        not_before = float(payload.get('nbf', now))
+    except (TypeError, ValueError):
+        raise InvalidJWT('JWT had an invalid nbf', issuer=issuer)
+    if not_before > now + leeway:
+        raise RequestExpired('JWT is not yet valid', issuer=issuer)
+    if float(payload['exp']) < now - leeway:
+        raise RequestExpired('JWT has expired', issuer=issuer)
+
+    audience = payload.get('aud')
+    if isinstance(audience, basestring):
+        audience = [audience]
+    if not isinstance(audience, list) or expected_aud not in audience:
+        raise InvalidJWT('Invalid JWT audience', issuer=issuer)
+
+    verify_keys(payload, required_keys, issuer=issuer)
+    return payload
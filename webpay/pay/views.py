@@ -5,7 +5,6 @@ from django.conf import settings
 from django.views.decorators.http import require_POST
 
 from mozpay.exc import InvalidJWT, RequestExpired
-from mozpay.verify import verify_jwt
 from tower import ugettext as _
 
 from webpay.base import dev_messages as msg
@@ -17,7 +16,9 @@ from lib.marketplace.api import client as marketplace, UnknownPricePoint
 
 from . import tasks
 from .forms import VerifyForm, NetCodeForm
-from .utils import trans_id, verify_urls
+from .notes import get_notes, PayRequestMissing, set_pay_request
+from .utils import refresh_issuer_secret, trans_id, verify_urls
+from .verify import verify_jwt
 
 log = getLogger('w.pay')
 
@@ -41,12 +42,11 @@ def process_pay_req(request, data=None):
                             _('Payments are temporarily disabled.'),
                             code=msg.PAY_DISABLED, status=503)
 
-    exc = er = None
-    try:
-        pay_req = verify_jwt(
-            form.cleaned_data['req'],
+    def verify(secret):
+        return verify_jwt(
+            form.jwt,
             settings.DOMAIN,  # JWT audience.
-            form.secret,
+            secret,
             algorithms=settings.SUPPORTED_JWT_ALGORITHMS,
             required_keys=('request.id',
                            'request.pricePoint',  # A price tier we'll look up.
@@ -54,11 +54,24 @@ def process_pay_req(request, data=None):
                            'request.description',
                            'request.postbackURL',
                            'request.chargebackURL'))
+
+    exc = er = None
+    try:
+        try:
+            pay_req = verify(form.secret)
+        except RequestExpired:
+            raise
+        except InvalidJWT:
+            # The issuer may have rotated its secret since we cached it.
+            secret = refresh_issuer_secret(form.key)
+            if not secret:
+                raise
+            pay_req = verify(secret)
     except RequestExpired, exc:
-        log.debug('exception in mozpay.verify_jwt(): {e}'.format(e=exc))
+        log.debug('exception in verify_jwt(): {e}'.format(e=exc))
         er = msg.EXPIRED_JWT
     except InvalidJWT, exc:
-        log.debug('exception in mozpay.verify_jwt(): {e}'.format(e=exc))
+        log.debug('exception in verify_jwt(): {e}'.format(e=exc))
         er = msg.INVALID_JWT
 
     if exc:
@@ -84,7 +97,7 @@ def process_pay_req(request, data=None):
     try:
         marketplace.get_price(pay_req['request']['pricePoint'])
     except UnknownPricePoint:
-        log.exception('UnknownPricePoint calling get price_price()')
+        log.exception('UnknownPricePoint calling get_price()')
         return app_error(request, code=msg.BAD_PRICE_POINT)
 
     _trim_pay_request(pay_req)
@@ -95,10 +108,9 @@ def process_pay_req(request, data=None):
     # It gets saved to the solitude transaction so you can access it there.
     # Otherwise it is used for simulations and fake payments.
     notes = request.session.get('notes', {})
-    notes['pay_request'] = pay_req
     # The issuer key points to the app that issued the payment request.
     notes['issuer_key'] = form.key
-    request.session['notes'] = notes
+    set_pay_request(request, notes, pay_req)
     tx = trans_id()
     log.info('Generated new transaction ID: {tx}'.format(tx=tx))
     request.session['trans_id'] = tx
@@ -156,7 +168,11 @@ def configure_transaction(request, data=None):
         log.info('Notifying for free in-app trans_id={t}; with '
                  'solitude_buyer_uuid={u}'.format(
                      t=request.session['trans_id'], u=solitude_buyer_uuid))
-        tasks.free_notify.delay(request.session['notes'], solitude_buyer_uuid)
+        try:
+            notes = get_notes(request)
+        except PayRequestMissing, exc:
+            return system_error(request, code=exc.error_code)
+        tasks.free_notify.delay(notes, solitude_buyer_uuid)
 
     sim = pay_req['request']['simulate'] if is_simulation else None
     client_trans_id = 'client-trans:{u}'.format(u=uuid.uuid4())
@@ -33,7 +33,8 @@ class PinViewSet(viewsets.ViewSet):
                                     form.cleaned_data['pin'],
                                     etag=form.buyer_etag,
                                     pin_confirmed=True,
-                                    clear_was_locked=True)
+                                    clear_was_locked=True,
+                                    buyer=form.buyer)
 
             if form.client_response_is_valid(res):
                 set_user_has_pin(request, True)
@@ -49,7 +50,8 @@ class PinViewSet(viewsets.ViewSet):
             res = client.change_pin(form.uuid,
                                     form.cleaned_data['pin'],
                                     pin_confirmed=True,
-                                    clear_was_locked=True)
+                                    clear_was_locked=True,
+                                    buyer=form.buyer)
             if form.client_response_is_valid(res):
                 return response.Response(status=204)
 
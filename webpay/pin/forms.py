@@ -24,6 +24,8 @@ class HTML5NumberWidget(TextInput):
 class BasePinForm(ParanoidForm):
     pin = forms.CharField(max_length=4, required=True,
                           widget=HTML5NumberWidget)
+    # The Solitude buyer, when the form had to look it up.
+    buyer = None
 
     def __init__(self, uuid=None, *args, **kwargs):
         # Error codes for tracking see pay/constants.py.
@@ -89,6 +91,7 @@ class CreatePinForm(BasePinForm):
         pin = self.cleaned_data['pin']
         buyer = client.get_buyer(self.uuid)
         if buyer and self.client_response_is_valid(buyer):
+            self.buyer = buyer
             try:
                 self.buyer_etag = buyer['etag']
             except KeyError:
@@ -78,7 +78,8 @@ class TestPost(PIN):
         eq_(res.status_code, 204)
         self.solitude_client.change_pin.assert_called_with(
             self.uuid, '1234', etag='', pin_confirmed=True,
-            clear_was_locked=True)
+            clear_was_locked=True,
+            buyer={'pin': False, 'resource_pk': 'abc'})
 
     def test_cant_post_when_user_has_pin(self):
         self.solitude.generic.buyer.get_object_or_404.return_value = {
@@ -220,7 +221,8 @@ class TestPatch(PIN):
         res = self.patch(self.url, data={'pin': '1234'})
         eq_(res.status_code, 204)
         self.solitude_client.change_pin.assert_called_with(
-            self.uuid, '1234', pin_confirmed=True, clear_was_locked=True)
+            self.uuid, '1234', pin_confirmed=True, clear_was_locked=True,
+            buyer=mock.ANY)
         ok_('user_reset' not in self.client.session,
             'Expected user_reset to be removed: {s}'
             .format(s=self.client.session.items()))
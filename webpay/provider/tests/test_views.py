@@ -134,7 +134,7 @@ class TestWaitToFinish(ProviderTestCase):
     def test_wait_for_boku_transaction(self):
         res = self.wait()
         url = reverse('provider.transaction_status', args=[self.trans_id])
-        eq_(res.context['transaction_status_url'], url)
+        eq_(pq(res.content)('body').attr('data-trans-start-url'), url)
         eq_(res.status_code, 200)
 
     def test_spa_wait_to_finish(self):
@@ -143,7 +143,7 @@ class TestWaitToFinish(ProviderTestCase):
         doc = pq(res.content)
         eq_(doc('body').attr('data-start-view'), 'wait-to-finish')
         url = reverse('provider.transaction_status', args=[self.trans_id])
-        eq_(res.context['transaction_status_url'], url)
+        eq_(doc('body').attr('data-trans-start-url'), url)
 
     def test_missing_transaction(self):
         res = self.client.get('{u}?foo=bar'.format(u=self.wait_url))
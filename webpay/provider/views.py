@@ -2,7 +2,6 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.http import (HttpResponseForbidden, HttpResponseNotFound,
                          HttpResponse)
-from django.shortcuts import render
 
 from django_paranoia.decorators import require_GET
 
@@ -14,6 +13,7 @@ from webpay.base.helpers import fxa_auth_info
 from webpay.base.logger import getLogger
 from webpay.base.utils import log_cef, system_error
 from webpay.pay import tasks
+from webpay.spa.shell import render_index
 
 log = getLogger('w.provider')
 NoticeClasses = {}
@@ -27,7 +27,7 @@ def wait_to_finish(request, provider_name):
     The provider redirects here so the UI can poll Solitude until the
     transaction is complete.
     """
-    helper = ProviderHelper(provider_name)
+    helper = ProviderHelper.get(provider_name)
     trans_uuid = helper.provider.transaction_from_notice(request.GET)
     if not trans_uuid:
         # This could happen if someone is tampering with the URL or if
@@ -46,7 +46,7 @@ def wait_to_finish(request, provider_name):
         'fxa_auth_url': fxa_url,
     }
 
-    return render(request, 'spa/index.html', ctx)
+    return render_index(request, ctx)
 
 
 @json_view(status_code=203)
@@ -78,7 +78,7 @@ def transaction_status(request, transaction_uuid):
 
 @require_GET
 def success(request, provider_name):
-    provider = ProviderHelper(provider_name)
+    provider = ProviderHelper.get(provider_name)
     if provider.name != 'reference':
         raise NotImplementedError(
             'only the reference provider is implemented so far')
@@ -94,12 +94,12 @@ def success(request, provider_name):
     ctx = {'start_view': 'payment-success',
            'fxa_state': state,
            'fxa_auth_url': fxa_url}
-    return render(request, 'spa/index.html', ctx)
+    return render_index(request, ctx)
 
 
 @require_GET
 def error(request, provider_name):
-    provider = ProviderHelper(provider_name)
+    provider = ProviderHelper.get(provider_name)
     if provider.name != 'reference':
         raise NotImplementedError(
             'only the reference provider is implemented so far')
@@ -123,7 +123,7 @@ def notification(request, provider_name):
     """
     Handle server to server notification responses.
     """
-    provider = ProviderHelper(provider_name)
+    provider = ProviderHelper.get(provider_name)
 
     try:
         transaction_uuid = provider.server_notification(request)
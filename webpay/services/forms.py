@@ -4,10 +4,11 @@ from django.conf import settings
 import jwt
 from django_paranoia.forms import ParanoidForm
 
-from mozpay.exc import InvalidJWT
+from mozpay.exc import InvalidJWT, RequestExpired
 from mozpay.verify import verify_jwt
 from webpay.base.logger import getLogger
-from webpay.pay.utils import lookup_issuer, UnknownIssuer
+from webpay.pay.utils import (lookup_issuer, refresh_issuer_secret,
+                              UnknownIssuer)
 
 log = getLogger('w.services')
 
@@ -24,18 +25,31 @@ class SigCheckForm(ParanoidForm):
                      .format(exc))
             raise forms.ValidationError('INVALID_JWT_OR_UNKNOWN_ISSUER')
 
+        issuer = jwt_data.get('iss', '')
         try:
-            secret, active_product = lookup_issuer(jwt_data.get('iss', ''))
+            secret, active_product = lookup_issuer(issuer)
         except UnknownIssuer, exc:
             log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
                      .format(exc))
             raise forms.ValidationError('INVALID_JWT_OR_UNKNOWN_ISSUER')
 
+        def verify(secret):
+            return verify_jwt(enc_jwt,
+                              settings.DOMAIN,  # JWT audience.
+                              secret,
+                              required_keys=[])
+
         try:
-            clean_jwt = verify_jwt(enc_jwt,
-                                   settings.DOMAIN,  # JWT audience.
-                                   secret,
-                                   required_keys=[])
+            try:
+                clean_jwt = verify(secret)
+            except RequestExpired:
+                raise
+            except InvalidJWT:
+                # The issuer may have rotated its secret since we cached it.
+                secret = refresh_issuer_secret(issuer)
+                if not secret:
+                    raise
+                clean_jwt = verify(secret)
         except InvalidJWT, exc:
             log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
                      .format(exc))
@@ -52,6 +52,17 @@ class TestMonitor(TestCase):
         res = self.client.get(self.url)
         eq_(res.status_code, 200)
 
+    @mock.patch('webpay.services.views.breaker')
+    def test_breakers(self, breaker, sol, mkt):
+        breaker.states.return_value = {'https://app.com/': 'open'}
+        sol.services.request.get.return_value = {'authenticated': 'webpay'}
+        mkt.account.permissions.mine.get.return_value = {'permissions':
+                                                         {'webpay': True}}
+        res = self.client.get(self.url)
+        eq_(res.status_code, 200)
+        eq_(json.loads(res.content)['postback_breakers'],
+            {'https://app.com/': 'open'})
+
 
 class TestSigCheck(TestCase):
 
@@ -141,6 +152,19 @@ class TestSigCheck(TestCase):
         eq_(data['errors'],
             {'sig_check_jwt': ['INVALID_JWT_OR_UNKNOWN_ISSUER']})
 
+    def test_rotated_secret(self):
+        getter = self.patch_issuer()
+        getter.return_value = {'secret': 'old'}
+        url = reverse('services.sig_check')
+        self.client.post(url, {'sig_check_jwt': self.jwt(issuer='some-app',
+                                                         secret='old')})
+        getter.return_value = {'secret': 'new'}
+        res = self.client.post(
+            url, {'sig_check_jwt': self.jwt(issuer='some-app',
+                                            secret='new')})
+        eq_(res.status_code, 200)
+        eq_(getter.call_count, 2)
+
     def test_bad_jwt_typ(self):
         self.patch_issuer()
         res = self.client.post(
@@ -205,6 +229,29 @@ class TestErrorLegend(TestCase):
         data = json.loads(res.content)
         assert data['errors'], data
 
+    def test_cache_headers(self):
+        res = self.client.get(reverse('services.error_legend'),
+                              data=dict(locale='pl'))
+        assert res['ETag'], res
+        eq_(res['Cache-Control'],
+            'public, max-age={0}'.format(settings.ERROR_LEGEND_MAX_AGE))
+
+    def test_not_modified(self):
+        url = reverse('services.error_legend')
+        etag = self.client.get(url, data=dict(locale='pl'))['ETag']
+        res = self.client.get(url, data=dict(locale='pl'),
+                              HTTP_IF_NONE_MATCH=etag)
+        eq_(res.status_code, 304, res)
+        eq_(res.content, '')
+        eq_(res['ETag'], etag)
+
+    def test_etag_per_locale(self):
+        url = reverse('services.error_legend')
+        res = self.client.get(url, data=dict(locale='pl'),
+                              HTTP_IF_NONE_MATCH=self.client.get(
+                                  url, data=dict(locale='de'))['ETag'])
+        eq_(res.status_code, 200, res)
+
 
 class TestAPIException(TestCase):
 
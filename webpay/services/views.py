@@ -1,6 +1,7 @@
 import json
 
 from django import http
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.utils import translation
@@ -11,9 +12,10 @@ from rest_framework import viewsets
 from lib.marketplace.api import client as marketplace
 from lib.solitude.api import client as solitude
 from webpay.base.decorators import json_view
-from webpay.base.dev_messages import legend
+from webpay.base.dev_messages import compiled_legend
 from webpay.base.logger import getLogger
 from webpay.base.utils import log_cef_meta
+from webpay.pay.dispatch import breaker
 
 from .forms import ErrorLegendForm, SigCheckForm
 
@@ -55,6 +57,10 @@ def monitor(request):
             msg = 'Not the webpay user, got: %s' % users['authenticated']
 
     content['solitude'] = msg
+
+    # Report app hosts that notices are being held back from. This is
+    # informational, a broken app server isn't a problem with webpay.
+    content['postback_breakers'] = breaker.states()
     return http.HttpResponse(content=json.dumps(content),
                              content_type='application/json',
                              status=200 if all_good else 500)
@@ -109,9 +115,16 @@ def error_legend(request):
         data['errors'] = form.errors
         return http.HttpResponse(content=json.dumps(data), status=400)
 
-    data['locale'] = form.cleaned_data['locale'] or data['locale']
-    data['legend'] = legend(locale=data['locale'])
-    return data
+    legend = compiled_legend(form.cleaned_data['locale'] or data['locale'])
+    if request.META.get('HTTP_IF_NONE_MATCH') == legend.etag:
+        res = http.HttpResponseNotModified()
+    else:
+        res = http.HttpResponse(legend.content,
+                                content_type='application/json; charset=utf-8')
+    res['ETag'] = legend.etag
+    res['Cache-Control'] = 'public, max-age={0}'.format(
+        settings.ERROR_LEGEND_MAX_AGE)
+    return res
 
 
 class APIException(viewsets.ViewSet):
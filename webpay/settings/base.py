@@ -134,6 +134,9 @@ MIDDLEWARE_CLASSES = (
     'webpay.base.middleware.CSPMiddleware',
     'django_statsd.middleware.GraphiteRequestTimingMiddleware',
     'django_statsd.middleware.GraphiteMiddleware',
+    'webpay.base.middleware.RequestCacheMiddleware',
+    'webpay.base.middleware.CallBudgetMiddleware',
+    'webpay.base.middleware.SessionSizeMiddleware',
     'webpay.base.middleware.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -152,8 +155,18 @@ ROOT_URLCONF = 'webpay.urls'
 
 SECRET_KEY = 'please change this'
 
+# Use 'webpay.base.sessions' to keep sessions in the cache instead of in an
+# encrypted cookie.
 SESSION_ENGINE = 'encrypted_cookies'
 
+# With the webpay.base.sessions engine, also write sessions to the database
+# so that they survive the cache being flushed.
+SESSION_WRITE_THROUGH = False
+
+# When True the verified pay request is kept in the cache instead of the
+# session cookie, which only keeps a reference to it. See webpay.pay.notes.
+COMPACT_SESSION_NOTES = True
+
 # Custom name of session cookie.
 # This must be a non-default so it doesn't collide with zamboni on the same
 # subdomain.
@@ -233,8 +246,28 @@ BROWSERID_VERIFICATION_URL = 'https://%s/verify' % BROWSERID_DOMAIN
 NATIVE_FXA_VERIFICATION_URL = 'https://verifier.accounts.firefox.com/v2'
 NATIVE_FXA_ISSUER = 'api.accounts.firefox.com'
 
+# Size and timeout (in seconds) of the in-process cache of Solitude buyers
+# that sits in front of the shared cache.
+BUYER_LOCAL_CACHE_SIZE = 1000
+BUYER_LOCAL_CACHE_TIMEOUT = 60
+
+# How long (in seconds) to remember the Solitude resource_pk of a buyer uuid.
+BUYER_PK_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
 CACHEBUST_IMGS = True
 
+# How long (in seconds) to cache the product and secret of a JWT issuer.
+# Set to 0 to look up the issuer in Solitude every time.
+ISSUER_CACHE_TIMEOUT = 60 * 5
+
+# How long (in seconds) to remember that a JWT issuer is unknown.
+ISSUER_NEGATIVE_CACHE_TIMEOUT = 30
+
+# How long (in seconds) to cache the generic and provider products that a
+# purchase of a seller's product resolves to. Set to 0 to look them up in
+# Solitude every time.
+PRODUCT_CACHE_TIMEOUT = 60
+
 # A cache nuggets setting, that hasn't been updated to use the
 # new PREFIX in the CACHE setttings. Overridden on all prod servers.
 CACHE_PREFIX = 'webpay'
@@ -366,10 +399,28 @@ MARKETPLACE_OAUTH = {
     'secret': 'some-secret-eh?'
 }
 
+# Seconds a price tier fetched from the Marketplace is fresh for and how many
+# seconds after that it may still be served while it is refreshed.
+PRICE_CACHE_TIMEOUT = 60
+PRICE_CACHE_MAX_STALE = 60 * 10
+
+# Keep all Marketplace price tiers in memory so that price lookups don't
+# need a network call. See lib.marketplace.api.PriceIndex.
+PRICE_INDEX_ENABLED = True
+PRICE_INDEX = {
+    # Seconds after which the tiers are reloaded in the background.
+    'refresh': 60 * 5,
+    # Seconds after which the tiers are no longer used.
+    'max_age': 60 * 30,
+    # Tiers to ask for in each request to the prices API.
+    'page_size': 100,
+}
+
 # Configure our test runner for some nice test output.
 NOSE_PLUGINS = [
     'nosenicedots.NiceDots',
     'blockage.plugins.NoseBlockage',
+    'webpay.base.tests.plugins.ResetCaches',
 ]
 
 NOSE_ARGS = [
@@ -378,6 +429,7 @@ NOSE_ARGS = [
     # This breaks xunit in CI. FIXME.
     # '--with-nicedots',
     '--with-blockage',
+    '--with-reset-caches',
     '--http-whitelist=""',
 ]
 
@@ -430,6 +482,53 @@ POSTBACK_ATTEMPTS = 5
 # Amount of seconds between each payment postback attempt.
 POSTBACK_DELAY = 300
 
+# Keep signed notices so that retries send the same JWT without looking up
+# the transaction and secret again.
+CACHE_SIGNED_NOTICES = True
+
+# Sign a notice again when its JWT expires in less than this many seconds.
+NOTICE_RESIGN_MARGIN = 60 * 10
+
+# Connection pooling of postbacks and chargebacks sent from each worker
+# process and how many of them can be sent to one host at a time by all
+# workers. See webpay.pay.dispatch.NoticeDispatcher.
+NOTICE_DISPATCHER = {
+    'pool_connections': 20,
+    'pool_maxsize': 10,
+    'max_per_host': 5,
+    # Seconds before the slot of a worker that died sending a notice is
+    # given back. This must be longer than the notice timeout.
+    'slot_timeout': 60,
+    # Seconds to wait before sending a notice again when the host was busy.
+    # These retries don't count against POSTBACK_ATTEMPTS.
+    'busy_retry_delay': 30,
+    # After this many busy retries the next one counts as an attempt.
+    'max_busy_retries': 20,
+}
+
+# Stop sending notices to an app host for a while once too many of them
+# fail. See webpay.pay.dispatch.CircuitBreaker.
+POSTBACK_BREAKER_ENABLED = True
+POSTBACK_BREAKER = {
+    # Seconds over which failures are counted.
+    'window': 300,
+    # Don't open the circuit until this many notices were sent in a window.
+    'min_requests': 10,
+    # Fraction of failed notices that opens the circuit.
+    'failure_rate': 0.5,
+    # Seconds the circuit stays open before probing the host again.
+    'open_for': 300,
+    # Successful probes needed to close the circuit.
+    'probes': 3,
+    # Seconds before a probe that never reported back is given up on.
+    # Notices held back while another one probes are retried after this.
+    'probe_timeout': 30,
+    # Notices held back by the circuit are retried when it is half open.
+    # These retries don't count against POSTBACK_ATTEMPTS until there
+    # have been this many.
+    'max_held_retries': 100,
+}
+
 # In production, all locales must be whitelisted for use, regardless of the
 # existence of po files.
 PROD_LANGUAGES = (
@@ -476,6 +575,18 @@ PROD_LANGUAGES = (
     'zh-TW',
 )
 
+# The number of distinct Accept-Language headers to remember the best locale
+# for. See webpay.base.middleware.LocaleTables.
+ACCEPT_LANGUAGE_CACHE_SIZE = 1000
+
+# Seconds that clients and CDNs may cache the error legend for. The legend
+# only changes on deploy and is sent with an ETag so it can be revalidated.
+ERROR_LEGEND_MAX_AGE = 60 * 60 * 24
+
+# Compile the error legend of every locale in PROD_LANGUAGES when the WSGI
+# app starts instead of on the first request for each one.
+ERROR_LEGEND_PRECOMPILE = True
+
 # Maximum length of a product description. This is used to truncate long
 # descriptions so that they do not break things like session cookies.
 PRODUCT_DESCRIPTION_LENGTH = 255
@@ -490,6 +601,14 @@ PROJECT_MODULE = 'webpay'
 # will trigger form errors.
 SHORT_FIELD_MAX_LENGTH = 255
 
+# Pay request JWTs longer than this many bytes are rejected before they are
+# decoded.
+JWT_MAX_LENGTH = 1024 * 16
+
+# Seconds of clock skew allowed when checking the exp and nbf of a pay
+# request JWT.
+JWT_LEEWAY = 60
+
 # This is the typ for signature checking JWTs.
 # This is used to integrate with Marketplace and other apps.
 SIG_CHECK_TYP = 'mozilla/payments/sigcheck/v1'
@@ -507,6 +626,15 @@ SITE_URL = host.rstrip('/')
 # server for it.
 SOLITUDE_URL = os.environ.get('SOLITUDE_URL', 'http://localhost:2602')
 
+# When True, independent Solitude lookups (such as the buyer and seller of a
+# new transaction) are made concurrently instead of one after another.
+SOLITUDE_CONCURRENT_LOOKUPS = True
+
+# The path of a Solitude endpoint that takes several GET requests in one
+# POST and returns all the responses, for example 'generic/batch'. When None
+# batched lookups are made concurrently instead.
+SOLITUDE_BATCH_ENDPOINT = None
+
 # The OAuth tokens for solitude.
 SOLITUDE_OAUTH = {'key': 'webpay', 'secret': 'please change this'}
 
@@ -529,6 +657,10 @@ SPA_URLS = [
 ]
 SPA_USE_MIN_JS = True
 
+# Render spa/index.html once per locale and Spartacus build and only fill in
+# the values that change for each request. See webpay.spa.shell.
+SPA_INDEX_PRERENDER = True
+
 # SPA App settings. These are merged into the app's settings.js.
 # This allows us to specify different settings for -dev/stage/prod
 SPA_SETTINGS = {
@@ -546,6 +678,60 @@ SPA_SETTINGS = {
     ]
 }
 
+# Connection pools for the Solitude and Marketplace API clients. Each entry
+# is keyed by API name; 'default' applies to every API unless overridden.
+#
+# * pool_maxsize: the maximum number of keep-alive connections to the host.
+# * max_retries: retries for failed connections, requests are not retried.
+# * timeout: the timeout in seconds for each request.
+# * stats_interval: how often (in seconds) pool stats are sent to statsd.
+SLUMBER_POOLS = {
+    'default': {
+        'pool_connections': 10,
+        'pool_maxsize': 10,
+        'max_retries': 0,
+        'timeout': 30,
+        'stats_interval': 60,
+    },
+    'solitude': {
+        'pool_maxsize': 25,
+        'timeout': 20,
+    },
+    'marketplace': {
+        'pool_maxsize': 10,
+        'timeout': 10,
+    },
+}
+
+# Retries on connection errors for each Slumber endpoint, keyed by
+# '<pool name>.<endpoint>'. See lib.utils.RetryPolicy.
+SLUMBER_RETRY = {
+    'default': {
+        'attempts': 1,
+        'backoff': 0.1,
+        'max_backoff': 2,
+        'deadline': 10,
+        'hedge_after': None,
+    },
+    'marketplace.prices': {
+        # Roughly the p95 of the prices endpoint.
+        'hedge_after': 0.5,
+    },
+}
+
+# The number of Solitude and Marketplace calls a view may make before a
+# warning is logged, keyed by the dotted path of the view. Zero means no
+# budget. See webpay.base.middleware.CallBudgetMiddleware.
+SLUMBER_CALL_BUDGET = {
+    'default': 10,
+}
+
+# When True, add a Server-Timing header with the time spent in each
+# Solitude and Marketplace endpoint to responses. The header exposes
+# internal endpoints so it is only for development, buyers with super
+# powers always get it.
+SLUMBER_SERVER_TIMING = False
+
 STATSD_CLIENT = 'django_statsd.clients.normal'
 
 TEMPLATE_CONTEXT_PROCESSORS = list(TEMPLATE_CONTEXT_PROCESSORS) + [
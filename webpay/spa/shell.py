@@ -0,0 +1,109 @@
+"""
+Serves spa/index.html, the page that starts Spartacus.
+
+The page only differs between requests in a locale by a few values such
+as the FxA state and the view to start with. When SPA_INDEX_PRERENDER is
+on the template is rendered once per locale and Spartacus build with
+placeholders for those values, which are then filled in for each request
+without going through Jinja.
+"""
+import re
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.utils import translation
+
+import jingo
+from funfactory.context_processors import i18n
+from jinja2 import escape
+
+from lib.solitude import constants as solitude_constants
+from webpay.base import utils
+from webpay.base.cache import LocalCache
+
+TEMPLATE = 'spa/index.html'
+
+# The values of spa/index.html that change from one request to the next.
+DYNAMIC = ('csrf_token', 'error_code', 'fxa_auth_url', 'fxa_state',
+           'logged_in_user', 'mkt_user', 'start_view', 'super_powers',
+           'trans_start_url')
+
+_placeholder = re.compile(r'@@spa:(\w+)@@')
+
+# Maps (locale, build id) to a Shell. Shells of older builds fall out as
+# new ones come in.
+shells = LocalCache('spa_shell', size=200, timeout=0)
+
+
+class Shell(object):
+    """
+    spa/index.html rendered with a placeholder in place of each of the
+    DYNAMIC values.
+    """
+
+    def __init__(self, html):
+        # Static HTML at even indexes, names of values at odd ones.
+        self.parts = _placeholder.split(html)
+
+    @classmethod
+    def build(cls, request):
+        """Render the shell for the active locale."""
+        ctx = i18n(request)
+        ctx.update(settings=settings, solitude_constants=solitude_constants)
+        ctx.update((name, '@@spa:{0}@@'.format(name)) for name in DYNAMIC)
+        return cls(jingo.env.get_template(TEMPLATE).render(ctx))
+
+    def render(self, values):
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = escape(values[parts[i]])
+        return u''.join(parts)
+
+
+def get_shell(request):
+    key = (translation.get_language(), utils.spartacus_build_id())
+    shell = shells.get(key)
+    if shell is None:
+        shell = Shell.build(request)
+        shells.set(key, shell)
+    return shell
+
+
+def index_values(request, ctx):
+    """
+    Return the DYNAMIC values of spa/index.html given the context of a
+    view, which can have:
+
+    * fxa_state, fxa_auth_url: see webpay.base.helpers.fxa_auth_info().
+    * start_view: the Spartacus view to start with.
+    * error_code: the error to show, with the payment-failed view.
+    * mkt_user: True if the buyer was logged in by a Marketplace JWT,
+      False if they weren't and None when there was no JWT.
+    * super_powers: True if the buyer has super powers.
+    * transaction_status_url: the URL to poll for the transaction, by
+      default the one of the transaction in the session.
+    """
+    mkt_user = ctx.get('mkt_user')
+    return {
+        'csrf_token': getattr(request, 'csrf_token', ''),
+        'error_code': ctx.get('error_code') or '',
+        'fxa_auth_url': ctx.get('fxa_auth_url') or '',
+        'fxa_state': ctx.get('fxa_state') or '',
+        'logged_in_user': request.session.get('logged_in_user', ''),
+        'mkt_user': ('true' if mkt_user else
+                     'false' if mkt_user is False else ''),
+        'start_view': ctx.get('start_view') or '',
+        'super_powers': 'true' if ctx.get('super_powers') else 'false',
+        'trans_start_url': (ctx.get('transaction_status_url') or
+                            reverse('api:pay.trans_start_url')),
+    }
+
+
+def render_index(request, ctx=None, status=200):
+    """Return a response of spa/index.html, see index_values() for `ctx`."""
+    values = index_values(request, ctx or {})
+    if not settings.SPA_INDEX_PRERENDER:
+        return render(request, TEMPLATE, values, status=status)
+    return HttpResponse(get_shell(request).render(values), status=status)
@@ -0,0 +1,76 @@
+from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
+
+import mock
+from nose.tools import eq_
+from pyquery import PyQuery as pq
+
+from webpay.base import dev_messages as msg
+from webpay.base.tests import BasicSessionCase
+from webpay.base.utils import custom_error
+from webpay.spa.shell import Shell, shells
+
+
+class TestShell(BasicSessionCase):
+
+    def setUp(self):
+        super(TestShell, self).setUp()
+        shells.clear()
+        self.addCleanup(shells.clear)
+
+    def get(self, prerender, *args, **kw):
+        with self.settings(SPA_INDEX_PRERENDER=prerender):
+            return self.client.get(*args, **kw)
+
+    def test_same_as_rendered(self):
+        session = self.client.session
+        session['logged_in_user'] = 'buyer@example.com'
+        session['super_powers'] = True
+        self.save_session(session)
+        rendered = self.get(False, reverse('index'))
+        prerendered = self.get(True, reverse('index'))
+        eq_(prerendered.status_code, 200)
+        eq_(prerendered.content, rendered.content)
+
+    def test_values(self):
+        res = self.get(True, reverse('spa:index', args=['enter-pin']))
+        body = pq(res.content)('body')
+        eq_(body.attr('data-mkt-user'), '')
+        eq_(body.attr('data-super-powers'), 'false')
+        eq_(body.attr('data-trans-start-url'),
+            reverse('api:pay.trans_start_url'))
+        assert body.attr('data-fxa-state'), res.content
+
+    def test_error(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        with self.settings(SPA_INDEX_PRERENDER=True):
+            res = custom_error(request, 'Oops', code=msg.BAD_REQUEST)
+        eq_(res.status_code, 400)
+        body = pq(res.content)('body')
+        eq_(body.attr('data-start-view'), 'payment-failed')
+        eq_(body.attr('data-error-code'), msg.BAD_REQUEST)
+
+    def test_built_once_per_locale(self):
+        with mock.patch('webpay.spa.shell.Shell.build',
+                        wraps=Shell.build) as build:
+            self.get(True, reverse('index'))
+            self.get(True, reverse('index'))
+            eq_(build.call_count, 1)
+            res = self.get(True, reverse('index'), {'lang': 'de'})
+            eq_(build.call_count, 2)
+        eq_(pq(res.content)('html').attr('lang'), 'de')
+
+    @mock.patch('webpay.base.utils.spartacus_build_id')
+    def test_built_per_build(self, build_id):
+        build_id.return_value = 'one'
+        self.get(True, reverse('index'))
+        build_id.return_value = 'two'
+        res = self.get(True, reverse('index'))
+        eq_(pq(res.content)('body').attr('data-build-id'), 'two')
+        eq_(len(shells), 2)
+
+    def test_escaped(self):
+        shell = Shell(u'<body data-fxa-state="@@spa:fxa_state@@">')
+        eq_(shell.render({'fxa_state': '"><script>'}),
+            u'<body data-fxa-state="&#34;&gt;&lt;script&gt;">')
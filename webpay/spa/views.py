@@ -1,12 +1,12 @@
 import urlparse
 from django.conf import settings
-from django.shortcuts import render
 
 from django_paranoia.decorators import require_GET
 from mozpay.verify import InvalidJWT, _get_issuer, verify_sig
 from webpay.auth.utils import set_user
 from webpay.base.helpers import fxa_auth_info
 from webpay.base.logger import getLogger
+from webpay.spa.shell import render_index
 log = getLogger('w.spa')
 
 
@@ -41,4 +41,4 @@ def index(request, view_name=None, start_view=None):
 
     # This has to come after set_user as set_user modifies the session.
     ctx['super_powers'] = request.session.get('super_powers', False)
-    return render(request, 'spa/index.html', ctx)
+    return render_index(request, ctx)